@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+'''
+Compares the time it takes to load, save, and filter analysis results files
+with the JSON backends that are available, using the test fixture logs.
+
+Usage: benchmarks/json_backends.py [NUM_ROUNDS]
+'''
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import pkg_resources
+
+from onionperf import util
+from onionperf.analysis import OPAnalysis
+from onionperf.filtering import Filtering
+
+num_rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+logging.disable(logging.INFO)
+
+data_dir = pkg_resources.resource_filename("onionperf", "tests/data/logs/")
+work_dir = tempfile.mkdtemp()
+analysis = OPAnalysis(nickname="bench", ip_address="127.0.0.1")
+analysis.add_tgen_file(os.path.join(data_dir, "onionperf.tgen.log"))
+analysis.add_torctl_file(os.path.join(data_dir, "onionperf.torctl.log"))
+analysis.analyze()
+# skip compression, so that only JSON decoding and encoding is measured
+analysis.save(filename="onionperf.analysis.json", output_prefix=work_dir, do_compress=False)
+input_path = os.path.join(work_dir, "onionperf.analysis.json")
+fingerprints_path = os.path.join(work_dir, "fingerprints.txt")
+with open(fingerprints_path, "wt") as f:
+    f.write("$CE946DFEC40A1BFC3665A4727F54354F57297497\n")
+
+def run_rounds(func):
+    start = time.perf_counter()
+    for i in range(num_rounds):
+        func(i)
+    return (time.perf_counter() - start) / num_rounds * 1000.0
+
+def remove_output(filename):
+    # uncompressed files are appended to, so every round has to start from scratch
+    path = os.path.join(work_dir, filename)
+    if os.path.exists(path):
+        os.remove(path)
+    return filename
+
+def save(i):
+    analysis.save(filename=remove_output("saved.{0}.json".format(i % 2)), output_prefix=work_dir, do_compress=False)
+
+def apply_filters(i):
+    filtering = Filtering()
+    filtering.exclude_fingerprints(fingerprints_path)
+    filtering.apply_filters(input_path=input_path, output_dir=work_dir, output_file=remove_output("filtered.{0}.json".format(i % 2)))
+
+backends = ["json"] + (["orjson"] if util.orjson is not None else [])
+results = {}
+for backend in backends:
+    util.set_json_backend(backend)
+    results[backend] = [run_rounds(lambda i: OPAnalysis.load(filename=input_path)), run_rounds(save), run_rounds(apply_filters)]
+
+print("{0:<10}{1:>12}{2:>12}{3:>12}".format("backend", "load [ms]", "save [ms]", "filter [ms]"))
+for backend in backends:
+    print("{0:<10}{1:>12.3f}{2:>12.3f}{3:>12.3f}".format(backend, *results[backend]))
+if "orjson" in results:
+    print("{0:<10}{1:>11.2f}x{2:>11.2f}x{3:>11.2f}x".format("speedup", *[a / b for (a, b) in zip(results["json"], results["orjson"])]))
+shutil.rmtree(work_dir)
@@ -5,13 +5,18 @@
   See LICENSE for licensing information
 '''
 
-import os, re, json, datetime, logging
+import sys, os, re, pickle, datetime, logging
+
+from array import array
+from multiprocessing import Pool
+from functools import partial
+
+import numpy as np
 
 from abc import ABCMeta, abstractmethod
 
 # stem imports
 from stem import CircEvent, CircStatus, CircPurpose, StreamStatus
-from stem.response.events import CircuitEvent, CircMinorEvent, StreamEvent, BuildTimeoutSetEvent
 from stem.response import ControlMessage, convert
 
 # tgentools imports
@@ -26,24 +31,112 @@ class OPAnalysis(Analysis):
         super().__init__(nickname, ip_address)
         self.json_db = {'type': 'onionperf', 'version': '4.0', 'data': {}}
         self.torctl_filepaths = []
+        # parsers and byte offsets of log files that are analyzed incrementally
+        self.parsers = None
+        self.offsets = {}
+        self.torctl_parser = None
 
     def add_torctl_file(self, filepath):
         self.torctl_filepaths.append(filepath)
 
-    def analyze(self, date_filter=None):
+    def add_torctl_parser(self, parser):
+        '''
+        Uses a TorCtlParser that was already fed with Tor control events, for
+        example by TorMonitor while logging them, instead of a new one.
+        '''
+        self.torctl_parser = parser
+        if self.parsers is not None:
+            self.parsers = (self.parsers[0], parser)
+
+    def move_file(self, filepath, new_filepath):
+        '''
+        Continues an incremental analysis of the log file at filepath with the
+        file at new_filepath, for example after the log file has been rotated.
+        '''
+        self.tgen_filepaths = [new_filepath if path == filepath else path for path in self.tgen_filepaths]
+        self.torctl_filepaths = [new_filepath if path == filepath else path for path in self.torctl_filepaths]
+        if filepath in self.offsets:
+            self.offsets[new_filepath] = self.offsets.pop(filepath)
+
+    def analyze(self, date_filter=None, verify_with_stem=False, num_processes=1, state_ttl_seconds=None, max_state_size=None):
         if self.did_analysis:
             return
 
         self.date_filter = date_filter
-        super().analyze(do_complete=True, date_filter=self.date_filter)
-        torctl_parser = TorCtlParser(date_filter=self.date_filter)
+        tgen_parser = TGenParser(date_filter=self.date_filter)
+        torctl_parser = self.torctl_parser
+        if torctl_parser is None:
+            torctl_parser = TorCtlParser(date_filter=self.date_filter, verify_with_stem=verify_with_stem,
+                                             state_ttl_seconds=state_ttl_seconds, max_state_size=max_state_size)
+        self.__analyze_files(tgen_parser, torctl_parser, self.__get_source, num_processes)
+        self.did_analysis = True
+
+    def analyze_by_date(self, dates, verify_with_stem=False, state_ttl_seconds=None, max_state_size=None):
+        '''
+        Parses the log files once and splits the results by UTC date, for logs
+        that span several dates. Returns one analysis per date, in the order of
+        dates, with the same results as a separate analysis of the same log
+        files with that date as date_filter.
+        '''
+        tgen_parser = DailyTGenParser(dates)
+        torctl_parser = DailyTorCtlParser(dates, verify_with_stem=verify_with_stem,
+                                          state_ttl_seconds=state_ttl_seconds, max_state_size=max_state_size)
+        for filepath in self.tgen_filepaths:
+            logging.info("parsing log file at {0}".format(filepath))
+            tgen_parser.parse(self.__get_tgen_source(filepath, (tgen_parser.start_ts, tgen_parser.end_ts)), do_complete=True)
+        for filepath in self.torctl_filepaths:
+            logging.info("parsing log file at {0}".format(filepath))
+            torctl_parser.parse(util.DataSource(filepath))
+
+        analyses = []
+        for (date, date_tgen_parser, date_torctl_parser) in zip(dates, tgen_parser.parsers, torctl_parser.parsers):
+            analysis = OPAnalysis(nickname=self.nickname, ip_address=self.measurement_ip)
+            analysis.tgen_filepaths, analysis.torctl_filepaths = list(self.tgen_filepaths), list(self.torctl_filepaths)
+            analysis.date_filter = date
+            analysis.__add_parser_data(date_tgen_parser, date_torctl_parser)
+            analysis.did_analysis = True
+            analyses.append(analysis)
+        return analyses
+
+    def analyze_incrementally(self, date_filter=None, verify_with_stem=False, num_processes=1, is_final=False,
+                              state_ttl_seconds=None, max_state_size=None):
+        '''
+        Parses only the lines that were appended to the log files since the
+        previous call, and updates the results. Circuits, streams, and transfers
+        that have not completed yet are kept in the parsers, and the last line of
+        an uncompressed log file is left for the next call unless is_final is set.
+        The parsers are created in the first call, so later calls ignore
+        date_filter, verify_with_stem, state_ttl_seconds, and max_state_size. Use save_checkpoint and load_checkpoint
+        to continue the analysis in another process.
+        '''
+        if self.did_analysis:
+            return
 
-        for (filepaths, parser, json_db_key) in [(self.torctl_filepaths, torctl_parser, 'tor')]:
-            if len(filepaths) > 0:
+        if self.parsers is None:
+            self.date_filter = date_filter
+            torctl_parser = self.torctl_parser
+            if torctl_parser is None:
+                torctl_parser = TorCtlParser(date_filter=self.date_filter, verify_with_stem=verify_with_stem,
+                                             state_ttl_seconds=state_ttl_seconds, max_state_size=max_state_size)
+            self.parsers = (TGenParser(date_filter=self.date_filter), torctl_parser)
+        self.__analyze_files(self.parsers[0], self.parsers[1],
+                             lambda filepath, json_db_key: self.__get_new_lines_source(filepath, json_db_key, is_final), num_processes)
+        self.did_analysis = is_final
+
+    def __analyze_files(self, tgen_parser, torctl_parser, get_source, num_processes):
+        for (filepaths, parser, json_db_key) in [(self.tgen_filepaths, tgen_parser, 'tgen'), (self.torctl_filepaths, torctl_parser, 'tor')]:
+            if len(filepaths) > 0 or parser is self.torctl_parser:
                 for filepath in filepaths:
                     logging.info("parsing log file at {0}".format(filepath))
-                    parser.parse(util.DataSource(filepath))
+                    if json_db_key == 'tgen':
+                        parser.parse(get_source(filepath, json_db_key), do_complete=True)
+                    else:
+                        parser.parse(get_source(filepath, json_db_key), num_processes=num_processes)
+        self.__add_parser_data(tgen_parser, torctl_parser)
 
+    def __add_parser_data(self, tgen_parser, torctl_parser):
+        for (filepaths, parser, json_db_key) in [(self.tgen_filepaths, tgen_parser, 'tgen'), (self.torctl_filepaths, torctl_parser, 'tor')]:
+            if len(filepaths) > 0 or parser is self.torctl_parser:
                 if self.nickname is None:
                     parsed_name = parser.get_name()
                     if parsed_name is not None:
@@ -56,21 +149,59 @@ class OPAnalysis(Analysis):
                 if self.measurement_ip is None:
                     self.measurement_ip = "unknown"
 
-                self.json_db['data'].setdefault(self.nickname, {'measurement_ip': self.measurement_ip}).setdefault(json_db_key, parser.get_data())
+                self.json_db['data'].setdefault(self.nickname, {'measurement_ip': self.measurement_ip})[json_db_key] = parser.get_data()
         self.json_db['data'][self.nickname]["tgen"].pop("heartbeats")
         self.json_db['data'][self.nickname]["tgen"].pop("init_ts")
         self.json_db['data'][self.nickname]["tgen"].pop("stream_summary")
-        self.did_analysis = True
 
-    def save(self, filename=None, output_prefix=os.getcwd(), do_compress=True, date_prefix=None, sort_keys=True):
-        if filename is None:
-            base_filename = "onionperf.analysis.json.xz"
-            if date_prefix is not None:
-                filename = "{0}.{1}".format(util.date_to_string(date_prefix), base_filename)
-            elif self.date_filter is not None:
-                filename = "{0}.{1}".format(util.date_to_string(self.date_filter), base_filename)
+    def __get_source(self, filepath, json_db_key):
+        if json_db_key == 'tgen':
+            return self.__get_tgen_source(filepath)
+        return util.DataSource(filepath)
+
+    def __get_new_lines_source(self, filepath, json_db_key, is_final):
+        source = util.DataSource(filepath)
+        start = self.offsets.get(filepath, 0)
+        if start is None:
+            # we already read this compressed file to its end
+            end = None
+            source.set_byte_ranges([])
+        else:
+            if not source.is_seekable():
+                end = None
+            elif is_final:
+                end = os.path.getsize(filepath)
             else:
-                filename = base_filename
+                # leave the last line for the next call, it may still be written
+                end = util.find_last_line_end(filepath, newline='\n' if json_db_key == 'tgen' else '\r\n')
+            source.set_byte_ranges([(start, end)])
+        self.offsets[filepath] = end
+        return source
+
+    def __get_tgen_source(self, filepath, time_range=None):
+        # time_range is a (start, end) unix timestamp range, by default that of the date filter
+        source = util.DataSource(filepath)
+        if time_range is None and self.date_filter is not None:
+            time_range = util.date_to_timestamp_range(self.date_filter)
+        if time_range is not None and source.is_seekable():
+            # only read the lines of the date we are asked to filter from a time-ordered
+            # log, plus the first line which tells the parser the TGen version and host name
+            with open(filepath, 'rb') as f:
+                header_end = len(f.readline())
+            start = util.find_timestamp_offset(filepath, time_range[0])
+            end = util.find_timestamp_offset(filepath, time_range[1])
+            source.set_byte_ranges([(0, header_end), (max(header_end, start), end)])
+        elif time_range is not None and source.has_time_index():
+            # the first block of an indexed archive, which is always read, contains the first line
+            source.set_time_range(*time_range)
+        return source
+
+    def save(self, filename=None, output_prefix=os.getcwd(), do_compress=True, date_prefix=None, sort_keys=True, compact=False, do_columnar=False,
+             compression_codec='xz', compression_level=None, compression_threads=1):
+        if filename is None:
+            filename = get_analysis_filename(date_prefix if date_prefix is not None else self.date_filter, compression_codec)
+        else:
+            compression_codec = util.get_compression_codec(filename) or compression_codec
 
         filepath = os.path.abspath(os.path.expanduser("{0}/{1}".format(output_prefix, filename)))
         if not os.path.exists(output_prefix):
@@ -78,12 +209,105 @@ class OPAnalysis(Analysis):
 
         logging.info("saving analysis results to {0}".format(filepath))
 
-        outf = util.FileWritable(filepath, do_compress=do_compress)
-        json.dump(self.json_db, outf, sort_keys=sort_keys, separators=(',', ': '), indent=2)
+        outf = util.FileWritable(filepath, do_compress=do_compress, codec=compression_codec if do_compress else None,
+                                 level=compression_level, threads=compression_threads)
+        util.write_json(outf, self.json_db, sort_keys=sort_keys, compact=compact)
         outf.close()
 
+        if do_columnar:
+            self.save_columnar(get_columnar_filename(outf.filename))
+
         logging.info("done!")
+        return outf.filename
+
+    def save_columnar(self, filename):
+        '''
+        Saves flat tables of the tgen transfers and streams, the tor circuits and
+        streams, and the hops of tor circuit paths to a NumPy .npz file with one
+        array per column, so that they can be loaded using load_columnar without
+        decoding the JSON results.
+        '''
+        filepath = os.path.abspath(os.path.expanduser(filename))
+        logging.info("saving columnar analysis results to {0}".format(filepath))
+
+        rows = {table: [] for table in COLUMNAR_TABLES}
+        for (node, node_data) in self.json_db['data'].items():
+            for (table, (section, key)) in COLUMNAR_TABLES.items():
+                if section is None:
+                    continue
+                for record in node_data.get(section, {}).get(key, {}).values():
+                    row = {'node': node}
+                    row.update(record)
+                    rows[table].append(row)
+            for circuit in node_data.get('tor', {}).get('circuits', {}).values():
+                for (hop, (long_name, elapsed_seconds)) in enumerate(circuit.get('path', [])):
+                    fingerprint, _, nickname = long_name.partition('~')
+                    rows['tor_circuit_hops'].append({'node': node, 'circuit_id': circuit['circuit_id'], 'hop': hop,
+                                                     'fingerprint': fingerprint.lstrip('$'), 'nickname': nickname,
+                                                     'elapsed_seconds': elapsed_seconds})
+
+        arrays = {}
+        for (table, table_rows) in rows.items():
+            for (column, values) in build_columnar_table(table_rows).items():
+                arrays["{0}/{1}".format(table, column)] = values
+        with open(filepath, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+
+    def save_checkpoint(self, filename):
+        '''
+        Saves the state of an incremental analysis, including the byte offsets
+        into the log files, the open circuits, streams, and transfers, and the
+        partial results, so that it can be continued using load_checkpoint.
+        '''
+        filepath = os.path.abspath(os.path.expanduser(filename))
+        logging.info("saving analysis checkpoint to {0}".format(filepath))
+        # write to a temporary file first, so that we never leave a broken checkpoint behind
+        with open("{0}.tmp".format(filepath), 'wb') as f:
+            pickle.dump(self, f)
+        os.replace("{0}.tmp".format(filepath), filepath)
+
+    @classmethod
+    def load_columnar(cls, filename="onionperf.analysis.npz", input_prefix=os.getcwd(), as_data_frames=True):
+        '''
+        Loads the tables written by save_columnar, and returns a dict with table
+        names as keys and pandas DataFrames as values, or dicts of NumPy arrays
+        by column name if as_data_frames is False.
+        '''
+        filepath = os.path.abspath(os.path.expanduser("{0}".format(filename)))
+        if not os.path.exists(filepath):
+            filepath = os.path.abspath(os.path.expanduser("{0}/{1}".format(input_prefix, filename)))
+            if not os.path.exists(filepath):
+                logging.warning("file does not exist at '{0}'".format(filepath))
+                return None
+
+        logging.info("loading columnar analysis results from {0}".format(filepath))
 
+        tables = {table: {} for table in COLUMNAR_TABLES}
+        with np.load(filepath, allow_pickle=False) as npz:
+            for key in npz.files:
+                table, _, column = key.partition('/')
+                tables.setdefault(table, {})[column] = npz[key]
+        if as_data_frames:
+            import pandas as pd
+            tables = {table: pd.DataFrame(columns) for (table, columns) in tables.items()}
+        return tables
+
+    @classmethod
+    def load_checkpoint(cls, filename):
+        filepath = os.path.abspath(os.path.expanduser(filename))
+        if not os.path.exists(filepath):
+            logging.warning("file does not exist at '{0}'".format(filepath))
+            return None
+
+        logging.info("loading analysis checkpoint from {0}".format(filepath))
+        with open(filepath, 'rb') as f:
+            analysis_instance = pickle.load(f)
+        for (log_filepath, offset) in analysis_instance.offsets.items():
+            if offset is not None and util.DataSource(log_filepath).is_seekable() and os.path.getsize(log_filepath) < offset:
+                logging.warning("log file at '{0}' is shorter than at the last checkpoint, not continuing".format(log_filepath))
+                return None
+        return analysis_instance
 
     def get_tgen_streams(self, node):
         try:
@@ -113,7 +337,15 @@ class OPAnalysis(Analysis):
             return None
 
     @classmethod
-    def load(cls, filename="onionperf.analysis.json.xz", input_prefix=os.getcwd()):
+    def load(cls, filename="onionperf.analysis.json.xz", input_prefix=os.getcwd(), sections=None, filters=None):
+        '''
+        Loads analysis results from a file. If sections is given, only the
+        listed sections of the data of each node are loaded, like 'tgen' or
+        'tor/circuits', and all other objects and arrays in the data of each
+        node are skipped while reading the file. If filters is given, the
+        filters overlay file of that name next to the file is applied, as if
+        the file had been rewritten by `onionperf filter`.
+        '''
         filepath = os.path.abspath(os.path.expanduser("{0}".format(filename)))
         if not os.path.exists(filepath):
             filepath = os.path.abspath(os.path.expanduser("{0}/{1}".format(input_prefix, filename)))
@@ -125,7 +357,10 @@ class OPAnalysis(Analysis):
 
         inf = util.DataSource(filepath)
         inf.open()
-        db = json.load(inf.get_file_handle())
+        if sections is None:
+            db = util.json_loads(inf.get_file_handle().read())
+        else:
+            db = util.JSONSectionReader(inf.get_file_handle()).load(partial(select_analysis_sections, sections))
         inf.close()
 
         logging.info("done!")
@@ -136,10 +371,152 @@ class OPAnalysis(Analysis):
         elif db['type'] != 'onionperf' or str(db['version']) >= '5.':
             logging.warning("type or version not supported (type={0}, version={1})".format(db['type'], db['version']))
             return None
+
+        analysis_instance = cls()
+        analysis_instance.json_db = db
+        if filters is not None:
+            filters_filepath = get_filters_filename(filepath, filters)
+            if not os.path.exists(filters_filepath):
+                logging.warning("filters overlay file does not exist at '{0}'".format(filters_filepath))
+                return None
+            analysis_instance.apply_filters_overlay(filters_filepath)
+        return analysis_instance
+
+    def apply_filters_overlay(self, filepath):
+        '''
+        Marks the Tor circuits listed in a filters overlay file as filtered out
+        and replaces the filter metadata with the one in the overlay.
+        '''
+        with open(filepath, 'rb') as f:
+            overlay = util.json_loads(f.read())
+        if overlay.get('type') != 'onionperf-filters' or str(overlay.get('version')) >= '2.':
+            raise ValueError("filters overlay type or version not supported (type={0}, version={1})".format(
+                overlay.get('type'), overlay.get('version')))
+        self.json_db['filters'] = overlay['filters']
+        self.json_db['version'] = '4.0'
+        for node, circuit_ids in overlay['filtered_out'].get('tor/circuits', {}).items():
+            tor_circuits = self.get_tor_circuits(node)
+            if tor_circuits is None:
+                continue
+            for circuit_id in circuit_ids:
+                if circuit_id in tor_circuits:
+                    tor_circuit = tor_circuits[circuit_id]
+                    tor_circuit["filtered_out"] = True
+                    tor_circuits[circuit_id] = dict(sorted(tor_circuit.items()))
+
+# tables in columnar analysis results, with the section and key of the records in
+# the data of each node that make up their rows, except for the hops of circuit paths
+COLUMNAR_TABLES = {
+    'tgen_transfers': ('tgen', 'transfers'),
+    'tgen_streams': ('tgen', 'streams'),
+    'tor_circuits': ('tor', 'circuits'),
+    'tor_streams': ('tor', 'streams'),
+    'tor_circuit_hops': (None, None),
+}
+
+def select_analysis_sections(sections, path):
+    '''
+    Decides for util.JSONSectionReader whether to load the object or array at
+    the given path of analysis results, given sections of node data to load.
+    '''
+    if len(path) < 3:
+        return None if len(path) == 0 or path[0] == 'data' else True
+    section = '/'.join(path[2:])
+    for selected_section in sections:
+        if section == selected_section or section.startswith(selected_section + '/'):
+            return True
+    for selected_section in sections:
+        if selected_section.startswith(section + '/'):
+            return None
+    return False
+
+def get_analysis_filename(date=None, compression_codec='xz'):
+    '''
+    Returns the default name of an analysis results file, which starts with the
+    given date, if any, and ends in the extension of the compression codec.
+    '''
+    base_filename = "onionperf.analysis.json{0}".format(util.COMPRESSION_CODECS[compression_codec][0])
+    if date is not None:
+        return "{0}.{1}".format(util.date_to_string(date), base_filename)
+    return base_filename
+
+def get_columnar_filename(filename):
+    '''
+    Returns the name of the columnar sidecar file of an analysis results file,
+    for example onionperf.analysis.npz for onionperf.analysis.json.xz.
+    '''
+    codec = util.get_compression_codec(filename)
+    if codec is not None:
+        filename = filename[:-len(util.COMPRESSION_CODECS[codec][0])]
+    if filename.endswith('.json'):
+        filename = filename[:-len('.json')]
+    return "{0}.npz".format(filename)
+
+FILTERS_EXTENSION = '.filters.json'
+
+# the fingerprint and, if known, nickname of a relay in a tor circuit path, like $ABCD...~nickname
+LONG_NAME_PATTERN = re.compile(r"\$?([0-9a-fA-F]{40})(?:[~=]([0-9a-zA-Z]{1,19}))?")
+
+def parse_long_name(long_name):
+    '''
+    Returns the upper-case fingerprint and the nickname, or None if it is not
+    known, of a relay in a tor circuit path, or None if the long name does not
+    contain a fingerprint. Hops without nickname are written as $ABCD...~None.
+    '''
+    long_name_match = LONG_NAME_PATTERN.match(long_name)
+    if not long_name_match:
+        return None
+    nickname = long_name_match.group(2)
+    return (long_name_match.group(1).upper(), nickname if nickname != "None" else None)
+
+def get_filters_filename(filename, name):
+    '''
+    Returns the name of the filters overlay sidecar file of the given name of
+    an analysis results file, for example
+    onionperf.analysis.relays.filters.json for onionperf.analysis.json.xz and
+    relays.
+    '''
+    codec = util.get_compression_codec(filename)
+    if codec is not None:
+        filename = filename[:-len(util.COMPRESSION_CODECS[codec][0])]
+    if filename.endswith('.json'):
+        filename = filename[:-len('.json')]
+    return "{0}.{1}{2}".format(filename, name, FILTERS_EXTENSION)
+
+def build_columnar_table(rows):
+    '''
+    Turns a list of dicts into a dict of NumPy arrays with one array per column.
+    Nested dicts become columns named by their keys joined with '/', and lists
+    are left out. Missing numbers are NaN, missing strings are empty, missing
+    booleans are False, and columns of mixed types are stored as strings.
+    '''
+    def flatten(record, prefix, flat_row):
+        for (key, value) in record.items():
+            if isinstance(value, dict):
+                flatten(value, "{0}{1}/".format(prefix, key), flat_row)
+            elif not isinstance(value, list):
+                flat_row[prefix + str(key)] = value
+        return flat_row
+
+    flat_rows = [flatten(row, '', {}) for row in rows]
+    columns = {}
+    for flat_row in flat_rows:
+        for column in flat_row:
+            columns.setdefault(column, None)
+
+    table = {}
+    for column in columns:
+        values = [flat_row.get(column) for flat_row in flat_rows]
+        present_values = [value for value in values if value is not None]
+        if all(isinstance(value, bool) for value in present_values):
+            table[column] = np.array([value is True for value in values], dtype=bool)
+        elif all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+            table[column] = np.array(values, dtype=np.int64)
+        elif all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present_values):
+            table[column] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
         else:
-            analysis_instance = cls()
-            analysis_instance.json_db = db
-            return analysis_instance
+            table[column] = np.array(['' if value is None else str(value) for value in values], dtype=str)
+    return table
 
 class Parser(object, metaclass=ABCMeta):
     @abstractmethod
@@ -153,7 +530,22 @@ class Parser(object, metaclass=ABCMeta):
         pass
 
 
+# event keys like "GENERAL:BUILT" repeat for every circuit and stream, so each
+# distinct key is formatted once and shared by all of them
+EVENT_KEYS = {}
+
+def get_event_key(prefix, suffix):
+    try:
+        return EVENT_KEYS[(prefix, suffix)]
+    except KeyError:
+        return EVENT_KEYS.setdefault((prefix, suffix), sys.intern("{0}:{1}".format(prefix, suffix)))
+
 class TorStream(object):
+    # streams are kept compact while in flight, and only expanded in get_data
+    __slots__ = ('stream_id', 'circuit_id', 'unix_ts_start', 'unix_ts_end', 'failure_reason_local',
+                 'failure_reason_remote', 'source', 'target', 'event_purposes', 'event_statuses',
+                 'event_times', 'last_purpose')
+
     def __init__(self, sid):
         self.stream_id = sid
         self.circuit_id = None
@@ -163,14 +555,20 @@ class TorStream(object):
         self.failure_reason_remote = None
         self.source = None
         self.target = None
-        self.elapsed_seconds = []
+        self.event_purposes = []
+        self.event_statuses = []
+        self.event_times = array('d')
         self.last_purpose = None
 
     def add_event(self, purpose, status, arrived_at):
+        # events without a purpose inherit the last one, which is resolved in
+        # get_data so that stream fragments can be merged
         if purpose is not None:
+            purpose = sys.intern(purpose)
             self.last_purpose = purpose
-        key = "{0}:{1}".format(self.last_purpose, status)
-        self.elapsed_seconds.append([key, arrived_at])
+        self.event_purposes.append(purpose)
+        self.event_statuses.append(sys.intern(status))
+        self.event_times.append(arrived_at)
 
     def set_circ_id(self, circ_id):
         if circ_id is not None:
@@ -195,25 +593,52 @@ class TorStream(object):
     def set_source(self, source):
         self.source = source
 
+    def merge(self, stream):
+        # continue this stream with the events of a fragment of the same stream
+        # that was parsed from a later part of the log
+        self.set_circ_id(stream.circuit_id)
+        self.event_purposes.extend(stream.event_purposes)
+        self.event_statuses.extend(stream.event_statuses)
+        self.event_times.extend(stream.event_times)
+        if stream.last_purpose is not None:
+            self.last_purpose = stream.last_purpose
+        if stream.unix_ts_start is not None:
+            self.set_start_time(stream.unix_ts_start)
+            self.set_source(stream.source)
+        self.set_target(stream.target)
+        self.set_local_failure(stream.failure_reason_local)
+        self.set_remote_failure(stream.failure_reason_remote)
+        self.set_end_time(stream.unix_ts_end)
+        return self
+
     def get_data(self):
         if self.unix_ts_start is None or self.unix_ts_end is None:
             return None
-        d = self.__dict__
-        for item in d['elapsed_seconds']:
-            item[1] = item[1] - self.unix_ts_start
-        del(d['last_purpose'])
-        if d['failure_reason_local'] is None: del(d['failure_reason_local'])
-        if d['failure_reason_remote'] is None: del(d['failure_reason_remote'])
-        if d['source'] is None: del(d['source'])
-        if d['target'] is None: del(d['target'])
+        d = {'stream_id': self.stream_id, 'circuit_id': self.circuit_id,
+             'unix_ts_start': self.unix_ts_start, 'unix_ts_end': self.unix_ts_end}
+        if self.failure_reason_local is not None: d['failure_reason_local'] = self.failure_reason_local
+        if self.failure_reason_remote is not None: d['failure_reason_remote'] = self.failure_reason_remote
+        if self.source is not None: d['source'] = self.source
+        if self.target is not None: d['target'] = self.target
+        d['elapsed_seconds'] = elapsed_seconds = []
+        last_purpose = None
+        for (purpose, status, arrived_at) in zip(self.event_purposes, self.event_statuses, self.event_times):
+            if purpose is not None:
+                last_purpose = purpose
+            elapsed_seconds.append([get_event_key(last_purpose, status), arrived_at - self.unix_ts_start])
         return d
 
     def __str__(self):
-        return('stream id=%d circ_id=%s %s' % (self.id, self.circ_id,
-               ' '.join(['%s=%s' % (event, arrived_at)
-               for (event, arrived_at) in sorted(self.elapsed_seconds, key=lambda item: item[1])])))
+        return('stream id=%d circ_id=%s %s' % (self.stream_id, self.circuit_id,
+               ' '.join(['%s=%s' % (status, arrived_at)
+               for (status, arrived_at) in zip(self.event_statuses, self.event_times)])))
 
 class TorCircuit(object):
+    # circuits are kept compact while in flight, and only expanded in get_data
+    __slots__ = ('circuit_id', 'unix_ts_start', 'unix_ts_end', 'failure_reason_local', 'failure_reason_remote',
+                 'buildtime_seconds', 'build_timeout', 'build_quantile', 'event_keys', 'event_times',
+                 'path_hops', 'path_times')
+
     def __init__(self, cid):
         self.circuit_id = cid
         self.unix_ts_start = None
@@ -223,14 +648,18 @@ class TorCircuit(object):
         self.buildtime_seconds = None
         self.build_timeout = None
         self.build_quantile = None
-        self.elapsed_seconds = []
-        self.path = []
+        self.event_keys = []
+        self.event_times = array('d')
+        self.path_hops = []
+        self.path_times = array('d')
 
     def add_event(self, event, arrived_at):
-        self.elapsed_seconds.append([str(event), arrived_at])
+        self.event_keys.append(sys.intern(str(event)))
+        self.event_times.append(arrived_at)
 
     def add_hop(self, hop, arrived_at):
-        self.path.append(["${0}~{1}".format(hop[0], hop[1]), arrived_at])
+        self.path_hops.append(sys.intern("${0}~{1}".format(hop[0], hop[1])))
+        self.path_times.append(arrived_at)
 
     def set_launched(self, unix_ts, build_timeout, build_quantile):
         if self.unix_ts_start is None:
@@ -251,58 +680,232 @@ class TorCircuit(object):
         if self.buildtime_seconds is None:
             self.buildtime_seconds = unix_ts
 
+    def merge(self, circuit):
+        # continue this circuit with the events of a fragment of the same circuit
+        # that was parsed from a later part of the log
+        if circuit.unix_ts_start is not None:
+            self.set_launched(circuit.unix_ts_start, circuit.build_timeout, circuit.build_quantile)
+        self.event_keys.extend(circuit.event_keys)
+        self.event_times.extend(circuit.event_times)
+        self.path_hops.extend(circuit.path_hops)
+        self.path_times.extend(circuit.path_times)
+        if circuit.buildtime_seconds is not None:
+            self.set_build_time(circuit.buildtime_seconds)
+        self.set_local_failure(circuit.failure_reason_local)
+        self.set_remote_failure(circuit.failure_reason_remote)
+        self.set_end_time(circuit.unix_ts_end)
+        return self
+
     def get_data(self):
         if self.unix_ts_start is None or self.unix_ts_end is None:
             return None
-        d = self.__dict__
-        for item in d['elapsed_seconds']:
-            item[1] = item[1] - self.unix_ts_start
-        for item in d['path']:
-            item[1] = item[1] - self.unix_ts_start
-        if d['buildtime_seconds'] is None:
-            del(d['buildtime_seconds'])
-        else:
-            d['buildtime_seconds'] = self.buildtime_seconds - self.unix_ts_start
-        if len(d['path']) == 0: del(d['path'])
-        if d['failure_reason_local'] is None: del(d['failure_reason_local'])
-        if d['failure_reason_remote'] is None: del(d['failure_reason_remote'])
-        if d['build_timeout'] is None: del(d['build_timeout'])
-        if d['build_quantile'] is None: del(d['build_quantile'])
+        d = {'circuit_id': self.circuit_id, 'unix_ts_start': self.unix_ts_start, 'unix_ts_end': self.unix_ts_end}
+        if self.failure_reason_local is not None: d['failure_reason_local'] = self.failure_reason_local
+        if self.failure_reason_remote is not None: d['failure_reason_remote'] = self.failure_reason_remote
+        if self.buildtime_seconds is not None: d['buildtime_seconds'] = self.buildtime_seconds - self.unix_ts_start
+        if self.build_timeout is not None: d['build_timeout'] = self.build_timeout
+        if self.build_quantile is not None: d['build_quantile'] = self.build_quantile
+        d['elapsed_seconds'] = [[key, arrived_at - self.unix_ts_start] for (key, arrived_at) in zip(self.event_keys, self.event_times)]
+        if len(self.path_hops) > 0:
+            d['path'] = [[hop, arrived_at - self.unix_ts_start] for (hop, arrived_at) in zip(self.path_hops, self.path_times)]
         return d
 
     def __str__(self):
-        return('circuit id=%d %s' % (self.id, ' '.join(['%s=%s' %
-               (event, arrived_at) for (event, arrived_at) in
-               sorted(self.elapsed_seconds, key=lambda item: item[1])])))
+        return('circuit id=%d %s' % (self.circuit_id, ' '.join(['%s=%s' %
+               (event, arrived_at) for (event, arrived_at) in zip(self.event_keys, self.event_times)])))
+
+class TorCtlEvent(object):
+    '''
+    A lightweight decoder for CIRC, CIRC_MINOR, and STREAM events that only
+    extracts the attributes read by TorCtlParser, using the same attribute
+    names and values as the corresponding stem event classes. Of the circuit
+    path, only the last hop is decoded.
+    '''
+
+    # event type -> (positional attribute names, keyword -> attribute name)
+    ATTRIBUTES = {
+        'CIRC': (('id', 'status', 'path'),
+                 {'PURPOSE': 'purpose', 'HS_STATE': 'hs_state', 'REND_QUERY': 'rend_query',
+                  'REASON': 'reason', 'REMOTE_REASON': 'remote_reason'}),
+        'CIRC_MINOR': (('id', 'event', 'path'),
+                       {'PURPOSE': 'purpose', 'HS_STATE': 'hs_state', 'REND_QUERY': 'rend_query',
+                        'OLD_PURPOSE': 'old_purpose'}),
+        'STREAM': (('id', 'status', 'circ_id', 'target'),
+                   {'PURPOSE': 'purpose', 'REASON': 'reason', 'REMOTE_REASON': 'remote_reason',
+                    'SOURCE_ADDR': 'source_addr'}),
+    }
+
+    def __init__(self, event_type, raw_event_str):
+        positional_names, keyword_names = TorCtlEvent.ATTRIBUTES[event_type]
+        self.type = event_type
+
+        # like stem, reject events that were cut off before the line ending
+        if not raw_event_str.endswith('\r\n'):
+            raise ValueError("{0} event is not terminated by CRLF: {1}".format(event_type, raw_event_str))
+
+        # positional arguments come first, followed by key=value pairs; a
+        # token without a key continues a quoted value that contained spaces,
+        # and so does any token until that quoted value is closed, like stem
+        positional, keywords, keyword, in_quote = [], {}, None, False
+        for token in raw_event_str.split()[1:]:
+            key, sep, value = token.partition('=')
+            if in_quote:
+                keywords[keyword] = "{0} {1}".format(keywords[keyword], token)
+                in_quote = not TorCtlEvent.is_quote_closed(keywords[keyword])
+            elif sep != '' and key.replace('_', '').isalnum():
+                keyword = key
+                keywords[keyword] = value
+                in_quote = value.startswith('"') and not TorCtlEvent.is_quote_closed(value)
+            elif keyword is not None:
+                keywords[keyword] = "{0} {1}".format(keywords[keyword], token)
+            else:
+                positional.append(token)
+
+        for i, name in enumerate(positional_names):
+            setattr(self, name, positional[i] if i < len(positional) else None)
+        for key, name in keyword_names.items():
+            value = keywords.get(key)
+            if value is not None and len(value) > 1 and value[0] == '"' and value[-1] == '"':
+                value = value[1:-1]
+            setattr(self, name, value)
+
+        if self.id is None:
+            raise ValueError("{0} event without an identifier: {1}".format(event_type, raw_event_str))
+
+        if event_type == 'STREAM':
+            # the spec uses a circ_id of zero for unattached streams
+            if self.circ_id == '0':
+                self.circ_id = None
+        else:
+            self.path = (TorCtlEvent.parse_hop(self.path.rsplit(',', 1)[-1]),) if self.path else ()
+
+    @staticmethod
+    def is_quote_closed(value):
+        # a quoted value ends with a quote that is not escaped by a backslash
+        if len(value) < 2 or not value.endswith('"'):
+            return False
+        return (len(value) - 1 - len(value[:-1].rstrip('\\'))) % 2 == 0
+
+    @staticmethod
+    def parse_hop(entry):
+        if '=' in entry:
+            fingerprint, nickname = entry.split('=')
+        elif '~' in entry:
+            fingerprint, nickname = entry.split('~')
+        elif entry[0] == '$':
+            fingerprint, nickname = entry, None
+        else:
+            fingerprint, nickname = None, entry
+        if fingerprint is not None:
+            fingerprint = fingerprint[1:]
+        return (fingerprint, nickname)
+
+    def diff(self, event):
+        '''
+        Returns a list of (attribute, our value, their value) tuples for all
+        decoded attributes that differ from those of the given stem event.
+        '''
+        positional_names, keyword_names = TorCtlEvent.ATTRIBUTES[self.type]
+        differences = []
+        if self.type != event.type:
+            differences.append(('type', self.type, event.type))
+        for name in positional_names + tuple(keyword_names.values()):
+            ours, theirs = getattr(self, name), getattr(event, name, None)
+            if name == 'path':
+                ours, theirs = ours[-1:], tuple(theirs[-1:]) if theirs else ()
+            if ours != theirs:
+                differences.append((name, ours, theirs))
+        return differences
+
+# the number of lines at the start of a TorCtl log after which the header ends at the latest
+TORCTL_HEADER_MAX_LINES = 100
 
 class TorCtlParser(Parser):
 
-    def __init__(self, date_filter=None):
-        ''' date_filter should be given in UTC '''
+    def __init__(self, date_filter=None, verify_with_stem=False, state_ttl_seconds=None, max_state_size=None):
+        '''
+        date_filter should be given in UTC. Circuits and streams that never end,
+        for example because tor was restarted, are evicted from the parser state
+        once their last event is more than state_ttl_seconds old, or once there
+        are more than max_state_size of them, oldest first. Eviction is not
+        applied when parsing a log in parallel chunks.
+        '''
         self.circuits_state = {}
         self.circuits = {}
         self.streams_state = {}
         self.streams = {}
         self.name = None
         self.boot_succeeded = False
+        self.header_done = False
         self.build_timeout_last = None
         self.build_quantile_last = None
         self.date_filter = date_filter
+        if self.date_filter is not None:
+            self.date_start_ts, self.date_end_ts = util.date_to_timestamp_range(self.date_filter)
+        self.num_events_skipped = 0
+        # decode events with both our own decoder and stem, and count differences
+        self.verify_with_stem = verify_with_stem
+        self.num_events_mismatched = 0
+        self.state_ttl_seconds = state_ttl_seconds
+        self.max_state_size = max_state_size
+        self.num_circuits_evicted = 0
+        self.num_streams_evicted = 0
+        self.next_eviction_ts = 0
+        # set when parsing one chunk of a log in parallel to the others, see parse_chunk
+        self.is_chunk = False
+        self.__init_event_handlers()
+
+    def __init_event_handlers(self):
+        # only these event types contribute to the analysis, all others are
+        # dropped by keyword before we pay for decoding them
+        self.event_handlers = {
+            'CIRC': self.__handle_circuit,
+            'CIRC_MINOR': self.__handle_circuit,
+            'STREAM': self.__handle_stream,
+            'BUILDTIMEOUT_SET': self.__handle_buildtimeout,
+        }
+        # lines read as bytes are matched against the encoded event types
+        self.event_types_by_bytes = {event_type.encode(): event_type for event_type in self.event_handlers}
+
+    def __getstate__(self):
+        # bound methods cannot be pickled, so set up the event handlers again when unpickling
+        state = self.__dict__.copy()
+        del(state['event_handlers'])
+        del(state['event_types_by_bytes'])
+        return state
+
+    def __setstate__(self, state):
+        # checkpoints written before headers could end without tor bootstrapping
+        state.setdefault('header_done', state.get('boot_succeeded', False))
+        self.__dict__.update(state)
+        self.__init_event_handlers()
 
     def __handle_circuit(self, event, arrival_dt):
         # first make sure we have a circuit object
         cid = int(event.id)
-        circ = self.circuits_state.setdefault(cid, TorCircuit(cid))
+        circ = self.circuits_state.get(cid)
+        if circ is None:
+            circ = self.circuits_state[cid] = TorCircuit(cid)
+            if self.is_chunk and cid not in self.chunk_circuit_ids:
+                # the circuit may have been opened before this chunk
+                self.chunk_circuit_ids.add(cid)
+                self.circuit_fragment_ids.add(cid)
         is_hs_circ = True if event.purpose in (CircPurpose.HS_CLIENT_INTRO, CircPurpose.HS_CLIENT_REND, \
                                    CircPurpose.HS_SERVICE_INTRO, CircPurpose.HS_SERVICE_REND) else False
 
         # now figure out what status we want to track
         key = None
-        if isinstance(event, CircuitEvent):
+        if event.type == 'CIRC':
             if event.status == CircStatus.LAUNCHED:
                 circ.set_launched(arrival_dt, self.build_timeout_last, self.build_quantile_last)
+                if self.is_chunk:
+                    # the build timeout may have been set before this chunk
+                    if self.build_timeout_inherited:
+                        self.circuit_inherit_ids.add(cid)
+                    else:
+                        self.circuit_inherit_ids.discard(cid)
 
-            key = "{0}:{1}".format(event.purpose, event.status)
+            key = get_event_key(event.purpose, event.status)
             circ.add_event(key, arrival_dt)
 
             if event.status == CircStatus.EXTENDED:
@@ -323,14 +926,22 @@ class TorCtlParser(Parser):
                 circ.set_end_time(arrival_dt)
                 started, built, ended = circ.unix_ts_start, circ.buildtime_seconds, circ.unix_ts_end
 
-                data = circ.get_data()
-                if data is not None:
-                    self.circuits[cid] = data
                 self.circuits_state.pop(cid)
+                if self.is_chunk:
+                    is_fragment, inherits_timeout = cid in self.circuit_fragment_ids, cid in self.circuit_inherit_ids
+                    self.circuit_fragment_ids.discard(cid)
+                    self.circuit_inherit_ids.discard(cid)
+                    # hand on the unfinished circuit if it depends on earlier chunks
+                    data = circ if is_fragment or inherits_timeout else circ.get_data()
+                    self.circuits_closed.append((cid, data, is_fragment, inherits_timeout))
+                else:
+                    data = circ.get_data()
+                    if data is not None:
+                        self.circuits[cid] = data
 
-        elif isinstance(event, CircMinorEvent):
+        elif event.type == 'CIRC_MINOR':
             if event.purpose != event.old_purpose or event.event != CircEvent.PURPOSE_CHANGED:
-                key = "{0}:{1}".format(event.event, event.purpose)
+                key = get_event_key(event.event, event.purpose)
                 circ.add_event(key, arrival_dt)
 
             if is_hs_circ:
@@ -341,7 +952,13 @@ class TorCtlParser(Parser):
 
     def __handle_stream(self, event, arrival_dt):
         sid = int(event.id)
-        strm = self.streams_state.setdefault(sid, TorStream(sid))
+        strm = self.streams_state.get(sid)
+        if strm is None:
+            strm = self.streams_state[sid] = TorStream(sid)
+            if self.is_chunk and sid not in self.chunk_stream_ids:
+                # the stream may have been opened before this chunk
+                self.chunk_stream_ids.add(sid)
+                self.stream_fragment_ids.add(sid)
 
         if event.circ_id is not None:
             strm.set_circ_id(event.circ_id)
@@ -362,31 +979,84 @@ class TorCtlParser(Parser):
             stream_type = strm.last_purpose
             started, ended = strm.unix_ts_start, strm.unix_ts_end
 
-            data = strm.get_data()
-            if data is not None:
-                self.streams[sid] = data
             self.streams_state.pop(sid)
+            if self.is_chunk:
+                is_fragment = sid in self.stream_fragment_ids
+                self.stream_fragment_ids.discard(sid)
+                # hand on the unfinished stream if it depends on earlier chunks
+                self.streams_closed.append((sid, strm if is_fragment else strm.get_data(), is_fragment))
+            else:
+                data = strm.get_data()
+                if data is not None:
+                    self.streams[sid] = data
 
     def __handle_buildtimeout(self, event, arrival_dt):
         self.build_timeout_last = event.timeout
         self.build_quantile_last = event.quantile
+        self.build_timeout_inherited = False
+
+    def __evict_state(self, unix_ts):
+        if self.max_state_size is not None:
+            # state is kept in the order in which circuits and streams were first seen
+            while len(self.circuits_state) > self.max_state_size:
+                self.circuits_state.pop(next(iter(self.circuits_state)))
+                self.num_circuits_evicted += 1
+            while len(self.streams_state) > self.max_state_size:
+                self.streams_state.pop(next(iter(self.streams_state)))
+                self.num_streams_evicted += 1
+        if self.state_ttl_seconds is not None and unix_ts >= self.next_eviction_ts:
+            # look for stale circuits and streams at most once per minute of log time
+            self.next_eviction_ts = unix_ts + 60
+            expired_ts = unix_ts - self.state_ttl_seconds
+            for cid in [cid for (cid, circ) in self.circuits_state.items() if len(circ.event_times) == 0 or circ.event_times[-1] < expired_ts]:
+                del(self.circuits_state[cid])
+                self.num_circuits_evicted += 1
+            for sid in [sid for (sid, strm) in self.streams_state.items() if len(strm.event_times) == 0 or strm.event_times[-1] < expired_ts]:
+                del(self.streams_state[sid])
+                self.num_streams_evicted += 1
+
+    def __decode_with_stem(self, raw_event_str):
+        event = ControlMessage.from_str("650 {0}".format(raw_event_str))
+        convert('EVENT', event)
+        return event
 
-    def __handle_event(self, event, arrival_dt):
-        if isinstance(event, (CircuitEvent, CircMinorEvent)):
-            self.__handle_circuit(event, arrival_dt)
-        elif isinstance(event, StreamEvent):
-            self.__handle_stream(event, arrival_dt)
-        elif isinstance(event, BuildTimeoutSetEvent):
-            self.__handle_buildtimeout(event, arrival_dt)
+    def __decode_event(self, event_type, raw_event_str):
+        if event_type not in TorCtlEvent.ATTRIBUTES:
+            return self.__decode_with_stem(raw_event_str)
+        if not self.verify_with_stem:
+            return TorCtlEvent(event_type, raw_event_str)
 
-    def __is_date_valid(self, date_to_check):
+        # in verification mode, the stem event is the one we hand on
+        try:
+            event = TorCtlEvent(event_type, raw_event_str)
+        except Exception as e:
+            event = e
+        try:
+            stem_event = self.__decode_with_stem(raw_event_str)
+        except Exception as e:
+            if not isinstance(event, Exception):
+                self.num_events_mismatched += 1
+                logging.warning("stem failed to decode an event that we decoded ({0}): {1}".format(repr(e), raw_event_str.strip()))
+            raise
+        if isinstance(event, Exception):
+            self.num_events_mismatched += 1
+            logging.warning("failed to decode an event that stem decoded ({0}): {1}".format(repr(event), raw_event_str.strip()))
+        else:
+            differences = event.diff(stem_event)
+            if len(differences) > 0:
+                self.num_events_mismatched += 1
+                for (name, ours, theirs) in differences:
+                    logging.warning("decoded {0}={1} but stem decoded {0}={2}: {3}".format(name, ours, theirs, raw_event_str.strip()))
+        return stem_event
+
+    def __is_date_valid(self, unix_ts):
         if self.date_filter is None:
             # we are not asked to filter, so every date is valid
             return True
         else:
-            # we are asked to filter, so the line is only valid if the date matches the filter
+            # we are asked to filter, so the line is only valid if it falls into the filter date
             # both the filter and the unix timestamp should be in UTC at this point
-            return util.do_dates_match(self.date_filter, date_to_check)
+            return self.date_start_ts <= unix_ts < self.date_end_ts
 
     def __parse_line(self, line):
         if not self.boot_succeeded:
@@ -400,40 +1070,436 @@ class TorCtlParser(Parser):
             elif re.search("BOOTSTRAP", line) is not None and re.search("PROGRESS=100", line) is not None:
                 self.boot_succeeded = True
 
-        # parse with stem
         timestamps, sep, raw_event_str = line.partition(" 650 ")
         if sep == '':
             return True
 
+        # skip events we don't handle without decoding them
+        event_type = raw_event_str.split(None, 1)[0] if raw_event_str else None
+        return self.__parse_event_line(timestamps, event_type, raw_event_str)
+
+    def __parse_event_line(self, timestamps, event_type, raw_event_str):
+        # raw_event_str may still be bytes, in which case it is decoded once we know we need the event
+        handler = self.event_handlers.get(event_type)
+        if handler is None:
+            self.num_events_skipped += 1
+            return True
+
         # event.arrived_at is also available but at worse granularity
         unix_ts = float(timestamps.strip().split()[2])
 
-        # check if we should ignore the line
-        line_date = datetime.datetime.utcfromtimestamp(unix_ts).date()
-        if not self.__is_date_valid(line_date):
+        # check if we should ignore the line, or if we are done with a time-ordered log
+        if not self.__is_date_valid(unix_ts):
+            return unix_ts < self.date_end_ts
+
+        if isinstance(raw_event_str, bytes):
+            raw_event_str = raw_event_str.decode('utf-8')
+        event = self.__decode_event(event_type, raw_event_str)
+        handler(event, unix_ts)
+        if self.state_ttl_seconds is not None or self.max_state_size is not None:
+            self.__evict_state(unix_ts)
+
+        return True
+
+    def parse_event_line(self, timestamps, event_type, raw_event_str):
+        '''
+        Parses a Tor control event of one of the handled types that another
+        parser found in a log line, like DailyTorCtlParser, given the part of the
+        line before " 650 " and the rest of the line after it, either as bytes
+        or as strings. Parsing errors are not caught.
+        '''
+        return self.__parse_event_line(timestamps, event_type, raw_event_str)
+
+    def parse_message(self, line):
+        '''
+        Parses a line as logged by TorMonitor, for lines that are not Tor control
+        events like the version and bootstrap status lines at the start of a log.
+        '''
+        try:
+            return self.__parse_line(line)
+        except:
             return True
 
-        event = ControlMessage.from_str("{0} {1}".format(sep.strip(), raw_event_str))
-        convert('EVENT', event)
-        self.__handle_event(event, unix_ts)
+    def end_header(self, line, num_lines):
+        '''
+        Returns whether the header at the start of a log ended with the given
+        line, which is the line at 1-based position num_lines. Tor only logs that
+        it bootstrapped when TorMonitor starts, which rotated logs do not
+        contain, so the header also ends with the first Tor control event or
+        after TORCTL_HEADER_MAX_LINES lines.
+        '''
+        if not self.header_done and (self.boot_succeeded or ' 650 ' in line or num_lines >= TORCTL_HEADER_MAX_LINES):
+            self.header_done = True
+        return self.header_done
+
+    def parse_event(self, event, unix_ts):
+        '''
+        Handles a Tor control event that was already decoded by stem, in the same
+        way as the line logged for it at unix_ts would have been parsed.
+        '''
+        handler = self.event_handlers.get(event.type)
+        if handler is None:
+            self.num_events_skipped += 1
+            return True
+        if not self.__is_date_valid(unix_ts):
+            return unix_ts < self.date_end_ts
+        handler(event, unix_ts)
+        if self.state_ttl_seconds is not None or self.max_state_size is not None:
+            self.__evict_state(unix_ts)
+        return True
 
+    def prune(self, unix_ts):
+        '''
+        Drops the results of circuits and streams that ended before unix_ts, to
+        bound the memory used by a parser that is fed events for a long time.
+        '''
+        for results in [self.circuits, self.streams]:
+            # results are added in the order in which circuits and streams end
+            while len(results) > 0:
+                oldest_id = next(iter(results))
+                if results[oldest_id]['unix_ts_end'] >= unix_ts:
+                    break
+                del(results[oldest_id])
+
+    def __find_byte_ranges(self, filename):
+        # parse the header lines one by one, so that we learn the host name
+        with open(filename, 'rt', newline='\r\n') as f:
+            num_lines = 0
+            while not self.header_done:
+                line = f.readline()
+                if line == '':
+                    break
+                num_lines += 1
+                try:
+                    if not self.__parse_line(line):
+                        return []
+                except:
+                    pass
+                self.end_header(line, num_lines)
+            header_end = f.tell()
+
+        if self.date_filter is None:
+            return [(header_end, os.path.getsize(filename))]
+
+        # then skip ahead to the lines of the date we are asked to filter
+        start = util.find_timestamp_offset(filename, self.date_start_ts, newline='\r\n')
+        end = util.find_timestamp_offset(filename, self.date_end_ts, newline='\r\n')
+        return [(max(header_end, start), end)]
+
+    def __parse_source(self, source):
+        # returns False if we stopped early because lines passed the filter date
+        source.open(newline='\r\n', binary=True)
+        reader = source.get_file_handle()
+        try:
+            # parse the header lines one by one
+            num_lines = 0
+            for line in reader:
+                num_lines += 1
+                # ignore line parsing errors
+                try:
+                    line = line.decode('utf-8')
+                    if not self.__parse_line(line):
+                        return False
+                except:
+                    continue
+                if self.end_header(line, num_lines):
+                    break
+            # then only look at the lines of events that we handle, and only
+            # decode those
+            block = reader.read_block()
+            while block:
+                if not self.__parse_block(block):
+                    return False
+                block = reader.read_block()
+        finally:
+            source.close()
         return True
 
-    def parse(self, source):
-        source.open(newline='\r\n')
-        for line in source:
+    def __parse_block(self, block):
+        num_event_lines, event_lines = util.find_keyword_lines(block, b" 650 ", list(self.event_types_by_bytes), newline=b'\r\n')
+        for (num_handled, (index, line_start, separator_start, line_end, event_type)) in enumerate(event_lines):
             # ignore line parsing errors
             try:
-                if self.__parse_line(line):
-                    continue
-                else:
-                    break
+                if not self.__parse_event_line(block[line_start:separator_start], self.event_types_by_bytes[event_type],
+                                               block[separator_start + 5:line_end]):
+                    self.num_events_skipped += index - num_handled
+                    return False
             except:
                 continue
-        source.close()
+        self.num_events_skipped += num_event_lines - len(event_lines)
+        return True
+
+    def parse_chunk(self, filename, byte_range):
+        '''
+        Parses the given byte range of a log after the header in isolation and
+        returns the results as a dict, with circuits and streams that may have
+        started in an earlier range left unfinished for merging.
+        '''
+        self.is_chunk = True
+        self.boot_succeeded = True
+        self.header_done = True
+        self.build_timeout_inherited = True
+        self.chunk_circuit_ids, self.circuit_fragment_ids, self.circuit_inherit_ids = set(), set(), set()
+        self.chunk_stream_ids, self.stream_fragment_ids = set(), set()
+        self.circuits_closed, self.streams_closed = [], []
+        is_complete = self.__parse_source(util.DataSource(filename, byte_ranges=[byte_range]))
+        return {'is_complete': is_complete,
+                'circuits_closed': self.circuits_closed, 'circuits_state': self.circuits_state,
+                'circuit_fragment_ids': self.circuit_fragment_ids, 'circuit_inherit_ids': self.circuit_inherit_ids,
+                'streams_closed': self.streams_closed, 'streams_state': self.streams_state,
+                'stream_fragment_ids': self.stream_fragment_ids,
+                'build_timeout_inherited': self.build_timeout_inherited,
+                'build_timeout_last': self.build_timeout_last, 'build_quantile_last': self.build_quantile_last,
+                'num_events_skipped': self.num_events_skipped, 'num_events_mismatched': self.num_events_mismatched}
+
+    def __resume_circuit(self, cid, circ, is_fragment, inherits_timeout, build_timeout, build_quantile):
+        if is_fragment and cid in self.circuits_state:
+            circ = self.circuits_state.pop(cid).merge(circ)
+        if inherits_timeout:
+            circ.build_timeout, circ.build_quantile = build_timeout, build_quantile
+        return circ
+
+    def __resume_stream(self, sid, strm, is_fragment):
+        if is_fragment and sid in self.streams_state:
+            strm = self.streams_state.pop(sid).merge(strm)
+        return strm
+
+    def __merge_chunk(self, chunk):
+        # replay the chunk results in log order, continuing circuits and streams
+        # that were still open at the end of the previous chunk
+        build_timeout, build_quantile = self.build_timeout_last, self.build_quantile_last
+        for (cid, data, is_fragment, inherits_timeout) in chunk['circuits_closed']:
+            if isinstance(data, TorCircuit):
+                data = self.__resume_circuit(cid, data, is_fragment, inherits_timeout, build_timeout, build_quantile).get_data()
+            if data is not None:
+                self.circuits[cid] = data
+        for (cid, circ) in chunk['circuits_state'].items():
+            self.circuits_state[cid] = self.__resume_circuit(cid, circ, cid in chunk['circuit_fragment_ids'],
+                                                             cid in chunk['circuit_inherit_ids'], build_timeout, build_quantile)
+        for (sid, data, is_fragment) in chunk['streams_closed']:
+            if isinstance(data, TorStream):
+                data = self.__resume_stream(sid, data, is_fragment).get_data()
+            if data is not None:
+                self.streams[sid] = data
+        for (sid, strm) in chunk['streams_state'].items():
+            self.streams_state[sid] = self.__resume_stream(sid, strm, sid in chunk['stream_fragment_ids'])
+        if not chunk['build_timeout_inherited']:
+            self.build_timeout_last, self.build_quantile_last = chunk['build_timeout_last'], chunk['build_quantile_last']
+        self.num_events_skipped += chunk['num_events_skipped']
+        self.num_events_mismatched += chunk['num_events_mismatched']
+        return chunk['is_complete']
+
+    def __parse_chunks(self, filename, byte_ranges, num_processes):
+        chunks = []
+        for (start, end) in byte_ranges:
+            chunks.extend(util.split_byte_range(filename, start, end, num_processes, newline='\r\n'))
+        with Pool(num_processes) as pool:
+            for chunk in pool.imap(partial(parse_torctl_chunk, filename, self.date_filter, self.verify_with_stem), chunks):
+                if not self.__merge_chunk(chunk):
+                    break
+
+    def parse(self, source, num_processes=1):
+        num_events_skipped_before = self.num_events_skipped
+        num_events_mismatched_before = self.num_events_mismatched
+        byte_ranges = source.byte_ranges
+        if byte_ranges is None and self.date_filter is not None and source.has_time_index():
+            # only decompress the blocks of an indexed archive that contain the date
+            source.set_time_range(self.date_start_ts, self.date_end_ts)
+        if byte_ranges is None and source.is_seekable() and (self.date_filter is not None or num_processes > 1):
+            byte_ranges = self.__find_byte_ranges(source.filename)
+        if num_processes > 1 and byte_ranges is not None and self.header_done and source.is_seekable():
+            # parse chunks of the log in parallel and merge them in order
+            self.__parse_chunks(source.filename, byte_ranges, num_processes)
+        else:
+            source.set_byte_ranges(byte_ranges)
+            self.__parse_source(source)
+        logging.info("skipped {0} Tor control events that are not used in the analysis".format(self.num_events_skipped - num_events_skipped_before))
+        if self.verify_with_stem:
+            logging.info("found {0} Tor control events that were decoded differently by stem".format(self.num_events_mismatched - num_events_mismatched_before))
 
     def get_data(self):
-        return {'circuits': self.circuits, 'streams': self.streams}
+        data = {'circuits': self.circuits, 'streams': self.streams}
+        if self.state_ttl_seconds is not None or self.max_state_size is not None:
+            data['evicted_circuits'] = self.num_circuits_evicted
+            data['evicted_streams'] = self.num_streams_evicted
+        return data
 
     def get_name(self):
         return self.name
+
+class LineListSource(object):
+    # hands on lines that were already read to a parser that expects a DataSource
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def open(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def close(self):
+        pass
+
+class DailyTGenParser(Parser):
+    '''
+    Parses TGen logs once and hands on each line to the TGenParser of its UTC
+    date, and lines that initialize TGen to all of them, so that each of them
+    ends up with the same results as parsing the logs with that date as
+    date_filter.
+    '''
+
+    INIT_PATTERN = re.compile(r"Initializing\sTGen\sv")
+
+    def __init__(self, dates):
+        self.parsers = [TGenParser(date_filter=date) for date in dates]
+        self.parsers_by_start_ts = {util.date_to_timestamp_range(date)[0]: parser for (date, parser) in zip(dates, self.parsers)}
+        self.start_ts = min(self.parsers_by_start_ts)
+        self.end_ts = max(self.parsers_by_start_ts) + 86400
+
+    def parse(self, source, do_complete=False):
+        # hand on consecutive lines of the same date together
+        lines, lines_parser = [], None
+        source.open()
+        try:
+            for line in source:
+                if DailyTGenParser.INIT_PATTERN.search(line) is not None:
+                    parser = None
+                else:
+                    parts = line.strip().split(' ', 3)
+                    if len(parts) < 4:
+                        continue
+                    parser = self.parsers_by_start_ts.get(int(float(parts[2]) // 86400) * 86400)
+                    if parser is None:
+                        continue
+                if parser is not lines_parser:
+                    if len(lines) > 0:
+                        lines_parser.parse(LineListSource(lines), do_complete=do_complete)
+                    lines, lines_parser = [], parser
+                if parser is None:
+                    for date_parser in self.parsers:
+                        date_parser.parse(LineListSource([line]), do_complete=do_complete)
+                else:
+                    lines.append(line)
+            if len(lines) > 0:
+                lines_parser.parse(LineListSource(lines), do_complete=do_complete)
+        finally:
+            source.close()
+
+    def get_data(self):
+        return {util.date_to_string(parser.date_filter): parser.get_data() for parser in self.parsers}
+
+    def get_name(self):
+        return self.parsers[0].get_name()
+
+class DailyTorCtlParser(Parser):
+    '''
+    Parses Tor control logs once and hands on each event to the TorCtlParser
+    of its UTC date, so that each of them ends up with the same results as
+    parsing the logs with that date as date_filter. Like the latter, it
+    assumes that logs are ordered by time, and stops reading a log once its
+    events pass the last date.
+    '''
+
+    def __init__(self, dates, verify_with_stem=False, state_ttl_seconds=None, max_state_size=None):
+        self.parsers = [TorCtlParser(date_filter=date, verify_with_stem=verify_with_stem,
+                                     state_ttl_seconds=state_ttl_seconds, max_state_size=max_state_size) for date in dates]
+        self.parsers_by_start_ts = {parser.date_start_ts: parser for parser in self.parsers}
+        self.start_ts = min(parser.date_start_ts for parser in self.parsers)
+        self.end_ts = max(parser.date_end_ts for parser in self.parsers)
+        self.event_types_by_bytes = self.parsers[0].event_types_by_bytes
+        self.num_events_skipped = 0
+
+    def __parse_header_line(self, line, num_lines, active_parsers):
+        # header lines go to all parsers that still read the log, and returns
+        # whether the header ended for all of those
+        for (start_ts, parser) in list(active_parsers.items()):
+            if not parser.parse_message(line):
+                del(active_parsers[start_ts])
+            else:
+                parser.end_header(line, num_lines)
+        return all(parser.header_done for parser in active_parsers.values())
+
+    def __parse_block(self, block, active_parsers):
+        # returns False once all parsers stopped reading the log
+        num_event_lines, event_lines = util.find_keyword_lines(block, b" 650 ", list(self.event_types_by_bytes), newline=b'\r\n')
+        self.num_events_skipped += num_event_lines - len(event_lines)
+        next_end_ts = min(active_parsers) + 86400
+        for (index, line_start, separator_start, line_end, event_type) in event_lines:
+            timestamps = block[line_start:separator_start]
+            # ignore line parsing errors
+            try:
+                unix_ts = float(timestamps.split()[2])
+            except:
+                continue
+            if unix_ts >= next_end_ts:
+                # parsers of earlier dates would stop reading the log at this event
+                for start_ts in [start_ts for start_ts in active_parsers if start_ts + 86400 <= unix_ts]:
+                    del(active_parsers[start_ts])
+                if len(active_parsers) == 0:
+                    return False
+                next_end_ts = min(active_parsers) + 86400
+            parser = active_parsers.get(unix_ts // 86400 * 86400)
+            if parser is not None:
+                try:
+                    parser.parse_event_line(timestamps, self.event_types_by_bytes[event_type], block[separator_start + 5:line_end])
+                except:
+                    continue
+        return True
+
+    def parse(self, source):
+        num_events_skipped_before = self.num_events_skipped
+        active_parsers = dict(self.parsers_by_start_ts)
+        is_header_done = all(parser.header_done for parser in self.parsers)
+        if source.byte_ranges is None and source.has_time_index():
+            # only decompress the blocks of an indexed archive that contain the dates
+            source.set_time_range(self.start_ts, self.end_ts)
+        if source.byte_ranges is None and source.is_seekable():
+            # parse the header lines, then skip ahead to the first date
+            with open(source.filename, 'rt', newline='\r\n') as f:
+                num_lines = 0
+                while not is_header_done and len(active_parsers) > 0:
+                    line = f.readline()
+                    if line == '':
+                        break
+                    num_lines += 1
+                    is_header_done = self.__parse_header_line(line, num_lines, active_parsers)
+                header_end = f.tell()
+            start = util.find_timestamp_offset(source.filename, self.start_ts, newline='\r\n')
+            end = util.find_timestamp_offset(source.filename, self.end_ts, newline='\r\n')
+            source.set_byte_ranges([(max(header_end, start), end)])
+        source.open(newline='\r\n', binary=True)
+        reader = source.get_file_handle()
+        try:
+            if not is_header_done:
+                num_lines = 0
+                for line in reader:
+                    if len(active_parsers) == 0:
+                        break
+                    num_lines += 1
+                    # ignore line parsing errors
+                    try:
+                        line = line.decode('utf-8')
+                    except:
+                        continue
+                    if self.__parse_header_line(line, num_lines, active_parsers):
+                        break
+            block = reader.read_block()
+            while block and len(active_parsers) > 0:
+                if not self.__parse_block(block, active_parsers):
+                    break
+                block = reader.read_block()
+        finally:
+            source.close()
+        logging.info("skipped {0} Tor control events that are not used in the analysis".format(self.num_events_skipped - num_events_skipped_before))
+
+    def get_data(self):
+        return {util.date_to_string(parser.date_filter): parser.get_data() for parser in self.parsers}
+
+    def get_name(self):
+        return self.parsers[0].get_name()
+
+def parse_torctl_chunk(filename, date_filter, verify_with_stem, byte_range):
+    parser = TorCtlParser(date_filter=date_filter, verify_with_stem=verify_with_stem)
+    return parser.parse_chunk(filename, byte_range)
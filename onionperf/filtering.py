@@ -5,63 +5,206 @@
   See LICENSE for licensing information
 '''
 
+from onionperf.analysis import OPAnalysis, parse_long_name
+from functools import partial
+from multiprocessing import Pool, cpu_count
+import calendar
+import datetime
+import json
+import logging
+import os
 import re
-from onionperf.analysis import OPAnalysis
+import sys
+import time
+import traceback
 
 class Filtering(object):
 
     def __init__(self):
         self.fingerprints_to_include = None
         self.fingerprints_to_exclude = None
-        self.fingerprint_pattern = re.compile("\$?([0-9a-fA-F]{40})")
+        self.nicknames_to_include = None
+        self.nicknames_to_exclude = None
+        self.time_windows_to_include = None
+        self.time_windows_to_exclude = None
+        self.min_build_time_seconds = None
+        self.max_build_time_seconds = None
+        self.failure_reasons_to_include = None
+        self.failure_reasons_to_exclude = None
+        self.fingerprint_pattern = re.compile(r"\$?([0-9a-fA-F]{40})")
 
-    def include_fingerprints(self, path):
-        self.fingerprints_to_include = []
-        self.fingerprints_to_include_path = path
+    def read_fingerprints(self, path):
+        fingerprints = set()
         with open(path, 'rt') as f:
             for line in f:
                 fingerprint_match = self.fingerprint_pattern.match(line)
                 if fingerprint_match:
-                    fingerprint = fingerprint_match.group(1).upper()
-                    self.fingerprints_to_include.append(fingerprint)
+                    fingerprints.add(fingerprint_match.group(1).upper())
+        return fingerprints
 
-    def exclude_fingerprints(self, path):
-        self.fingerprints_to_exclude = []
-        self.fingerprints_to_exclude_path = path
+    def read_nicknames(self, path):
+        # relay nicknames are case-insensitive
+        nicknames = set()
         with open(path, 'rt') as f:
             for line in f:
-                fingerprint_match = self.fingerprint_pattern.match(line)
-                if fingerprint_match:
-                    fingerprint = fingerprint_match.group(1).upper()
-                    self.fingerprints_to_exclude.append(fingerprint)
+                nickname = line.strip()
+                if nickname and not nickname.startswith('#'):
+                    nicknames.add(nickname.lower())
+        return nicknames
+
+    def include_fingerprints(self, path):
+        self.fingerprints_to_include = self.read_fingerprints(path)
+        self.fingerprints_to_include_path = path
+
+    def exclude_fingerprints(self, path):
+        self.fingerprints_to_exclude = self.read_fingerprints(path)
+        self.fingerprints_to_exclude_path = path
+
+    def include_nicknames(self, path):
+        self.nicknames_to_include = self.read_nicknames(path)
+        self.nicknames_to_include_path = path
+
+    def exclude_nicknames(self, path):
+        self.nicknames_to_exclude = self.read_nicknames(path)
+        self.nicknames_to_exclude_path = path
+
+    def include_time_window(self, start, end):
+        '''
+        Keeps only circuits started at or after the start and before the end of
+        this or any other included window, given as UTC datetimes.
+        '''
+        if self.time_windows_to_include is None:
+            self.time_windows_to_include = []
+        self.time_windows_to_include.append((start, end))
+
+    def exclude_time_window(self, start, end):
+        if self.time_windows_to_exclude is None:
+            self.time_windows_to_exclude = []
+        self.time_windows_to_exclude.append((start, end))
+
+    def min_build_time(self, seconds):
+        self.min_build_time_seconds = seconds
+
+    def max_build_time(self, seconds):
+        self.max_build_time_seconds = seconds
+
+    def include_failure_reasons(self, reasons):
+        self.failure_reasons_to_include = set(reason.upper() for reason in reasons)
+
+    def exclude_failure_reasons(self, reasons):
+        self.failure_reasons_to_exclude = set(reason.upper() for reason in reasons)
+
+    def get_tor_circuits_filters(self):
+        # lists the metadata of all configured filters, in a fixed order
+        filters = []
+        if self.fingerprints_to_include is not None:
+            filters.append({"name": "include_fingerprints", "filepath": self.fingerprints_to_include_path})
+        if self.fingerprints_to_exclude is not None:
+            filters.append({"name": "exclude_fingerprints", "filepath": self.fingerprints_to_exclude_path})
+        if self.nicknames_to_include is not None:
+            filters.append({"name": "include_nicknames", "filepath": self.nicknames_to_include_path})
+        if self.nicknames_to_exclude is not None:
+            filters.append({"name": "exclude_nicknames", "filepath": self.nicknames_to_exclude_path})
+        for (name, windows) in [("include_time_window", self.time_windows_to_include),
+                                ("exclude_time_window", self.time_windows_to_exclude)]:
+            for (start, end) in windows or []:
+                filters.append({"name": name, "start": start.strftime("%Y-%m-%d %H:%M:%S"),
+                                "end": end.strftime("%Y-%m-%d %H:%M:%S")})
+        if self.min_build_time_seconds is not None:
+            filters.append({"name": "min_build_time", "seconds": self.min_build_time_seconds})
+        if self.max_build_time_seconds is not None:
+            filters.append({"name": "max_build_time", "seconds": self.max_build_time_seconds})
+        if self.failure_reasons_to_include is not None:
+            filters.append({"name": "include_failure_reasons", "reasons": sorted(self.failure_reasons_to_include)})
+        if self.failure_reasons_to_exclude is not None:
+            filters.append({"name": "exclude_failure_reasons", "reasons": sorted(self.failure_reasons_to_exclude)})
+        return filters
+
+    def get_hop_rule(self):
+        # returns a function that tells whether a relay given by fingerprint and nickname may be on a kept circuit,
+        # or None if no rule looks at circuit paths
+        fingerprints_to_include, fingerprints_to_exclude = self.fingerprints_to_include, self.fingerprints_to_exclude
+        nicknames_to_include, nicknames_to_exclude = self.nicknames_to_include, self.nicknames_to_exclude
+        if fingerprints_to_include is None and fingerprints_to_exclude is None and \
+                nicknames_to_include is None and nicknames_to_exclude is None:
+            return None
+        def keep_hop(fingerprint, nickname):
+            if fingerprints_to_include is not None and fingerprint not in fingerprints_to_include:
+                return False
+            if fingerprints_to_exclude is not None and fingerprint in fingerprints_to_exclude:
+                return False
+            # relays without nickname are neither included nor excluded by nickname
+            if nicknames_to_include is not None and nickname is not None and nickname not in nicknames_to_include:
+                return False
+            if nicknames_to_exclude is not None and nickname is not None and nickname in nicknames_to_exclude:
+                return False
+            return True
+        return keep_hop
+
+    def get_circuit_rules(self):
+        # returns functions that each tell whether a circuit is kept, without looking at its path
+        rules = []
+        if self.time_windows_to_include is not None:
+            windows = [(calendar.timegm(start.timetuple()), calendar.timegm(end.timetuple()))
+                       for (start, end) in self.time_windows_to_include]
+            rules.append(lambda circuit: "unix_ts_start" in circuit and
+                         any(start <= circuit["unix_ts_start"] < end for (start, end) in windows))
+        if self.time_windows_to_exclude is not None:
+            excluded_windows = [(calendar.timegm(start.timetuple()), calendar.timegm(end.timetuple()))
+                                for (start, end) in self.time_windows_to_exclude]
+            rules.append(lambda circuit: "unix_ts_start" in circuit and
+                         not any(start <= circuit["unix_ts_start"] < end for (start, end) in excluded_windows))
+        min_seconds, max_seconds = self.min_build_time_seconds, self.max_build_time_seconds
+        if min_seconds is not None:
+            rules.append(lambda circuit: "buildtime_seconds" in circuit and circuit["buildtime_seconds"] >= min_seconds)
+        if max_seconds is not None:
+            rules.append(lambda circuit: "buildtime_seconds" in circuit and circuit["buildtime_seconds"] <= max_seconds)
+        reasons_to_include, reasons_to_exclude = self.failure_reasons_to_include, self.failure_reasons_to_exclude
+        if reasons_to_include is not None:
+            rules.append(lambda circuit: circuit.get("failure_reason_local") in reasons_to_include or
+                         circuit.get("failure_reason_remote") in reasons_to_include)
+        if reasons_to_exclude is not None:
+            rules.append(lambda circuit: circuit.get("failure_reason_local") not in reasons_to_exclude and
+                         circuit.get("failure_reason_remote") not in reasons_to_exclude)
+        return rules
 
     def filter_tor_circuits(self, analysis):
-        if self.fingerprints_to_include is None and self.fingerprints_to_exclude is None:
+        keep_hop = self.get_hop_rule()
+        circuit_rules = self.get_circuit_rules()
+        if keep_hop is None and len(circuit_rules) == 0:
             return
         filters = analysis.json_db.setdefault("filters", {})
         tor_circuits_filters = filters.setdefault("tor/circuits", [])
-        if self.fingerprints_to_include:
-           tor_circuits_filters.append({"name": "include_fingerprints", "filepath": self.fingerprints_to_include_path })
-        if self.fingerprints_to_exclude:
-           tor_circuits_filters.append({"name": "exclude_fingerprints", "filepath": self.fingerprints_to_exclude_path })
+        tor_circuits_filters.extend(self.get_tor_circuits_filters())
+        # relays show up on many circuits, so each long name is only parsed and looked up once
+        kept_long_names = {}
         for source in analysis.get_nodes():
             tor_circuits = analysis.get_tor_circuits(source)
-            filtered_circuit_ids = []
             for circuit_id, tor_circuit in tor_circuits.items():
-                keep = False
-                if "path" in tor_circuit:
-                    path = tor_circuit["path"]
-                    keep = True
-                    for long_name, _ in path:
-                        fingerprint_match = self.fingerprint_pattern.match(long_name)
-                        if fingerprint_match:
-                            fingerprint = fingerprint_match.group(1).upper()
-                            if self.fingerprints_to_include is not None and fingerprint not in self.fingerprints_to_include:
-                                keep = False
-                                break
-                            if self.fingerprints_to_exclude is not None and fingerprint in self.fingerprints_to_exclude:
+                keep = True
+                if keep_hop is not None:
+                    if "path" not in tor_circuit:
+                        keep = False
+                    else:
+                        for long_name, _ in tor_circuit["path"]:
+                            keep_long_name = kept_long_names.get(long_name)
+                            if keep_long_name is None:
+                                relay = parse_long_name(long_name)
+                                if relay is not None:
+                                    (fingerprint, nickname) = relay
+                                    keep_long_name = keep_hop(fingerprint, nickname.lower() if nickname is not None else None)
+                                else:
+                                    # hops without a fingerprint are not filtered
+                                    keep_long_name = True
+                                kept_long_names[long_name] = keep_long_name
+                            if not keep_long_name:
                                 keep = False
                                 break
+                if keep:
+                    for rule in circuit_rules:
+                        if not rule(tor_circuit):
+                            keep = False
+                            break
                 if not keep:
                     tor_circuits[circuit_id]["filtered_out"] = True
                     tor_circuits[circuit_id] = dict(sorted(tor_circuit.items()))
@@ -73,3 +216,94 @@ class Filtering(object):
         analysis.json_db = dict(sorted(analysis.json_db.items()))
         analysis.save(filename=output_file, output_prefix=output_dir, sort_keys=False)
 
+    def save_filters_overlay(self, input_path, output_dir, output_file):
+        '''
+        Writes a filters overlay file that only lists the filter metadata and
+        the IDs of filtered out Tor circuits, which OPAnalysis.load applies to
+        the unchanged analysis results file. Only Tor circuits are read from
+        the analysis results file.
+        '''
+        analysis = OPAnalysis.load(filename=input_path, sections=['tor/circuits'])
+        self.filter_tor_circuits(analysis)
+        filtered_out = {}
+        for source in analysis.get_nodes():
+            tor_circuits = analysis.get_tor_circuits(source) or {}
+            filtered_out[source] = sorted((circuit_id for circuit_id, tor_circuit in tor_circuits.items()
+                                           if tor_circuit.get("filtered_out")), key=str)
+        overlay = {"type": "onionperf-filters", "version": "1.0", "analysis": os.path.basename(input_path),
+                   "filters": analysis.json_db.get("filters", {}), "filtered_out": {"tor/circuits": filtered_out}}
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, output_file)
+        logging.info("saving filters overlay to {0}".format(output_path))
+        with open(output_path, 'wt') as f:
+            json.dump(overlay, f, sort_keys=True)
+
+
+# the filters used by the worker processes of a pool, set once per process instead of being passed with each file
+worker_filtering = None
+
+
+def init_worker(filtering):
+    global worker_filtering
+    worker_filtering = filtering
+
+
+def filter_func(overlay, job):
+    # runs in a worker process and returns errors instead of raising them, so that other files go on
+    (input_path, output_dir, output_file) = job
+    start = time.time()
+    try:
+        if overlay:
+            worker_filtering.save_filters_overlay(input_path=input_path, output_dir=output_dir, output_file=output_file)
+        else:
+            worker_filtering.apply_filters(input_path=input_path, output_dir=output_dir, output_file=output_file)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+        logging.error("filtering of {0} failed: {1}".format(input_path, error))
+    return (input_path, error, time.time() - start)
+
+
+def multiprocess_filters(filtering, jobs, num_processes=None, overlay=False):
+    '''
+    Applies the filters of filtering to each (input_path, output_dir,
+    output_file) job in a pool of num_processes processes, or one per CPU core
+    if that is None, starting with the largest input files, and writes either
+    filtered analysis results files or, if overlay is True, filters overlay
+    files. Progress is logged after each file, and a file that cannot be
+    filtered does not stop the others. Returns the number of files that failed.
+    '''
+    sizes = {job[0]: os.path.getsize(job[0]) for job in jobs}
+    jobs = sorted(jobs, key=lambda job: sizes[job[0]], reverse=True)
+    total_size = sum(sizes.values())
+    done_size, num_done, failed = 0, 0, []
+    start = time.time()
+    pool = Pool(num_processes or cpu_count(), initializer=init_worker, initargs=(filtering,))
+    try:
+        for (input_path, error, seconds) in pool.imap_unordered(partial(filter_func, overlay), jobs):
+            if error is not None:
+                failed.append(input_path)
+                continue
+            num_done += 1
+            done_size += sizes[input_path]
+            elapsed = time.time() - start
+            eta = elapsed / done_size * (total_size - done_size) if done_size > 0 else 0.0
+            logging.info("Filtered {0} of {1} analysis results files ({2:.1f}% of input bytes), about {3} left".format(
+                num_done, len(jobs), 100.0 * done_size / total_size if total_size > 0 else 100.0,
+                datetime.timedelta(seconds=round(eta))))
+        pool.close()
+        pool.join()
+        if len(failed) > 0:
+            logging.error("Filtering of {0} of {1} analysis results files failed: {2}".format(
+                len(failed), len(jobs), ', '.join(sorted(failed))))
+        return len(failed)
+    except KeyboardInterrupt:
+        logging.info("interrupted, terminating process pool")
+        pool.terminate()
+        pool.join()
+        sys.exit()
+    except Exception:
+        # do not leave worker processes running after raising
+        pool.terminate()
+        pool.join()
+        raise
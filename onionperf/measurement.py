@@ -138,8 +138,10 @@ def watchdog_thread_task(cmd, cwd, writable, done_ev, send_stdin, ready_search_s
     # too many failures, or master asked us to stop, close the writable before exiting thread
     writable.close()
 
-def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, nickname, done_ev):
+def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, nickname, done_ev, partial_interval_seconds=0, compression_threads=1):
     next_midnight = None
+    next_partial = None
+    anal = None
 
     while not done_ev.wait(1):
         # get time
@@ -152,6 +154,10 @@ def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, ni
             if (next_midnight - utcnow).total_seconds() < 0:
                 next_midnight -= datetime.timedelta(1)  # subtract 1 day
 
+        # setup the next time to publish a partial analysis of the current day, if enabled
+        if next_partial is None and partial_interval_seconds > 0:
+            next_partial = utcnow + datetime.timedelta(seconds=partial_interval_seconds)
+
         # if we are past midnight, launch the rotate task
         if (next_midnight - utcnow).total_seconds() < 0:
             # handle the general writables we are watching
@@ -161,34 +167,77 @@ def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, ni
             # handle tgen and tor writables specially, and do analysis
             if tgen_writable is not None or torctl_writable is not None:
                 try:
+                    if anal is None:
+                        anal = start_incremental_analysis(tgen_writable, torctl_writable, nickname)
 
-                    # get our public ip address, do this every night in case it changes
-                    public_measurement_ip_guess = util.get_ip_address()
-
-                    # set up the analysis object with our log files
-                    anal = analysis.OPAnalysis(nickname=nickname, ip_address=public_measurement_ip_guess)
+                    # continue parsing the rotated log files where the partial analysis stopped
                     if tgen_writable is not None:
-                        anal.add_tgen_file(tgen_writable.rotate_file(filename_datetime=next_midnight))
-                    if torctl_writable is not None:
-                        anal.add_torctl_file(torctl_writable.rotate_file(filename_datetime=next_midnight))
+                        anal.move_file(tgen_writable.filename, tgen_writable.rotate_file(filename_datetime=next_midnight))
+                    if isinstance(torctl_writable, monitor.LiveAnalysisWritable):
+                        # the Tor control events of the rotated log file have already been parsed
+                        torctl_writable.rotate_file(filename_datetime=next_midnight)
+                        anal.add_torctl_parser(torctl_writable.rotated_parser)
+                    elif torctl_writable is not None:
+                        anal.move_file(torctl_writable.filename, torctl_writable.rotate_file(filename_datetime=next_midnight))
 
-                    # run the analysis, i.e. parse the files
-                    anal.analyze()
+                    # run the analysis, i.e. parse the rest of the files
+                    anal.analyze_incrementally(is_final=True)
 
                     # save the results in onionperf json format in the www docroot
-                    anal.save(output_prefix=docroot, do_compress=True, date_prefix=next_midnight.date())
+                    anal.save(output_prefix=docroot, do_compress=True, date_prefix=next_midnight.date(), compression_threads=compression_threads)
+
+                    # the partial analysis of the day is superseded by the complete one
+                    partial_filepath = os.path.join(docroot, get_partial_analysis_filename(next_midnight))
+                    if os.path.exists(partial_filepath):
+                        os.remove(partial_filepath)
 
                     # update the xml index in docroot
                     generate_docroot_index(docroot)
                 except Exception as e:
                     logging.warning("Caught and ignored exception in TorPerf log parser: {0}".format(repr(e)))
                     logging.warning("Formatted traceback: {0}".format(traceback.format_exc()))
-            # reset our timer
+            # reset our timer and start a new analysis for the next day
             next_midnight = None
+            next_partial = None
+            anal = None
+
+        # if it is time, parse the lines that were logged since the last partial analysis
+        elif next_partial is not None and (next_partial - utcnow).total_seconds() < 0:
+            if tgen_writable is not None or torctl_writable is not None:
+                try:
+                    if anal is None:
+                        anal = start_incremental_analysis(tgen_writable, torctl_writable, nickname)
+                    if isinstance(torctl_writable, monitor.LiveAnalysisWritable):
+                        anal.add_torctl_parser(torctl_writable.get_parser())
+                    anal.analyze_incrementally()
+                    anal.save(filename=get_partial_analysis_filename(next_midnight), output_prefix=docroot, do_compress=True,
+                              compression_threads=compression_threads)
+                    generate_docroot_index(docroot)
+                except Exception as e:
+                    logging.warning("Caught and ignored exception in TorPerf partial log parser: {0}".format(repr(e)))
+                    logging.warning("Formatted traceback: {0}".format(traceback.format_exc()))
+                    # start over from the beginning of the log files next time
+                    anal = None
+            next_partial = None
+
+def start_incremental_analysis(tgen_writable, torctl_writable, nickname):
+    # get our public ip address, do this every day in case it changes
+    public_measurement_ip_guess = util.get_ip_address()
+
+    # set up the analysis object with our log files
+    anal = analysis.OPAnalysis(nickname=nickname, ip_address=public_measurement_ip_guess)
+    if tgen_writable is not None:
+        anal.add_tgen_file(tgen_writable.filename)
+    if torctl_writable is not None and not isinstance(torctl_writable, monitor.LiveAnalysisWritable):
+        anal.add_torctl_file(torctl_writable.filename)
+    return anal
+
+def get_partial_analysis_filename(date_object):
+    return "{0}.onionperf.analysis.partial.json.xz".format(util.date_to_string(date_object))
 
 class Measurement(object):
 
-    def __init__(self, tor_bin_path, tgen_bin_path, datadir_path, privatedir_path, nickname, additional_client_conf=None, torclient_conf_file=None, torserver_conf_file=None, single_onion=False, drop_guards_interval_hours=0):
+    def __init__(self, tor_bin_path, tgen_bin_path, datadir_path, privatedir_path, nickname, additional_client_conf=None, torclient_conf_file=None, torserver_conf_file=None, single_onion=False, drop_guards_interval_hours=0, live_analysis=False, log_compression='gz', compression_threads=1, log_block_size=None, partial_analysis_interval_minutes=0):
         self.tor_bin_path = tor_bin_path
         self.tgen_bin_path = tgen_bin_path
         self.datadir_path = datadir_path
@@ -204,6 +253,11 @@ class Measurement(object):
         self.torserver_conf_file = torserver_conf_file
         self.single_onion = single_onion
         self.drop_guards_interval_hours = drop_guards_interval_hours
+        self.live_analysis = live_analysis
+        self.log_compression = log_compression
+        self.compression_threads = compression_threads
+        self.log_block_size = log_block_size
+        self.partial_analysis_interval_minutes = partial_analysis_interval_minutes
 
     def run(self, do_onion=True, do_inet=True, tgen_model=None, tgen_client_conf=None, tgen_server_conf=None):
         '''
@@ -336,7 +390,9 @@ class Measurement(object):
     def __start_log_processors(self, general_writables, tgen_writable, torctl_writable):
         # rotate the log files, and then parse out the measurement data
         logrotate_args = (general_writables, tgen_writable, torctl_writable, self.www_docroot, self.nickname, self.done_event)
-        logrotate = threading.Thread(target=logrotate_thread_task, name="logrotate", args=logrotate_args)
+        logrotate = threading.Thread(target=logrotate_thread_task, name="logrotate", args=logrotate_args,
+                                     kwargs={'partial_interval_seconds': 60 * self.partial_analysis_interval_minutes,
+                                             'compression_threads': self.compression_threads})
         logrotate.start()
         self.threads.append(logrotate)
 
@@ -362,7 +418,8 @@ class Measurement(object):
             tgen_model.dump_to_file(tgen_confpath)
 
         tgen_logpath = "{0}/onionperf.tgen.log".format(tgen_datadir)
-        tgen_writable = util.FileWritable(tgen_logpath)
+        tgen_writable = util.FileWritable(tgen_logpath, rotate_codec=self.log_compression, threads=self.compression_threads,
+                                          rotate_block_size=self.log_block_size)
         logging.info("Logging TGen {1} process output to {0}".format(tgen_logpath, name))
 
         tgen_cmd = "{0} {1}".format(self.tgen_bin_path, tgen_confpath)
@@ -458,7 +515,8 @@ WarnUnsafeSocks 0\nSafeLogging 0\nMaxCircuitDirtiness 60 seconds\nDataDirectory
             f.write(tor_config)
 
         tor_logpath = "{0}/onionperf.tor.log".format(tor_datadir)
-        tor_writable = util.FileWritable(tor_logpath)
+        tor_writable = util.FileWritable(tor_logpath, rotate_codec=self.log_compression, threads=self.compression_threads,
+                                         rotate_block_size=self.log_block_size)
         logging.info("Logging Tor {0} process output to {1}".format(name, tor_logpath))
 
         # from stem.process import launch_tor_with_config
@@ -476,7 +534,11 @@ WarnUnsafeSocks 0\nSafeLogging 0\nMaxCircuitDirtiness 60 seconds\nDataDirectory
         tor_ready_ev.wait()
 
         torctl_logpath = "{0}/onionperf.torctl.log".format(tor_datadir)
-        torctl_writable = util.FileWritable(torctl_logpath)
+        torctl_writable = util.FileWritable(torctl_logpath, rotate_codec=self.log_compression, threads=self.compression_threads,
+                                            rotate_block_size=self.log_block_size)
+        if self.live_analysis and name == "client":
+            # analyze the client's Tor control events while logging them
+            torctl_writable = monitor.LiveAnalysisWritable(torctl_writable)
         logging.info("Logging Tor {0} control port monitor output to {1}".format(name, torctl_logpath))
 
         # give a few seconds to make sure Tor had time to start listening on the control port
@@ -16,9 +16,14 @@ from functools import partial
 import shutil
 import pathlib
 
+from threading import Lock
+
 # stem imports
 from stem.control import EventType, Controller, Signal
 
+# onionperf imports
+from . import analysis, util
+
 def get_supported_torctl_events():
     return list(EventType)
 
@@ -76,7 +81,7 @@ class TorMonitor(object):
                         if not drop_timeouts_response.is_ok():
                             self.__log(self.writable, "[WARNING] unrecognized command DROPTIMEOUTS in tor\n")
 
-                        self.__log(self.writable, "Dropping guards %s" % os.getcwd())
+                        self.__log(self.writable, "Dropping guards %s\n" % os.getcwd())
                         pathlib.Path("tor-client/onionperf_state_history/").mkdir(parents=True, exist_ok=True)
                         shutil.copy("tor-client/state", "tor-client/onionperf_state_history/state_%s" % time.strftime("%Y%m%d-%H%M%S"))
 
@@ -92,14 +97,76 @@ class TorMonitor(object):
         self.writable.close()
 
     def __handle_tor_event(self, writable, event):
-        self.__log(writable, event.raw_content())
+        self.__log(writable, event.raw_content(), event)
 
-    def __log(self, writable, msg):
+    def __log(self, writable, msg, event=None):
         now = datetime.datetime.now()
         utcnow = datetime.datetime.utcnow()
         epoch = datetime.datetime(1970, 1, 1)
-        unix_ts = (utcnow - epoch).total_seconds()
-        writable.write("{0} {1:.02f} {2}".format(now.strftime("%Y-%m-%d %H:%M:%S"), unix_ts, msg))
+        unix_ts = "{0:.02f}".format((utcnow - epoch).total_seconds())
+        line = "{0} {1} {2}".format(now.strftime("%Y-%m-%d %H:%M:%S"), unix_ts, msg)
+        if event is not None and isinstance(writable, LiveAnalysisWritable):
+            # hand on the decoded event with the timestamp as it is logged
+            writable.write_event(line, event, float(unix_ts))
+        else:
+            writable.write(line)
+
+class LiveAnalysisWritable(util.Writable):
+    '''
+    Writes the lines logged by TorMonitor to another writable, and also passes
+    them together with the decoded Tor control events to a TorCtlParser, so
+    that the analysis of a log file is ready as soon as the file is rotated.
+    Only the results of circuits and streams that ended within the last
+    retention_seconds are kept in memory.
+    '''
+
+    def __init__(self, writable, retention_seconds=90000):
+        self.writable = writable
+        self.filename = writable.filename
+        self.retention_seconds = retention_seconds
+        self.parser = analysis.TorCtlParser()
+        self.rotated_parser = None
+        self.next_prune_ts = 0
+        self.lock = Lock()
+
+    def write(self, msg):
+        with self.lock:
+            self.writable.write(msg)
+            self.parser.parse_message(msg)
+
+    def write_event(self, msg, event, unix_ts):
+        with self.lock:
+            self.writable.write(msg)
+            try:
+                self.parser.parse_event(event, unix_ts)
+            except:
+                # ignore event handling errors, like errors parsing a logged line
+                pass
+            if unix_ts >= self.next_prune_ts:
+                self.parser.prune(unix_ts - self.retention_seconds)
+                self.next_prune_ts = unix_ts + 60
+
+    def get_parser(self):
+        '''
+        Returns a new TorCtlParser with a copy of the results parsed so far.
+        '''
+        with self.lock:
+            parser = analysis.TorCtlParser()
+            parser.name = self.parser.name
+            parser.circuits = dict(self.parser.circuits)
+            parser.streams = dict(self.parser.streams)
+        return parser
+
+    def close(self):
+        with self.lock:
+            self.writable.close()
+
+    def rotate_file(self, filename_datetime=datetime.datetime.now()):
+        # start a new parser for the new file, just like parsing the files separately
+        with self.lock:
+            new_filename = self.writable.rotate_file(filename_datetime=filename_datetime)
+            self.rotated_parser, self.parser = self.parser, analysis.TorCtlParser()
+        return new_filename
 
 def tor_monitor_run(tor_ctl_port, writable, events, newnym_interval_seconds, drop_guards_interval_hours, done_ev):
     torctl_monitor = TorMonitor(tor_ctl_port, writable, events)
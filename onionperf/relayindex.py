@@ -0,0 +1,184 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  Copyright 2015-2020 The Tor Project
+  See LICENSE for licensing information
+'''
+
+from onionperf.analysis import OPAnalysis, FILTERS_EXTENSION, parse_long_name
+from onionperf import reprocessing
+from multiprocessing import Pool, cpu_count
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import traceback
+
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hops (
+    fingerprint TEXT NOT NULL,
+    date TEXT,
+    node TEXT NOT NULL,
+    circuit_id TEXT NOT NULL,
+    hop INTEGER NOT NULL,
+    nickname TEXT,
+    unix_ts_start REAL,
+    buildtime_seconds REAL,
+    failure_reason_local TEXT,
+    failure_reason_remote TEXT,
+    file_id INTEGER NOT NULL REFERENCES files(file_id)
+);
+CREATE INDEX IF NOT EXISTS hops_fingerprint_date ON hops (fingerprint, date);
+CREATE INDEX IF NOT EXISTS hops_file_id ON hops (file_id);
+'''
+
+def get_hop_rows(filepath):
+    '''
+    Returns one row per hop of each Tor circuit with a known path in the
+    analysis results file at filepath, with the circuit's date, node, ID, build
+    time, and failure reasons next to the relay fingerprint and its hop in the
+    path, counted from 0 like in columnar analysis results. Only Tor circuits
+    are read from the file.
+    '''
+    analysis = OPAnalysis.load(filename=filepath, sections=['tor/circuits'])
+    if analysis is None:
+        raise ValueError("unable to load analysis results from {0}".format(filepath))
+    rows = []
+    for node in analysis.get_nodes():
+        for circuit_id, tor_circuit in (analysis.get_tor_circuits(node) or {}).items():
+            if "path" not in tor_circuit:
+                continue
+            unix_ts_start = tor_circuit.get("unix_ts_start")
+            date = datetime.datetime.utcfromtimestamp(unix_ts_start).strftime("%Y-%m-%d") if unix_ts_start is not None else None
+            for hop, (long_name, _) in enumerate(tor_circuit["path"]):
+                relay = parse_long_name(long_name)
+                if relay is None:
+                    continue
+                (fingerprint, nickname) = relay
+                rows.append((fingerprint, date, node, str(circuit_id), hop,
+                             nickname, unix_ts_start, tor_circuit.get("buildtime_seconds"),
+                             tor_circuit.get("failure_reason_local"), tor_circuit.get("failure_reason_remote")))
+    return rows
+
+
+def get_hop_rows_func(filepath):
+    # runs in a worker process and returns errors instead of raising them, so that other files go on
+    try:
+        return (filepath, get_hop_rows(filepath), None)
+    except Exception:
+        error = traceback.format_exc()
+        logging.error("indexing of {0} failed: {1}".format(filepath, error))
+        return (filepath, None, error)
+
+
+class RelayIndex(object):
+    '''
+    A persistent inverted index from relay fingerprints to the Tor circuits
+    they were part of in a directory of analysis results files, stored in an
+    SQLite database, so that relay-centric queries do not need to load any
+    analysis results files.
+    '''
+
+    QUERY_COLUMNS = ['date', 'node', 'circuit_id', 'hop', 'nickname', 'unix_ts_start', 'buildtime_seconds',
+                     'failure_reason_local', 'failure_reason_remote']
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(INDEX_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, dirpath, num_processes=None):
+        '''
+        Adds the analysis results files found in dirpath that are new or were
+        changed since the last update, and removes the ones that are gone.
+        Returns the number of files that could not be indexed.
+        '''
+        filepaths = [os.path.abspath(filepath) for filepath in reprocessing.collect_logs(dirpath, '*onionperf.analysis.json*')
+                     if not filepath.endswith(FILTERS_EXTENSION)]
+        indexed = {path: (file_id, size, mtime_ns) for (file_id, path, size, mtime_ns)
+                   in self.connection.execute("SELECT file_id, path, size, mtime_ns FROM files")}
+        pending, stats = [], {}
+        for filepath in filepaths:
+            stat = os.stat(filepath)
+            stats[filepath] = (stat.st_size, stat.st_mtime_ns)
+            if filepath not in indexed or indexed[filepath][1:] != stats[filepath]:
+                pending.append(filepath)
+        removed = [path for path in indexed if path.startswith(os.path.abspath(dirpath) + os.sep) and path not in stats]
+        with self.connection:
+            for path in removed:
+                self.remove_file(indexed[path][0])
+        logging.info("Indexing {0} new or changed analysis results files, skipping {1} unchanged ones, and removing {2} missing ones".format(
+            len(pending), len(filepaths) - len(pending), len(removed)))
+        if len(pending) == 0:
+            return 0
+
+        num_failed, num_done = 0, 0
+        pool = Pool(num_processes or cpu_count())
+        try:
+            for (filepath, rows, error) in pool.imap_unordered(get_hop_rows_func, pending):
+                if error is not None:
+                    num_failed += 1
+                    continue
+                # each file is replaced in its own transaction, so that an interrupted update can be resumed
+                with self.connection:
+                    if filepath in indexed:
+                        self.remove_file(indexed[filepath][0])
+                    (size, mtime_ns) = stats[filepath]
+                    file_id = self.connection.execute("INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)",
+                                                      (filepath, size, mtime_ns)).lastrowid
+                    self.connection.executemany("INSERT INTO hops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                                [row + (file_id,) for row in rows])
+                num_done += 1
+                logging.info("Indexed {0} of {1} analysis results files".format(num_done, len(pending)))
+            pool.close()
+            pool.join()
+        except KeyboardInterrupt:
+            logging.info("interrupted, terminating process pool")
+            pool.terminate()
+            pool.join()
+            sys.exit()
+        except Exception:
+            # do not leave worker processes running after raising, like when the database is locked
+            pool.terminate()
+            pool.join()
+            raise
+        if num_failed > 0:
+            logging.error("Indexing of {0} of {1} analysis results files failed".format(num_failed, len(pending)))
+        return num_failed
+
+    def remove_file(self, file_id):
+        self.connection.execute("DELETE FROM hops WHERE file_id = ?", (file_id,))
+        self.connection.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+
+    def get_last_date(self):
+        # returns the date of the latest indexed circuit, or None if there is none
+        (date,) = self.connection.execute("SELECT MAX(date) FROM hops").fetchone()
+        return datetime.datetime.strptime(date, "%Y-%m-%d").date() if date else None
+
+    def query(self, fingerprint, start_date=None, end_date=None):
+        '''
+        Returns a list of dicts, one for each time that the relay with the
+        given fingerprint was part of a Tor circuit on a date between
+        start_date and end_date, both inclusive and optional, ordered by start
+        time.
+        '''
+        sql = "SELECT {0} FROM hops WHERE fingerprint = ?".format(", ".join(self.QUERY_COLUMNS))
+        params = [fingerprint.lstrip('$').upper()]
+        if start_date is not None:
+            sql += " AND date >= ?"
+            params.append(start_date.strftime("%Y-%m-%d"))
+        if end_date is not None:
+            sql += " AND date <= ?"
+            params.append(end_date.strftime("%Y-%m-%d"))
+        sql += " ORDER BY unix_ts_start, node, circuit_id, hop"
+        return [dict(zip(self.QUERY_COLUMNS, row)) for row in self.connection.execute(sql, params)]
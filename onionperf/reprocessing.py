@@ -1,38 +1,145 @@
-from onionperf.analysis import OPAnalysis
+from onionperf.analysis import OPAnalysis, get_analysis_filename, get_columnar_filename
 from onionperf import util
 from functools import partial
 from multiprocessing import Pool, cpu_count
 import datetime
+import fcntl
 import fnmatch
+import hashlib
+import importlib.metadata
+import json
 import logging
 import os
 import re
+import socket
 import sys
+import threading
+import time
+import traceback
 
 
 def collect_logs(dirpath, pattern):
     logs = []
     for root, dirnames, filenames in os.walk(dirpath):
         for filename in fnmatch.filter(sorted(filenames), pattern):
-            logs.append(os.path.join(root, filename))
+            # skip the time indexes of log archives
+            if not filename.endswith(util.TIME_INDEX_EXTENSION):
+                logs.append(os.path.join(root, filename))
     return logs
 
 
+LOG_FILENAME_DATE_PATTERN = re.compile(r'(\d+-\d+-\d+)')
+
+
+def get_filename_date(filepath):
+    m = LOG_FILENAME_DATE_PATTERN.search(filepath)
+    if m:
+        try:
+            return datetime.datetime.strptime(m.group(0), "%Y-%m-%d")
+        except ValueError:
+            pass
+    return None
+
+
+def get_log_dates(filepath, time_range=None):
+    '''
+    Returns the UTC dates of the lines in the given log file, taken from the
+    timestamps of its first and last lines, or the date in its file name if it
+    does not contain any timestamps. Compressed files without time index are
+    decompressed completely to find their last line, unless their time_range
+    is given, as returned by util.find_log_time_range.
+    '''
+    filename_date = get_filename_date(filepath)
+    if time_range is None:
+        time_range = util.find_log_time_range(filepath)
+    if not time_range:
+        return [filename_date] if filename_date is not None else []
+    first_date, last_date = [datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0, tzinfo=None) for ts in time_range]
+    return [first_date + datetime.timedelta(days=i) for i in range((last_date - first_date).days + 1)]
+
+
+def index_logs_by_date(logs, manifest=None):
+    '''
+    Returns a dict with dates as keys and lists of the given log files that
+    contain lines of that date as values, ordered by the date of their first
+    line, which is the order in which they need to be parsed. The time ranges
+    of log files are read in a pool of processes, because compressed log files
+    without time index need to be decompressed completely, and are cached in
+    the given manifest, so that unchanged log files are not read again.
+    '''
+    time_ranges = manifest.get_time_ranges(logs) if manifest is not None else {}
+    unread_logs = [log for log in logs if log not in time_ranges]
+    # log files that grow while they are read must not be cached with their new size
+    unread_stats = [get_file_stats(log) for log in unread_logs]
+    if len(unread_logs) > 1:
+        pool = Pool(cpu_count())
+        try:
+            unread_time_ranges = pool.map(util.find_log_time_range, unread_logs, chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        unread_time_ranges = [util.find_log_time_range(log) for log in unread_logs]
+    # an empty time range marks log files without any timestamps, so that they are not read again either
+    time_ranges.update((log, time_range or ()) for (log, time_range) in zip(unread_logs, unread_time_ranges))
+    if manifest is not None:
+        for (log, stats) in zip(unread_logs, unread_stats):
+            manifest.add_time_range(log, stats, time_ranges[log])
+    logs_by_date = {}
+    for (log_dates, log) in sorted((get_log_dates(log, time_ranges[log]), log) for log in logs):
+        if not log_dates:
+            logging.warning('Skipping file {0}, could not find a date in its file name or contents'.format(log))
+        for log_date in log_dates:
+            logs_by_date.setdefault(log_date, []).append(log)
+    return logs_by_date
+
+
+def plan_jobs(tgen_logs, tor_logs, date_filter, manifest=None):
+    '''
+    Returns one analysis job per date with both TGen and TorCtl log lines, as a
+    (tgen_logs, tor_logs, date) tuple with the lists of log files that contain
+    lines of that date, optionally only for the date of date_filter. The time
+    ranges of log files are cached in the given manifest, if any.
+    '''
+    tgen_logs_by_date = index_logs_by_date(tgen_logs, manifest)
+    tor_logs_by_date = index_logs_by_date(tor_logs, manifest)
+    if manifest is not None:
+        manifest.save()
+    jobs = []
+    for date in sorted(tgen_logs_by_date):
+        if date_filter is not None and not util.do_dates_match(date_filter, date):
+            continue
+        if date in tor_logs_by_date:
+            jobs.append((tgen_logs_by_date[date], tor_logs_by_date[date], date))
+        else:
+            logging.warning(
+                'Skipping date {0}, could not find a TorCtl log file for it'.
+                format(util.date_to_string(date)))
+    if not jobs:
+        logging.warning(
+            'Could not find any log matches. No analyses will be performed')
+    return jobs
+
+
 def match(tgen_logs, tor_logs, date_filter):
+    # pairs log files by the date in their file names, unlike plan_jobs
+    tor_logs_by_date = {}
+    for tor_log in tor_logs:
+        m = LOG_FILENAME_DATE_PATTERN.search(tor_log)
+        if m:
+            tor_logs_by_date.setdefault(m.group(0), tor_log)
     log_pairs = []
     for tgen_log in tgen_logs:
-        m = re.search(r'(\d+-\d+-\d+)', tgen_log)
+        m = LOG_FILENAME_DATE_PATTERN.search(tgen_log)
         if m:
             date = m.group(0)
             fdate = datetime.datetime.strptime(date, "%Y-%m-%d")
-            found = False
             if date_filter is None or util.do_dates_match(date_filter, fdate):
-                for tor_log in tor_logs:
-                    if date in tor_log:
-                        log_pairs.append((tgen_log, tor_log, fdate))
-                        found = True
-                        break
-                if not found:
+                if date in tor_logs_by_date:
+                    log_pairs.append((tgen_log, tor_logs_by_date[date], fdate))
+                else:
                     logging.warning(
                         'Skipping file {0}, could not find a match for it'.
                         format(tgen_log))
@@ -46,25 +153,443 @@ def match(tgen_logs, tor_logs, date_filter):
     return log_pairs
 
 
-def analyze_func(prefix, nick, pair):
+def get_job_logs(logs):
+    # jobs contain lists of log files, whereas log pairs contain single log files
+    return [logs] if isinstance(logs, str) else list(logs)
+
+
+MANIFEST_FILENAME = "onionperf.manifest.json"
+
+SUMMARY_FILENAME = "onionperf.reprocessing.json"
+
+
+def get_onionperf_version():
+    try:
+        return importlib.metadata.version("onionperf")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def get_file_stats(filepath):
+    # files are assumed to be unchanged as long as their size and modification time are
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class AnalysisManifest(object):
+    '''
+    Records which log files, onionperf version, nickname, date, and options
+    produced each analysis results file in an output directory, together with
+    the sizes and modification times of the log files and of the outputs, so
+    that log pairs can be skipped if their analysis results are up to date.
+    It also caches the time ranges of log files, so that compressed log files
+    only need to be read once to plan analysis jobs.
+    '''
+
+    def __init__(self, prefix):
+        self.filepath = os.path.join(prefix, MANIFEST_FILENAME)
+        self.entries, self.time_ranges = self.__read()
+        self.added_entries, self.added_time_ranges = {}, {}
+
+    def __read(self):
+        if os.path.exists(self.filepath):
+            try:
+                with open(self.filepath, 'rt') as f:
+                    manifest = json.load(f)
+                return manifest['entries'], manifest.get('time_ranges', {})
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning("ignoring unreadable manifest at '{0}': {1}".format(self.filepath, e))
+        return {}, {}
+
+    def get_entry(self, pair, nick, options):
+        # the outputs are filled in by add_entry once they were written
+        return {'inputs': {os.path.abspath(path): get_file_stats(path) for path in get_job_logs(pair[0]) + get_job_logs(pair[1])},
+                'version': get_onionperf_version(), 'nickname': nick,
+                'date_filter': util.date_to_string(pair[2]), 'options': options}
+
+    def is_current(self, output_filename, entry):
+        recorded_entry = self.entries.get(output_filename)
+        if recorded_entry is None or {key: value for (key, value) in recorded_entry.items() if key != 'outputs'} != entry:
+            return False
+        prefix = os.path.dirname(self.filepath)
+        for (filename, stats) in recorded_entry['outputs'].items():
+            filepath = os.path.join(prefix, filename)
+            if not os.path.exists(filepath) or get_file_stats(filepath) != stats:
+                return False
+        return True
+
+    def add_entry(self, output_filename, entry, output_filenames):
+        prefix = os.path.dirname(self.filepath)
+        entry = dict(entry, outputs={filename: get_file_stats(os.path.join(prefix, filename)) for filename in output_filenames})
+        self.entries[output_filename] = self.added_entries[output_filename] = entry
+
+    def get_time_ranges(self, filepaths):
+        # returns the cached time ranges of the given log files that did not change since they were read
+        time_ranges = {}
+        for filepath in filepaths:
+            cached = self.time_ranges.get(os.path.abspath(filepath))
+            if cached is not None and cached['stats'] == get_file_stats(filepath):
+                time_ranges[filepath] = tuple(cached['time_range'])
+        return time_ranges
+
+    def add_time_range(self, filepath, stats, time_range):
+        cached = {'stats': stats, 'time_range': list(time_range)}
+        self.time_ranges[os.path.abspath(filepath)] = self.added_time_ranges[os.path.abspath(filepath)] = cached
+
+    def save(self):
+        util.make_dir_path(os.path.dirname(self.filepath))
+        with open("{0}.lock".format(self.filepath), 'a') as lock_file:
+            # keep the entries that other processes added in the meantime, like those sharing a work queue
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            self.entries, self.time_ranges = self.__read()
+            self.entries.update(self.added_entries)
+            self.time_ranges.update(self.added_time_ranges)
+            # write to a temporary file first, so that we never leave a broken manifest behind
+            with open("{0}.tmp".format(self.filepath), 'wt') as f:
+                json.dump({'entries': self.entries, 'time_ranges': self.time_ranges}, f, indent=2, sort_keys=True)
+            os.replace("{0}.tmp".format(self.filepath), self.filepath)
+
+
+def get_worker_id():
+    return "{0}-{1}".format(socket.gethostname(), os.getpid())
+
+
+def get_task_id(pairs):
+    # identifies a group of log pairs by its dates, in the same way on all hosts
+    dates = [util.date_to_string(pair[2]) for pair in pairs]
+    return "{0}.{1}".format(dates[0], hashlib.sha256(" ".join(dates).encode()).hexdigest()[:16])
+
+
+def get_shard(task_id, num_shards):
+    # returns the shard of a task, from 1 to num_shards
+    return int(hashlib.sha256(task_id.encode()).hexdigest(), 16) % num_shards + 1
+
+
+class WorkQueue(object):
+    '''
+    Lets processes on one or more hosts share the analysis of the same log
+    pairs using lock files in a shared directory. A process claims a task by
+    creating its lock file, refreshes the lock file while working on it, and
+    marks the task as done once its analysis results are saved. Lock files
+    that were not refreshed for lock_timeout seconds, for example because a
+    host went down, can be claimed by other processes. A new directory should
+    be used for each reprocessing run.
+    '''
+
+    def __init__(self, dirpath, lock_timeout=600):
+        self.dirpath = os.path.abspath(os.path.expanduser(dirpath))
+        self.lock_timeout = lock_timeout
+        # generations of the tasks claimed by this process
+        self.generations = {}
+        util.make_dir_path(self.dirpath)
+
+    def get_lock_path(self, task_id):
+        return os.path.join(self.dirpath, "{0}.lock".format(task_id))
+
+    def get_done_path(self, task_id):
+        return os.path.join(self.dirpath, "{0}.done".format(task_id))
+
+    def is_done(self, task_id):
+        return os.path.exists(self.get_done_path(task_id))
+
+    def get_takeover_path(self, task_id, generation):
+        return os.path.join(self.dirpath, "{0}.{1}.takeover".format(task_id, generation))
+
+    def read_lock(self, task_id):
+        '''
+        Returns the contents and modification time of the lock file of a task,
+        both taken from the same file even if it is replaced meanwhile, or None
+        if there is no lock file.
+        '''
+        try:
+            with open(self.get_lock_path(task_id), 'rt') as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                try:
+                    lock = json.load(f)
+                except ValueError:
+                    lock = {}
+        except FileNotFoundError:
+            return None
+        return (lock, mtime)
+
+    def write_lock(self, task_id, generation, released=False):
+        # lock files are written under a temporary name first, so that they are never seen without contents
+        tmp_path = "{0}.{1}.tmp".format(self.get_lock_path(task_id), get_worker_id())
+        with open(tmp_path, 'wt') as f:
+            json.dump({'worker': get_worker_id(), 'generation': generation, 'released': released,
+                       'claimed': time.time()}, f)
+        return tmp_path
+
+    def owns(self, task_id):
+        if task_id not in self.generations:
+            return False
+        current = self.read_lock(task_id)
+        return current is not None and current[0].get('worker') == get_worker_id() and \
+            current[0].get('generation') == self.generations[task_id] and not current[0].get('released')
+
+    def claim(self, task_id):
+        '''
+        Returns True if the task was claimed by this process, or False if it is
+        done or claimed by another process.
+
+        Each claim of a task has a generation number that is stored in its lock
+        file. A released or stale lock file of generation N is only replaced by
+        the process that manages to create the takeover marker of generation
+        N + 1, so that a process that looked at an older lock file cannot take
+        over a lock file that was just replaced by another process.
+        '''
+        if self.is_done(task_id):
+            return False
+        lock_path = self.get_lock_path(task_id)
+        current = self.read_lock(task_id)
+        if current is None:
+            generation = 0
+            tmp_path = self.write_lock(task_id, generation)
+            try:
+                os.link(tmp_path, lock_path)
+            except FileExistsError:
+                return False
+            finally:
+                os.remove(tmp_path)
+        else:
+            (lock, mtime) = current
+            if not lock.get('released') and time.time() - mtime <= self.lock_timeout:
+                return False
+            generation = lock.get('generation', 0) + 1
+            try:
+                os.close(os.open(self.get_takeover_path(task_id, generation), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                return False
+            os.replace(self.write_lock(task_id, generation), lock_path)
+        self.generations[task_id] = generation
+        # the task may have been finished right before we created the lock file
+        if self.is_done(task_id):
+            self.release(task_id)
+            return False
+        return True
+
+    def refresh(self, task_id):
+        '''
+        Keeps the lock file of a claimed task fresh, and returns False if it was
+        taken over by another process meanwhile.
+        '''
+        if not self.owns(task_id):
+            return False
+        os.utime(self.get_lock_path(task_id))
+        return True
+
+    def release(self, task_id):
+        # released lock files are kept, so that the next claim continues their generations
+        if self.owns(task_id):
+            os.replace(self.write_lock(task_id, self.generations[task_id], released=True), self.get_lock_path(task_id))
+        self.generations.pop(task_id, None)
+
+    def finish(self, task_id):
+        with open(self.get_done_path(task_id), 'wt') as f:
+            json.dump({'worker': get_worker_id(), 'finished': time.time()}, f)
+        # claims check for the done marker after creating a lock file, so that it can be removed now
+        if self.owns(task_id):
+            os.remove(self.get_lock_path(task_id))
+        self.generations.pop(task_id, None)
+
+
+def analyze_func(prefix, nick, pair, verify_with_stem=False, state_ttl_seconds=None, max_state_size=None, do_columnar=False,
+                 compression_codec='xz', compression_level=None, compression_threads=1):
     analysis = OPAnalysis(nickname=nick)
     logging.info('Analysing pair for date {0}'.format(pair[2]))
-    analysis.add_tgen_file(pair[0])
-    analysis.add_torctl_file(pair[1])
-    analysis.analyze(date_filter=pair[2])
-    analysis.save(output_prefix=prefix)
+    for tgen_log in get_job_logs(pair[0]):
+        analysis.add_tgen_file(tgen_log)
+    for tor_log in get_job_logs(pair[1]):
+        analysis.add_torctl_file(tor_log)
+    analysis.analyze(date_filter=pair[2], verify_with_stem=verify_with_stem,
+                     state_ttl_seconds=state_ttl_seconds, max_state_size=max_state_size)
+    analysis.save(output_prefix=prefix, do_columnar=do_columnar, compression_codec=compression_codec,
+                  compression_level=compression_level, compression_threads=compression_threads)
     return 1
 
 
-def multiprocess_logs(log_pairs, prefix, nick=None):
-    pool = Pool(cpu_count())
-    analyses = None
+def analyze_dates_func(prefix, nick, pairs, verify_with_stem=False, state_ttl_seconds=None, max_state_size=None, do_columnar=False,
+                       compression_codec='xz', compression_level=None, compression_threads=1):
+    # pairs of different dates with the same log files are analyzed in a single pass over those
+    if len(pairs) == 1:
+        return analyze_func(prefix, nick, pairs[0], verify_with_stem=verify_with_stem, state_ttl_seconds=state_ttl_seconds,
+                            max_state_size=max_state_size, do_columnar=do_columnar, compression_codec=compression_codec,
+                            compression_level=compression_level, compression_threads=compression_threads)
+    analysis = OPAnalysis(nickname=nick)
+    logging.info('Analysing pairs for dates {0}'.format(', '.join(util.date_to_string(pair[2]) for pair in pairs)))
+    for tgen_log in get_job_logs(pairs[0][0]):
+        analysis.add_tgen_file(tgen_log)
+    for tor_log in get_job_logs(pairs[0][1]):
+        analysis.add_torctl_file(tor_log)
+    for date_analysis in analysis.analyze_by_date([pair[2] for pair in pairs], verify_with_stem=verify_with_stem,
+                                                  state_ttl_seconds=state_ttl_seconds, max_state_size=max_state_size):
+        date_analysis.save(output_prefix=prefix, do_columnar=do_columnar, compression_codec=compression_codec,
+                           compression_level=compression_level, compression_threads=compression_threads)
+    return len(pairs)
+
+
+def group_pending_pairs(pending_pairs):
+    # groups (pair, output_filename, entry) tuples of pairs with the same log files, keeping their order
+    groups = {}
+    for (pair, output_filename, entry) in pending_pairs:
+        groups.setdefault((tuple(get_job_logs(pair[0])), tuple(get_job_logs(pair[1]))), []).append((pair, output_filename, entry))
+    return list(groups.values())
+
+
+def record_analysis(manifest, outputs, do_columnar):
+    # called in the parent process once log pairs were analyzed
+    for (output_filename, entry) in outputs:
+        output_filenames = [output_filename] + ([get_columnar_filename(output_filename)] if do_columnar else [])
+        manifest.add_entry(output_filename, entry, output_filenames)
+    manifest.save()
+
+
+def run_analysis_task(func, work_queue, task):
+    # runs in a worker process and returns errors instead of raising them, so that other tasks go on
+    (index, task_id, pairs) = task
+    if work_queue is not None and not work_queue.claim(task_id):
+        return (index, 'skipped', None, None)
+    start = time.time()
+    stop_refreshing = threading.Event()
+    if work_queue is not None:
+        # keep the lock file fresh while analyzing, so that other processes do not take over
+        def refresh_lock():
+            while not stop_refreshing.wait(work_queue.lock_timeout / 4.0):
+                if not work_queue.refresh(task_id):
+                    logging.warning("lock of log pairs {0} was taken over by another process".format(task_id))
+                    break
+        refresh_thread = threading.Thread(target=refresh_lock, daemon=True)
+        refresh_thread.start()
     try:
-        func = partial(analyze_func, prefix, nick)
-        mr = pool.map_async(func, log_pairs)
+        func(pairs)
+        status, error = 'analyzed', None
+    except Exception:
+        status, error = 'failed', traceback.format_exc()
+        logging.error("analysis of log pairs for dates {0} failed: {1}".format(
+            ', '.join(util.date_to_string(pair[2]) for pair in pairs), error))
+    finally:
+        stop_refreshing.set()
+    if work_queue is not None:
+        refresh_thread.join()
+        if status == 'analyzed':
+            work_queue.finish(task_id)
+        else:
+            work_queue.release(task_id)
+    return (index, status, error, time.time() - start)
+
+
+def get_input_size(pairs):
+    logs = set()
+    for pair in pairs:
+        logs.update(get_job_logs(pair[0]) + get_job_logs(pair[1]))
+    return sum(os.path.getsize(log) for log in logs if os.path.exists(log))
+
+
+def write_summary(filepath, tasks):
+    # lists timings, input sizes, and failures of all tasks, failed ones first
+    summary = [{'dates': [util.date_to_string(pair[2]) for pair in task['pairs']],
+                'tgen_logs': get_job_logs(task['pairs'][0][0]), 'torctl_logs': get_job_logs(task['pairs'][0][1]),
+                'input_size': task['input_size'], 'status': task['status'], 'attempts': task['attempts'],
+                'seconds': task['seconds'], 'error': task['error']}
+               for task in sorted(tasks, key=lambda task: task['error'] is None)]
+    with open(filepath, 'wt') as f:
+        json.dump(summary, f, indent=2)
+
+
+def multiprocess_logs(log_pairs, prefix, nick=None, verify_with_stem=False, state_ttl_seconds=None, max_state_size=None,
+                      do_columnar=False, compression_codec='xz', compression_level=None, compression_threads=1,
+                      use_manifest=True, num_retries=1, max_tasks_per_process=10, shard=None, work_queue=None):
+    '''
+    Analyzes log pairs in a pool of processes, starting with the largest log
+    files, and analyzes pairs that failed again up to num_retries times. Each
+    process analyzes at most max_tasks_per_process groups of pairs with the
+    same log files before it is replaced, unless that is 0. Progress is logged
+    after each group, and timings and failures of all groups are written to a
+    summary file in prefix at the end. Returns the number of groups that failed.
+
+    Analyses can be spread over several hosts by giving each of them a
+    different (index, count) shard, starting at index 1, and the same log
+    pairs, or by giving all of them the same WorkQueue as work_queue.
+    '''
+    util.make_dir_path(prefix)
+    manifest = AnalysisManifest(prefix) if use_manifest else None
+    options = {'state_ttl_seconds': state_ttl_seconds, 'max_state_size': max_state_size, 'do_columnar': do_columnar,
+               'compression_codec': compression_codec, 'compression_level': compression_level}
+    planned_pairs = []
+    for pair in log_pairs:
+        output_filename = get_analysis_filename(pair[2], compression_codec)
+        planned_pairs.append((pair, output_filename, manifest.get_entry(pair, nick, options) if manifest is not None else None))
+
+    tasks, num_up_to_date = [], 0
+    for group in group_pending_pairs(planned_pairs):
+        # tasks are assigned to shards before looking at the manifest, so that this does not depend on the host
+        task_id = get_task_id([pair for (pair, output_filename, entry) in group])
+        if shard is not None and get_shard(task_id, shard[1]) != shard[0]:
+            continue
+        if manifest is not None:
+            # only analyze log pairs whose analysis results are missing or were produced differently
+            pending_group = [(pair, output_filename, entry) for (pair, output_filename, entry) in group
+                             if not manifest.is_current(output_filename, entry)]
+            num_up_to_date += len(group) - len(pending_group)
+            group = pending_group
+        if len(group) > 0:
+            pairs = [pair for (pair, output_filename, entry) in group]
+            tasks.append({'id': task_id, 'pairs': pairs, 'outputs': [(output_filename, entry) for (pair, output_filename, entry) in group],
+                          'input_size': get_input_size(pairs), 'status': 'pending', 'attempts': 0, 'seconds': None, 'error': None})
+    if manifest is not None:
+        logging.info("Skipping {0} log pairs with up-to-date analysis results in the manifest".format(num_up_to_date))
+    # start with the largest tasks, so that no large task is left running on its own at the end
+    tasks.sort(key=lambda task: task['input_size'], reverse=True)
+    total_size, done_size, num_done = sum(task['input_size'] for task in tasks), 0, 0
+    start = time.time()
+
+    # several processes sharing a work queue each write their own summary
+    summary_filepath = os.path.join(prefix, SUMMARY_FILENAME)
+    if work_queue is not None:
+        summary_filepath = os.path.join(prefix, "{0}.{1}.json".format(os.path.splitext(SUMMARY_FILENAME)[0], get_worker_id()))
+
+    pool = Pool(cpu_count(), maxtasksperchild=max_tasks_per_process or None)
+    try:
+        func = partial(analyze_dates_func, prefix, nick, verify_with_stem=verify_with_stem,
+                       state_ttl_seconds=state_ttl_seconds, max_state_size=max_state_size, do_columnar=do_columnar,
+                       compression_codec=compression_codec, compression_level=compression_level,
+                       compression_threads=compression_threads)
+        pending_indexes = list(range(len(tasks)))
+        for attempt in range(num_retries + 1):
+            if len(pending_indexes) == 0:
+                break
+            if attempt > 0:
+                logging.info("Retrying {0} failed analyses".format(len(pending_indexes)))
+            failed_indexes = []
+            for (index, status, error, seconds) in pool.imap_unordered(partial(run_analysis_task, func, work_queue),
+                                                                       [(index, tasks[index]['id'], tasks[index]['pairs']) for index in pending_indexes]):
+                task = tasks[index]
+                task['status'] = status
+                if status == 'skipped':
+                    # another process analyzed or is analyzing these pairs
+                    total_size -= task['input_size']
+                    continue
+                task['attempts'] += 1
+                task['seconds'], task['error'] = seconds, error
+                if status == 'failed':
+                    failed_indexes.append(index)
+                    continue
+                if manifest is not None:
+                    record_analysis(manifest, task['outputs'], do_columnar)
+                num_done += 1
+                done_size += task['input_size']
+                elapsed = time.time() - start
+                eta = elapsed / done_size * (total_size - done_size) if done_size > 0 else 0.0
+                logging.info("Analyzed {0} of {1} groups of log pairs ({2:.1f}% of input bytes), about {3} left".format(
+                    num_done, len(tasks), 100.0 * done_size / total_size if total_size > 0 else 100.0,
+                    datetime.timedelta(seconds=round(eta))))
+            pending_indexes = failed_indexes
         pool.close()
-        while not mr.ready():
-            mr.wait(1)
+        pool.join()
+        if len(pending_indexes) > 0:
+            logging.error("Analysis of {0} of {1} groups of log pairs failed, see {2} for details".format(
+                len(pending_indexes), len(tasks), summary_filepath))
+        return len(pending_indexes)
     except KeyboardInterrupt:
         logging.info("interrupted, terminating process pool")
         pool.terminate()
@@ -72,3 +597,9 @@ def multiprocess_logs(log_pairs, prefix, nick=None):
         sys.exit()
     except Exception as e:
         logging.error(e)
+        # do not leave worker processes running after returning
+        pool.terminate()
+        pool.join()
+        return len(tasks) - num_done
+    finally:
+        write_summary(summary_filepath, tasks)
@@ -1,8 +1,15 @@
 import os
+import datetime
+import json
+import math
+import lzma
+import shutil
+import tempfile
 import pkg_resources
 from nose.tools import *
 from onionperf import util
 from tgentools import analysis
+from onionperf.analysis import OPAnalysis, TorCtlParser, DailyTorCtlParser, TorCtlEvent, TorCircuit, TorStream, build_columnar_table
 
 
 def absolute_data_path(relative_path=""):
@@ -152,3 +159,299 @@ def test_stream_object_end_to_end():
 def test_parsing_parse_error():
     parser = analysis.TGenParser()
     parser.parse(util.DataSource(DATA_DIR + 'parse_error'))
+
+def test_torctl_parser_skips_unused_events():
+    parser = TorCtlParser()
+    parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    # BW, CIRC_BW, STREAM_BW, ORCONN and HS_DESC events are never decoded
+    assert_equals(parser.num_events_skipped, 516)
+    data = parser.get_data()
+    assert_equals(len(data['circuits']), 7)
+    assert_equals(len(data['streams']), 7)
+
+def test_torctl_event_matches_stem():
+    parser = TorCtlParser(verify_with_stem=True)
+    parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    assert_equals(parser.num_events_mismatched, 0)
+    native_parser = TorCtlParser()
+    native_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    assert_equals(parser.get_data(), native_parser.get_data())
+
+def test_torctl_event_stream():
+    event = TorCtlEvent('STREAM', 'STREAM 16 CLOSED 0 66.206.4.26:9001 REASON=END REMOTE_REASON=DONE SOCKS_USERNAME="a b"\r\n')
+    assert_equals(event.id, '16')
+    assert_equals(event.status, 'CLOSED')
+    assert_equals(event.circ_id, None)
+    assert_equals(event.target, '66.206.4.26:9001')
+    assert_equals(event.reason, 'END')
+    assert_equals(event.remote_reason, 'DONE')
+    assert_equals(event.source_addr, None)
+
+def test_torctl_event_circuit_path():
+    event = TorCtlEvent('CIRC', 'CIRC 22 EXTENDED $CE946DFEC40A1BFC3665A4727F54354F57297497~Forseti,$2ABDCC5A2656CDE1DF601092BCA60C7449F7D956~manningisfree PURPOSE=GENERAL\r\n')
+    assert_equals(event.path, (('2ABDCC5A2656CDE1DF601092BCA60C7449F7D956', 'manningisfree'),))
+    assert_equals(event.purpose, 'GENERAL')
+    assert_equals(event.hs_state, None)
+
+def test_torctl_event_quoted_keyword():
+    # keywords inside quoted values, like client-controlled SOCKS usernames, are part of those values
+    event = TorCtlEvent('CIRC', 'CIRC 22 BUILT $CE946DFEC40A1BFC3665A4727F54354F57297497~Forseti PURPOSE=GENERAL SOCKS_USERNAME="x PURPOSE=BOGUS" SOCKS_PASSWORD="y \\" REASON=BOGUS"\r\n')
+    assert_equals(event.purpose, 'GENERAL')
+    assert_equals(event.reason, None)
+    event = TorCtlEvent('STREAM', 'STREAM 16 CLOSED 0 66.206.4.26:9001 SOCKS_USERNAME="a\\\\" REASON=END\r\n')
+    assert_equals(event.reason, 'END')
+
+@raises(ValueError)
+def test_torctl_event_truncated():
+    TorCtlEvent('CIRC', 'CIRC 22 EXTENDED $CE946DFEC40A1BFC3665A4727F54354F57297497~Forseti')
+
+def test_torctl_parser_date_filter_seek():
+    work_dir = tempfile.mkdtemp()
+    compressed_path = os.path.join(work_dir, 'onionperf.torctl.log.xz')
+    with open(DATA_DIR + 'logs/onionperf.torctl.log', 'rb') as f_in, lzma.open(compressed_path, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    for date_filter in [datetime.date(2019, 1, 30), datetime.date(2019, 1, 31), datetime.date(2019, 2, 11)]:
+        # the uncompressed log is seekable, but the compressed copy is read from the start
+        seek_parser = TorCtlParser(date_filter=date_filter)
+        seek_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+        read_parser = TorCtlParser(date_filter=date_filter)
+        read_parser.parse(util.DataSource(compressed_path))
+        assert_equals(seek_parser.get_data(), read_parser.get_data())
+        assert_equals(seek_parser.get_name(), read_parser.get_name())
+    shutil.rmtree(work_dir)
+
+def test_torctl_parser_date_filter_indexed_archive():
+    work_dir = tempfile.mkdtemp()
+    archive_path = os.path.join(work_dir, 'onionperf.torctl.log.xz')
+    with open(DATA_DIR + 'logs/onionperf.torctl.log', 'rb') as f_in:
+        util.write_indexed_archive(f_in, archive_path, codec='xz', block_size=4096)
+    for date_filter in [datetime.date(2019, 1, 30), datetime.date(2019, 1, 31), datetime.date(2019, 2, 11)]:
+        # only the first block and the blocks of the date are decompressed
+        seek_parser = TorCtlParser(date_filter=date_filter)
+        seek_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+        index_parser = TorCtlParser(date_filter=date_filter)
+        index_parser.parse(util.DataSource(archive_path))
+        assert_equals(seek_parser.get_data(), index_parser.get_data())
+        assert_equals(seek_parser.get_name(), index_parser.get_name())
+    shutil.rmtree(work_dir)
+
+def test_torctl_parser_parallel_chunks():
+    log_path = DATA_DIR + 'logs/onionperf.torctl.log'
+    for date_filter in [None, datetime.date(2019, 1, 31)]:
+        serial_parser = TorCtlParser(date_filter=date_filter)
+        serial_parser.parse(util.DataSource(log_path))
+        # many small chunks make circuits and streams span chunk boundaries
+        parallel_parser = TorCtlParser(date_filter=date_filter)
+        parallel_parser.parse(util.DataSource(log_path), num_processes=16)
+        assert_equals(parallel_parser.get_data(), serial_parser.get_data())
+        assert_equals(parallel_parser.get_name(), serial_parser.get_name())
+        assert_equals(parallel_parser.num_events_skipped, serial_parser.num_events_skipped)
+
+def test_torctl_parser_without_header():
+    # rotated logs do not start with the lines logged when tor bootstrapped
+    work_dir = tempfile.mkdtemp()
+    log_path = os.path.join(work_dir, 'onionperf.torctl.log')
+    with open(DATA_DIR + 'logs/onionperf.torctl.log', 'rb') as f_in, open(log_path, 'wb') as f_out:
+        lines = f_in.read().split(b'\n', 2)
+        assert_true(b'Starting torctl program' in lines[0] and b'PROGRESS=100' in lines[1])
+        f_out.write(lines[2])
+    compressed_path = log_path + '.xz'
+    with open(log_path, 'rb') as f_in, lzma.open(compressed_path, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    for date_filter in [None, datetime.date(2019, 1, 31), datetime.date(2019, 2, 11)]:
+        full_parser = TorCtlParser(date_filter=date_filter)
+        full_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+        read_parser = TorCtlParser(date_filter=date_filter)
+        read_parser.parse(util.DataSource(compressed_path))
+        # the header ends at the first event, so that the log is searched and split into chunks
+        seek_parser = TorCtlParser(date_filter=date_filter)
+        seek_parser.parse(util.DataSource(log_path))
+        assert_equals(seek_parser.header_done, True)
+        parallel_parser = TorCtlParser(date_filter=date_filter)
+        parallel_parser.parse(util.DataSource(log_path), num_processes=4)
+        for parser in [read_parser, seek_parser, parallel_parser]:
+            assert_equals(parser.get_data(), full_parser.get_data())
+    dates = [datetime.date(2019, 1, 31), datetime.date(2019, 2, 1)]
+    daily_parser = DailyTorCtlParser(dates)
+    daily_parser.parse(util.DataSource(log_path))
+    for date in dates:
+        full_parser = TorCtlParser(date_filter=date)
+        full_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+        assert_equals(daily_parser.get_data()[util.date_to_string(date)], full_parser.get_data())
+    shutil.rmtree(work_dir)
+
+def test_torctl_parser_state_eviction():
+    def line(unix_ts, event):
+        return '2019-01-31 11:29:51 {0:.2f} 650 {1}\r\n'.format(unix_ts, event)
+    for kwargs in [{'state_ttl_seconds': 600}, {'max_state_size': 2}]:
+        parser = TorCtlParser(**kwargs)
+        # circuits and streams that never end, one every five minutes
+        for i in range(5):
+            parser.parse_message(line(1548934191 + i * 300, 'CIRC {0} LAUNCHED PURPOSE=GENERAL'.format(i)))
+            parser.parse_message(line(1548934191 + i * 300, 'STREAM {0} NEW 0 1.2.3.4:80 SOURCE_ADDR=127.0.0.1:5000 PURPOSE=USER'.format(i)))
+        parser.parse_message(line(1548934191 + 1500, 'CIRC 4 FAILED PURPOSE=GENERAL REASON=TIMEOUT'))
+        assert_equals(sorted(parser.circuits_state), [3])
+        assert_equals(sorted(parser.streams_state), [3, 4])
+        data = parser.get_data()
+        assert_equals(list(data['circuits']), [4])
+        assert_equals(data['evicted_circuits'], 3)
+        assert_equals(data['evicted_streams'], 3)
+
+def test_torctl_parser_state_eviction_disabled():
+    parser = TorCtlParser()
+    parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    # the log file contains measurements of two dates that are 11 days apart
+    evicting_parser = TorCtlParser(state_ttl_seconds=30 * 86400, max_state_size=1000)
+    evicting_parser.parse(util.DataSource(DATA_DIR + 'logs/onionperf.torctl.log'))
+    data = evicting_parser.get_data()
+    assert_equals(data.pop('evicted_circuits'), 0)
+    assert_equals(data.pop('evicted_streams'), 0)
+    assert_equals(data, parser.get_data())
+
+def test_analysis_incremental_checkpoint():
+    work_dir = tempfile.mkdtemp()
+    tgen_path = os.path.join(work_dir, 'onionperf.tgen.log')
+    torctl_path = os.path.join(work_dir, 'onionperf.torctl.log')
+    checkpoint_path = os.path.join(work_dir, 'onionperf.analysis.checkpoint')
+    complete_analysis = OPAnalysis(nickname='test', ip_address='1.2.3.4')
+    complete_analysis.add_tgen_file(DATA_DIR + 'logs/onionperf.tgen.log')
+    complete_analysis.add_torctl_file(DATA_DIR + 'logs/onionperf.torctl.log')
+    complete_analysis.analyze()
+    with open(DATA_DIR + 'logs/onionperf.tgen.log', 'rb') as f:
+        tgen_log = f.read()
+    with open(DATA_DIR + 'logs/onionperf.torctl.log', 'rb') as f:
+        torctl_log = f.read()
+    open(tgen_path, 'wb').close()
+    open(torctl_path, 'wb').close()
+    analysis = OPAnalysis(nickname='test', ip_address='1.2.3.4')
+    analysis.add_tgen_file(tgen_path)
+    analysis.add_torctl_file(torctl_path)
+    # let the logs grow in pieces that end in the middle of lines and events
+    for fraction in [0.3, 0.6, 1.0]:
+        with open(tgen_path, 'ab') as f:
+            f.write(tgen_log[os.path.getsize(tgen_path):int(len(tgen_log) * fraction)])
+        with open(torctl_path, 'ab') as f:
+            f.write(torctl_log[os.path.getsize(torctl_path):int(len(torctl_log) * fraction)])
+        analysis.analyze_incrementally()
+        analysis.save_checkpoint(checkpoint_path)
+        analysis = OPAnalysis.load_checkpoint(checkpoint_path)
+    analysis.analyze_incrementally(is_final=True)
+    assert_equals(analysis.json_db, complete_analysis.json_db)
+    shutil.rmtree(work_dir)
+
+def test_analysis_by_date():
+    work_dir = tempfile.mkdtemp()
+    gz_path = os.path.join(work_dir, 'onionperf.torctl.log.gz')
+    with open(DATA_DIR + 'logs/onionperf.torctl.log', 'rb') as f_in:
+        with open(gz_path, 'wb') as f_out:
+            f_out.write(util.compress_block(f_in.read(), 'gz'))
+    # the log spans 2019-01-31 to 2019-02-11, and dates may be missing in between
+    dates = [datetime.datetime(2019, 1, 30), datetime.datetime(2019, 1, 31), datetime.datetime(2019, 2, 3), datetime.datetime(2019, 2, 11)]
+    for torctl_path in [DATA_DIR + 'logs/onionperf.torctl.log', gz_path]:
+        analysis = OPAnalysis(nickname="test")
+        analysis.add_tgen_file(DATA_DIR + 'logs/onionperf.tgen.log')
+        analysis.add_torctl_file(torctl_path)
+        date_analyses = analysis.analyze_by_date(dates)
+        assert_equals([date_analysis.date_filter for date_analysis in date_analyses], dates)
+        for (date, date_analysis) in zip(dates, date_analyses):
+            expected_analysis = OPAnalysis(nickname="test")
+            expected_analysis.add_tgen_file(DATA_DIR + 'logs/onionperf.tgen.log')
+            expected_analysis.add_torctl_file(torctl_path)
+            expected_analysis.analyze(date_filter=date)
+            assert_equals(date_analysis.json_db, expected_analysis.json_db)
+    assert_equals(len(date_analyses[1].json_db['data']['test']['tor']['circuits']), 7)
+    shutil.rmtree(work_dir)
+
+def test_analysis_save_compact():
+    work_dir = tempfile.mkdtemp()
+    analysis = OPAnalysis(nickname='test', ip_address='1.2.3.4')
+    analysis.add_tgen_file(DATA_DIR + 'logs/onionperf.tgen.log')
+    analysis.add_torctl_file(DATA_DIR + 'logs/onionperf.torctl.log')
+    analysis.analyze()
+    analysis.save(filename='onionperf.analysis.json.xz', output_prefix=work_dir)
+    analysis.save(filename='onionperf.compact.analysis.json.xz', output_prefix=work_dir, compact=True)
+    with lzma.open(os.path.join(work_dir, 'onionperf.analysis.json.xz'), 'rt') as f:
+        assert_equals(f.read(), json.dumps(analysis.json_db, sort_keys=True, separators=(',', ': '), indent=2))
+    compact_analysis = OPAnalysis.load(filename='onionperf.compact.analysis.json.xz', input_prefix=work_dir)
+    assert_equals(compact_analysis.json_db, json.loads(json.dumps(analysis.json_db)))
+    shutil.rmtree(work_dir)
+
+def test_analysis_load_sections():
+    work_dir = tempfile.mkdtemp()
+    analysis = OPAnalysis(nickname='test', ip_address='1.2.3.4')
+    analysis.add_tgen_file(DATA_DIR + 'logs/onionperf.tgen.log')
+    analysis.add_torctl_file(DATA_DIR + 'logs/onionperf.torctl.log')
+    analysis.analyze()
+    analysis.save(filename='onionperf.analysis.json.xz', output_prefix=work_dir)
+    full_analysis = OPAnalysis.load(filename='onionperf.analysis.json.xz', input_prefix=work_dir)
+    circuits_analysis = OPAnalysis.load(filename='onionperf.analysis.json.xz', input_prefix=work_dir, sections=['tor/circuits'])
+    assert_equals(circuits_analysis.json_db['version'], full_analysis.json_db['version'])
+    assert_equals(circuits_analysis.json_db['data']['test'],
+                  {'measurement_ip': '1.2.3.4', 'tor': {'circuits': full_analysis.get_tor_circuits('test')}})
+    tgen_analysis = OPAnalysis.load(filename='onionperf.analysis.json.xz', input_prefix=work_dir, sections=['tgen', 'tor/streams'])
+    assert_equals(tgen_analysis.json_db['data']['test']['tgen'], full_analysis.json_db['data']['test']['tgen'])
+    assert_equals(tgen_analysis.get_tor_streams('test'), full_analysis.get_tor_streams('test'))
+    assert_equals(tgen_analysis.get_tor_circuits('test'), None)
+    shutil.rmtree(work_dir)
+
+def test_analysis_save_columnar():
+    work_dir = tempfile.mkdtemp()
+    analysis = OPAnalysis(nickname='test', ip_address='1.2.3.4')
+    analysis.add_tgen_file(DATA_DIR + 'logs/onionperf.tgen.log')
+    analysis.add_torctl_file(DATA_DIR + 'logs/onionperf.torctl.log')
+    analysis.analyze()
+    analysis.save(filename='onionperf.analysis.json.xz', output_prefix=work_dir, do_columnar=True)
+    tables = OPAnalysis.load_columnar(filename='onionperf.analysis.npz', input_prefix=work_dir)
+    circuits = analysis.get_tor_circuits('test')
+    assert_equals(sorted(tables['tor_circuits']['circuit_id']), sorted(circuits))
+    assert_equals(list(tables['tor_circuits']['node'].unique()), ['test'])
+    assert_equals(len(tables['tor_circuit_hops']), sum(len(circuit.get('path', [])) for circuit in circuits.values()))
+    hops = tables['tor_circuit_hops']
+    first_hop = hops[(hops['circuit_id'] == 26) & (hops['hop'] == 0)].iloc[0]
+    assert_equals(first_hop['fingerprint'], 'C92F69EE5756200F160CCFAFE9C3C984D3E6D561')
+    assert_equals(first_hop['nickname'], 'netzhub')
+    streams = analysis.get_tor_streams('test')
+    assert_equals(sorted(tables['tor_streams']['source']), sorted(stream.get('source', '') for stream in streams.values()))
+    arrays = OPAnalysis.load_columnar(filename=os.path.join(work_dir, 'onionperf.analysis.npz'), as_data_frames=False)
+    assert_equals(arrays['tor_circuits']['unix_ts_start'].dtype, 'float64')
+    shutil.rmtree(work_dir)
+
+def test_build_columnar_table():
+    table = build_columnar_table([
+        {'stream_id': '1', 'is_error': False, 'unix_ts_end': 10.5, 'filtered_out': True,
+         'elapsed_seconds': {'payload_progress_recv': {'0.1': 1.5}}, 'path': [['$A~a', 0.1]]},
+        {'stream_id': 2, 'is_error': True, 'elapsed_seconds': {'payload_progress_recv': {'0.1': 2.5, '0.2': 3}}}])
+    assert_equals(list(table), ['stream_id', 'is_error', 'unix_ts_end', 'filtered_out',
+                                'elapsed_seconds/payload_progress_recv/0.1', 'elapsed_seconds/payload_progress_recv/0.2'])
+    assert_equals(list(table['stream_id']), ['1', '2'])
+    assert_equals(list(table['is_error']), [False, True])
+    assert_equals(list(table['filtered_out']), [True, False])
+    assert_equals(list(table['elapsed_seconds/payload_progress_recv/0.1']), [1.5, 2.5])
+    assert_equals(table['unix_ts_end'][0], 10.5)
+    assert_true(math.isnan(table['unix_ts_end'][1]))
+    assert_true(math.isnan(table['elapsed_seconds/payload_progress_recv/0.2'][0]))
+
+def test_tor_circuit_get_data():
+    circuit = TorCircuit(7)
+    circuit.set_launched(100.0, 1500, 0.8)
+    circuit.add_event("GENERAL:LAUNCHED", 100.0)
+    circuit.add_hop(("AAAA", "relay1"), 100.5)
+    circuit.add_event("GENERAL:EXTENDED", 100.5)
+    circuit.set_build_time(101.0)
+    circuit.set_end_time(102.0)
+    assert(not hasattr(circuit, '__dict__'))
+    assert_equals(circuit.get_data(), {'circuit_id': 7, 'unix_ts_start': 100.0, 'unix_ts_end': 102.0,
+                                       'buildtime_seconds': 1.0, 'build_timeout': 1500, 'build_quantile': 0.8,
+                                       'elapsed_seconds': [["GENERAL:LAUNCHED", 0.0], ["GENERAL:EXTENDED", 0.5]],
+                                       'path': [["$AAAA~relay1", 0.5]]})
+
+def test_tor_stream_get_data():
+    stream = TorStream(3)
+    stream.add_event("USER", "NEW", 10.0)
+    stream.set_start_time(10.0)
+    stream.add_event(None, "SUCCEEDED", 10.25)
+    stream.set_circ_id('7')
+    stream.set_end_time(11.0)
+    assert(not hasattr(stream, '__dict__'))
+    assert_equals(stream.get_data(), {'stream_id': 3, 'circuit_id': '7', 'unix_ts_start': 10.0, 'unix_ts_end': 11.0,
+                                      'elapsed_seconds': [["USER:NEW", 0.0], ["USER:SUCCEEDED", 0.25]]})
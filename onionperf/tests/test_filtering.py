@@ -0,0 +1,202 @@
+import os
+import pkg_resources
+import datetime
+import tempfile
+import shutil
+import multiprocessing
+from nose.tools import *
+from onionperf import analysis
+from onionperf import filtering
+
+
+def absolute_data_path(relative_path=""):
+    """
+    Returns an absolute path for test data given a relative path.
+    """
+    return pkg_resources.resource_filename("onionperf",
+                                           "tests/data/" + relative_path)
+
+
+DATA_DIR = absolute_data_path()
+
+def save_analysis(work_dir):
+    op_analysis = analysis.OPAnalysis(nickname="test")
+    op_analysis.add_tgen_file(DATA_DIR + 'logs/onionperf.tgen.log')
+    op_analysis.add_torctl_file(DATA_DIR + 'logs/onionperf.torctl.log')
+    op_analysis.analyze(date_filter=datetime.date(2019, 1, 31))
+    op_analysis.save(output_prefix=work_dir, date_prefix=datetime.date(2019, 1, 31))
+    return os.path.join(work_dir, "2019-01-31.onionperf.analysis.json.xz")
+
+def test_multiprocess_filters():
+    work_dir = tempfile.mkdtemp()
+    analysis_file = save_analysis(work_dir)
+    circuits = analysis.OPAnalysis.load(filename=analysis_file).get_tor_circuits("test")
+    fingerprint = [path for path in [circuit.get("path") for circuit in circuits.values()] if path][0][0][0]
+    fingerprints_file = os.path.join(work_dir, "fingerprints.txt")
+    with open(fingerprints_file, 'wt') as f:
+        f.write(fingerprint + "\n")
+    test_filtering = filtering.Filtering()
+    test_filtering.exclude_fingerprints(fingerprints_file)
+    test_filtering.apply_filters(input_path=analysis_file, output_dir=os.path.join(work_dir, "serial"),
+                                 output_file="filtered.json.xz")
+    expected = analysis.OPAnalysis.load(filename=os.path.join(work_dir, "serial", "filtered.json.xz")).json_db
+
+    # a file that cannot be filtered is reported without stopping the others
+    jobs = []
+    for name in ["a", "b", "c"]:
+        os.makedirs(os.path.join(work_dir, "in", name))
+        input_path = os.path.join(work_dir, "in", name, "onionperf.analysis.json.xz")
+        if name == "c":
+            with open(input_path, 'wb') as f:
+                f.write(b"not an analysis results file")
+        else:
+            shutil.copy(analysis_file, input_path)
+        jobs.append((input_path, os.path.join(work_dir, "out", name), "onionperf.analysis.json.xz"))
+    assert_equals(filtering.multiprocess_filters(test_filtering, jobs, num_processes=2), 1)
+    for name in ["a", "b"]:
+        filtered = analysis.OPAnalysis.load(filename=os.path.join(work_dir, "out", name, "onionperf.analysis.json.xz"))
+        assert_equals(filtered.json_db, expected)
+    assert_false(os.path.exists(os.path.join(work_dir, "out", "c", "onionperf.analysis.json.xz")))
+    shutil.rmtree(work_dir)
+
+def test_multiprocess_filters_terminates_pool_on_error():
+    work_dir = tempfile.mkdtemp()
+    analysis_file = save_analysis(work_dir)
+    parent_pid = os.getpid()
+    class FailingLogging(object):
+        # fails to log progress in the parent process, but not in the worker processes
+        def info(self, msg):
+            if os.getpid() == parent_pid:
+                raise IOError("log is not writable")
+        def error(self, msg):
+            pass
+    logging = filtering.logging
+    filtering.logging = FailingLogging()
+    try:
+        filtering.multiprocess_filters(filtering.Filtering(), [(analysis_file, os.path.join(work_dir, "out"), "onionperf.analysis.json.xz")],
+                                       num_processes=1)
+        assert(False)
+    except IOError:
+        # check while the traceback still refers to the pool, which would otherwise be terminated when it is collected
+        assert_equals(multiprocessing.active_children(), [])
+    finally:
+        filtering.logging = logging
+    shutil.rmtree(work_dir)
+
+FINGERPRINTS = ["{0:040X}".format(i) for i in range(5)]
+
+def build_analysis():
+    test_analysis = analysis.OPAnalysis(nickname="test")
+    circuits = {
+        1: {"circuit_id": 1, "unix_ts_start": 1548892800.5, "buildtime_seconds": 0.5,
+            "path": [["$" + FINGERPRINTS[0] + "~relay0", 0.1], ["$" + FINGERPRINTS[1] + "~relay1", 0.5]]},
+        2: {"circuit_id": 2, "unix_ts_start": 1548896400.5, "buildtime_seconds": 2.5,
+            "path": [["$" + FINGERPRINTS[2] + "~Relay2", 1.0], ["$" + FINGERPRINTS[3] + "~relay3", 2.5]]},
+        3: {"circuit_id": 3, "unix_ts_start": 1548900000.5, "failure_reason_local": "TIMEOUT",
+            "path": [["$" + FINGERPRINTS[4] + "~relay4", 0.1]]},
+        4: {"circuit_id": 4, "unix_ts_start": 1548903600.5, "failure_reason_local": "DESTROYED",
+            "failure_reason_remote": "FINISHED"}}
+    test_analysis.json_db["data"]["test"] = {"tor": {"circuits": circuits}}
+    return test_analysis
+
+def get_filtered_out(test_filtering):
+    test_analysis = build_analysis()
+    test_filtering.filter_tor_circuits(test_analysis)
+    circuits = test_analysis.get_tor_circuits("test")
+    return sorted(circuit_id for circuit_id, circuit in circuits.items() if circuit.get("filtered_out"))
+
+def write_lines(work_dir, filename, lines):
+    path = os.path.join(work_dir, filename)
+    with open(path, 'wt') as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+def test_filter_tor_circuits_rules():
+    work_dir = tempfile.mkdtemp()
+    test_filtering = filtering.Filtering()
+    assert_equals(get_filtered_out(test_filtering), [])
+
+    # only relays with known fingerprints are filtered, and lots of them cost no more than a few
+    test_filtering.include_fingerprints(write_lines(work_dir, "few.txt", FINGERPRINTS[:2] + [FINGERPRINTS[4].lower()]))
+    assert_equals(get_filtered_out(test_filtering), [2, 4])
+    test_filtering.include_fingerprints(write_lines(work_dir, "many.txt",
+        ["${0:040X}".format(i) for i in range(10000)]))
+    assert_equals(get_filtered_out(test_filtering), [4])
+
+    test_filtering = filtering.Filtering()
+    test_filtering.exclude_fingerprints(write_lines(work_dir, "exclude.txt", [FINGERPRINTS[3]]))
+    assert_equals(get_filtered_out(test_filtering), [2, 4])
+
+    test_filtering = filtering.Filtering()
+    test_filtering.include_nicknames(write_lines(work_dir, "nicknames.txt", ["relay0", "relay1", "relay2", "relay3"]))
+    assert_equals(get_filtered_out(test_filtering), [3, 4])
+    test_filtering = filtering.Filtering()
+    test_filtering.exclude_nicknames(write_lines(work_dir, "nicknames.txt", ["# comment", "RELAY2"]))
+    assert_equals(get_filtered_out(test_filtering), [2, 4])
+
+    # relays without nickname are written as ~None, which is not a nickname to include or exclude
+    test_filtering = filtering.Filtering()
+    test_filtering.include_nicknames(write_lines(work_dir, "nicknames.txt", ["relay0"]))
+    test_filtering.exclude_nicknames(write_lines(work_dir, "exclude.txt", ["none"]))
+    test_analysis = build_analysis()
+    test_analysis.get_tor_circuits("test")[1]["path"][1][0] = "$" + FINGERPRINTS[1] + "~None"
+    test_filtering.filter_tor_circuits(test_analysis)
+    assert_false(test_analysis.get_tor_circuits("test")[1].get("filtered_out", False))
+
+    test_filtering = filtering.Filtering()
+    test_filtering.include_time_window(datetime.datetime(2019, 1, 31, 0, 0), datetime.datetime(2019, 1, 31, 1, 0))
+    test_filtering.include_time_window(datetime.datetime(2019, 1, 31, 2, 0), datetime.datetime(2019, 1, 31, 3, 0))
+    assert_equals(get_filtered_out(test_filtering), [2, 4])
+    test_filtering.exclude_time_window(datetime.datetime(2019, 1, 31, 0, 0), datetime.datetime(2019, 1, 31, 0, 30))
+    assert_equals(get_filtered_out(test_filtering), [1, 2, 4])
+
+    test_filtering = filtering.Filtering()
+    test_filtering.min_build_time(1.0)
+    assert_equals(get_filtered_out(test_filtering), [1, 3, 4])
+    test_filtering = filtering.Filtering()
+    test_filtering.max_build_time(1.0)
+    assert_equals(get_filtered_out(test_filtering), [2, 3, 4])
+
+    test_filtering = filtering.Filtering()
+    test_filtering.include_failure_reasons(["timeout", "FINISHED"])
+    assert_equals(get_filtered_out(test_filtering), [1, 2])
+    test_filtering = filtering.Filtering()
+    test_filtering.exclude_failure_reasons(["DESTROYED"])
+    assert_equals(get_filtered_out(test_filtering), [4])
+
+    # all rules are evaluated in one pass, and their metadata is recorded in a fixed order
+    test_filtering.max_build_time(1.0)
+    test_filtering.exclude_fingerprints(write_lines(work_dir, "exclude.txt", [FINGERPRINTS[0]]))
+    test_analysis = build_analysis()
+    test_filtering.filter_tor_circuits(test_analysis)
+    assert_equals([f["name"] for f in test_analysis.json_db["filters"]["tor/circuits"]],
+                  ["exclude_fingerprints", "max_build_time", "exclude_failure_reasons"])
+    assert_equals(sorted(circuit_id for circuit_id, circuit in test_analysis.get_tor_circuits("test").items()
+                         if circuit.get("filtered_out")), [1, 2, 3, 4])
+    shutil.rmtree(work_dir)
+
+def test_filters_overlay():
+    work_dir = tempfile.mkdtemp()
+    analysis_file = save_analysis(work_dir)
+    test_filtering = filtering.Filtering()
+    test_filtering.max_build_time(0.8)
+    test_filtering.apply_filters(input_path=analysis_file, output_dir=os.path.join(work_dir, "filtered"),
+                                 output_file="onionperf.analysis.json.xz")
+    expected = analysis.OPAnalysis.load(filename=os.path.join(work_dir, "filtered", "onionperf.analysis.json.xz"))
+    overlay_file = analysis.get_filters_filename(analysis_file, "fast")
+    assert_equals(os.path.basename(overlay_file), "2019-01-31.onionperf.analysis.fast.filters.json")
+    output_dir, output_file = os.path.split(overlay_file)
+    test_filtering.save_filters_overlay(input_path=analysis_file, output_dir=output_dir, output_file=output_file)
+    assert_true(os.path.getsize(overlay_file) < 1000)
+    assert_true(os.path.getmtime(analysis_file) <= os.path.getmtime(overlay_file))
+
+    # the overlay gives the same results as rewriting the whole file, also when loading only some sections
+    filtered = analysis.OPAnalysis.load(filename=analysis_file, filters="fast")
+    assert_equals(filtered.json_db, expected.json_db)
+    assert_equals(sorted(circuit_id for circuit_id, circuit in filtered.get_tor_circuits("test").items()
+                         if circuit.get("filtered_out")), ["25", "28", "36"])
+    filtered = analysis.OPAnalysis.load(filename=analysis_file, sections=["tor/circuits"], filters="fast")
+    assert_equals(filtered.get_tor_circuits("test"), expected.get_tor_circuits("test"))
+    assert_true("filtered_out" not in str(analysis.OPAnalysis.load(filename=analysis_file).json_db))
+    assert_equals(analysis.OPAnalysis.load(filename=analysis_file, filters="missing"), None)
+    shutil.rmtree(work_dir)
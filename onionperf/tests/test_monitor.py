@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import pkg_resources
+from nose.tools import assert_equals
+from stem.response import ControlMessage, convert
+from onionperf import analysis, monitor, util
+
+
+def absolute_data_path(relative_path=""):
+    """
+    Returns an absolute path for test data given a relative path.
+    """
+    return pkg_resources.resource_filename("onionperf",
+                                           "tests/data/" + relative_path)
+
+
+DATA_DIR = absolute_data_path()
+
+
+def replay_torctl_log(writable):
+    """
+    Writes the lines of a TorCtl log file to the given writable the way
+    TorMonitor logs lines and decoded events, and rotates it.
+    """
+    with open(DATA_DIR + "logs/onionperf.torctl.log", 'rt', newline='\r\n') as f:
+        for line in f:
+            timestamps, sep, raw_event_str = line.partition(" 650 ")
+            if sep == '' or '\n' in timestamps:
+                writable.write(line)
+            else:
+                event = ControlMessage.from_str("650 {0}".format(raw_event_str))
+                convert('EVENT', event)
+                writable.write_event(line, event, float(timestamps.split()[2]))
+    rotated_filename = writable.rotate_file()
+    writable.close()
+    return rotated_filename
+
+
+def test_live_analysis_writable():
+    """
+    Replays a TorCtl log file through a monitor.LiveAnalysisWritable, and
+    checks that the parser that is handed over when rotating the file produced
+    the same results as parsing the rotated file.
+    """
+    work_dir = tempfile.mkdtemp()
+    # the log file contains measurements of two dates that are 11 days apart
+    writable = monitor.LiveAnalysisWritable(util.FileWritable(os.path.join(work_dir, "onionperf.torctl.log")),
+                                            retention_seconds=30 * 86400)
+    rotated_filename = replay_torctl_log(writable)
+
+    parser = analysis.TorCtlParser()
+    parser.parse(util.DataSource(rotated_filename))
+    assert_equals(writable.rotated_parser.get_data(), parser.get_data())
+    assert_equals(writable.rotated_parser.get_name(), parser.get_name())
+    assert_equals(len(writable.rotated_parser.circuits), 7)
+    assert_equals(writable.get_parser().get_data(), {'circuits': {}, 'streams': {}})
+    shutil.rmtree(work_dir)
+
+
+def test_live_analysis_writable_retention():
+    """
+    Replays a TorCtl log file through a monitor.LiveAnalysisWritable that only
+    keeps results for a day, so that the circuits and streams of the first date
+    are dropped when events of the second date arrive.
+    """
+    work_dir = tempfile.mkdtemp()
+    writable = monitor.LiveAnalysisWritable(util.FileWritable(os.path.join(work_dir, "onionperf.torctl.log")),
+                                            retention_seconds=86400)
+    replay_torctl_log(writable)
+    assert_equals(writable.rotated_parser.get_data(), {'circuits': {}, 'streams': {}})
+    shutil.rmtree(work_dir)
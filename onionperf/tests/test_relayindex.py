@@ -0,0 +1,90 @@
+import os
+import pkg_resources
+import datetime
+import tempfile
+import shutil
+import sqlite3
+import multiprocessing
+from nose.tools import *
+from onionperf import analysis
+from onionperf.relayindex import RelayIndex
+
+
+def absolute_data_path(relative_path=""):
+    """
+    Returns an absolute path for test data given a relative path.
+    """
+    return pkg_resources.resource_filename("onionperf",
+                                           "tests/data/" + relative_path)
+
+
+DATA_DIR = absolute_data_path()
+
+def save_analysis(output_dir, date):
+    op_analysis = analysis.OPAnalysis(nickname="test")
+    op_analysis.add_tgen_file(DATA_DIR + 'logs/onionperf.tgen.log')
+    op_analysis.add_torctl_file(DATA_DIR + 'logs/onionperf.torctl.log')
+    op_analysis.analyze(date_filter=date)
+    return op_analysis.save(output_prefix=output_dir, date_prefix=date)
+
+def test_relay_index():
+    work_dir = tempfile.mkdtemp()
+    analyses_dir = os.path.join(work_dir, "analyses")
+    analysis_file = save_analysis(analyses_dir, datetime.date(2019, 1, 31))
+    circuits = analysis.OPAnalysis.load(filename=analysis_file).get_tor_circuits("test")
+    index_path = os.path.join(work_dir, "onionperf.relays.sqlite")
+    relay_index = RelayIndex(index_path)
+    assert_equals(relay_index.update(analyses_dir, num_processes=1), 0)
+    assert_equals(relay_index.get_last_date(), datetime.date(2019, 1, 31))
+
+    # every hop of every circuit can be found by its fingerprint
+    for circuit_id, circuit in circuits.items():
+        for hop, (long_name, _) in enumerate(circuit["path"]):
+            entries = relay_index.query(long_name[:41])
+            assert_true({'date': '2019-01-31', 'node': 'test', 'circuit_id': circuit_id, 'hop': hop,
+                         'nickname': long_name.split('~')[1], 'unix_ts_start': circuit["unix_ts_start"],
+                         'buildtime_seconds': circuit["buildtime_seconds"], 'failure_reason_local': None,
+                         'failure_reason_remote': None} in entries)
+    fingerprint = circuits["23"]["path"][0][0][1:41]
+    assert_equals(len(relay_index.query(fingerprint.lower())), 1)
+    assert_equals(relay_index.query(fingerprint, start_date=datetime.date(2019, 2, 1)), [])
+    assert_equals(relay_index.query(fingerprint, end_date=datetime.date(2019, 1, 30)), [])
+    relay_index.close()
+
+    # updates only read new or changed files and forget removed ones, and queries do not read any
+    relay_index = RelayIndex(index_path)
+    os.rename(analysis_file, analysis_file + ".moved")
+    assert_equals(relay_index.query(fingerprint)[0]['circuit_id'], "23")
+    os.rename(analysis_file + ".moved", analysis_file)
+    assert_equals(relay_index.update(analyses_dir, num_processes=1), 0)
+    assert_equals(len(relay_index.query(fingerprint)), 1)
+    with open(os.path.join(analyses_dir, "2019-02-01.onionperf.analysis.json.xz"), 'wb') as f:
+        f.write(b"not an analysis results file")
+    assert_equals(relay_index.update(analyses_dir, num_processes=1), 1)
+    os.remove(analysis_file)
+    assert_equals(relay_index.update(analyses_dir, num_processes=1), 1)
+    assert_equals(relay_index.query(fingerprint), [])
+    assert_equals(relay_index.get_last_date(), None)
+    relay_index.close()
+    shutil.rmtree(work_dir)
+
+def test_relay_index_terminates_pool_on_error():
+    work_dir = tempfile.mkdtemp()
+    analyses_dir = os.path.join(work_dir, "analyses")
+    save_analysis(analyses_dir, datetime.date(2019, 1, 31))
+    index_path = os.path.join(work_dir, "onionperf.relays.sqlite")
+    relay_index = RelayIndex(index_path)
+    relay_index.connection.execute("PRAGMA busy_timeout = 0")
+    # another connection that is writing to the index keeps the update from writing to it
+    other_connection = sqlite3.connect(index_path)
+    other_connection.execute("BEGIN IMMEDIATE")
+    try:
+        relay_index.update(analyses_dir, num_processes=1)
+        assert(False)
+    except sqlite3.OperationalError:
+        # check while the traceback still refers to the pool, which would otherwise be terminated when it is collected
+        assert_equals(multiprocessing.active_children(), [])
+    finally:
+        other_connection.close()
+        relay_index.close()
+    shutil.rmtree(work_dir)
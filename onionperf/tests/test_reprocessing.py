@@ -1,11 +1,14 @@
 import os
 import pkg_resources
 import datetime
+import json
+import multiprocessing
 import tempfile
 import shutil
 from nose.tools import *
 from onionperf import analysis
 from onionperf import reprocessing
+from onionperf import util
 
 
 def absolute_data_path(relative_path=""):
@@ -83,3 +86,232 @@ def test_end_to_end():
     json_file = os.path.join(work_dir, "2019-01-10.onionperf.analysis.json.xz")
     assert(os.path.exists(json_file))
     shutil.rmtree(work_dir)
+
+def test_analysis_manifest():
+    pair = (DATA_DIR + 'logs/onionperf.tgen.log', DATA_DIR + 'logs/onionperf.torctl.log', datetime.datetime(2019, 1, 10, 0, 0))
+    work_dir = tempfile.mkdtemp()
+    output_filename = analysis.get_analysis_filename(pair[2])
+    manifest = reprocessing.AnalysisManifest(work_dir)
+    entry = manifest.get_entry(pair, "test", {})
+    assert_equals(manifest.is_current(output_filename, entry), False)
+    reprocessing.analyze_func(work_dir, "test", pair)
+    manifest.add_entry(output_filename, entry, [output_filename])
+    manifest.save()
+    manifest = reprocessing.AnalysisManifest(work_dir)
+    assert_equals(manifest.is_current(output_filename, entry), True)
+    assert_equals(manifest.is_current(output_filename, manifest.get_entry(pair, None, {})), False)
+    os.utime(os.path.join(work_dir, output_filename), ns=(0, 0))
+    assert_equals(manifest.is_current(output_filename, entry), False)
+    shutil.rmtree(work_dir)
+
+def test_multiprocess_logs_manifest():
+    pairs = [(DATA_DIR + 'logs/onionperf.tgen.log', DATA_DIR + 'logs/onionperf.torctl.log', datetime.datetime(2019, 1, 10, 0, 0))]
+    work_dir = tempfile.mkdtemp()
+    reprocessing.multiprocess_logs(pairs, work_dir)
+    json_file = os.path.join(work_dir, "2019-01-10.onionperf.analysis.json.xz")
+    assert(os.path.exists(json_file))
+    assert(os.path.exists(os.path.join(work_dir, reprocessing.MANIFEST_FILENAME)))
+    mtime_ns = os.stat(json_file).st_mtime_ns
+    reprocessing.multiprocess_logs(pairs, work_dir)
+    assert_equals(os.stat(json_file).st_mtime_ns, mtime_ns)
+    reprocessing.multiprocess_logs(pairs, work_dir, use_manifest=False)
+    assert(os.stat(json_file).st_mtime_ns != mtime_ns)
+    shutil.rmtree(work_dir)
+
+def test_plan_jobs():
+    work_dir = tempfile.mkdtemp()
+    def write_log(filename, first_ts, last_ts, compress=False):
+        lines = []
+        for ts in range(first_ts, last_ts + 1, 3600):
+            date_time = datetime.datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+            lines.append("{0} {1}.0 [message] line\n".format(date_time, ts).encode())
+        data = b"".join(lines)
+        with open(os.path.join(work_dir, filename), "wb") as f:
+            f.write(util.compress_block(data, "xz") if compress else data)
+        return os.path.join(work_dir, filename)
+    # 2019-01-10 00:00:00 UTC
+    day = 1547078400
+    tgen_logs = [write_log("onionperf_2019-01-10_23:59:59.tgen.log", day, day + 86400),
+                 write_log("onionperf_2019-01-11_23:59:59.tgen.log.xz", day + 86400, day + 2 * 86400, compress=True),
+                 write_log("onionperf.tgen.log", day + 2 * 86400, day + 3 * 86400 - 1)]
+    torctl_logs = [write_log("onionperf.torctl.log", day, day + 3 * 86400 - 1)]
+    jobs = reprocessing.plan_jobs(tgen_logs, torctl_logs, None)
+    # the first log ends with a line at midnight, and so does the compressed log, which is decompressed to find its last line
+    assert_equals(jobs, [([tgen_logs[0]], torctl_logs, datetime.datetime(2019, 1, 10)),
+                         ([tgen_logs[0], tgen_logs[1]], torctl_logs, datetime.datetime(2019, 1, 11)),
+                         ([tgen_logs[1], tgen_logs[2]], torctl_logs, datetime.datetime(2019, 1, 12))])
+    jobs = reprocessing.plan_jobs(list(reversed(tgen_logs)), torctl_logs, datetime.date(2019, 1, 11))
+    assert_equals(jobs, [([tgen_logs[0], tgen_logs[1]], torctl_logs, datetime.datetime(2019, 1, 11))])
+    assert_equals(reprocessing.plan_jobs(tgen_logs, [], None), [])
+    # time ranges cached in the manifest are used as long as log files do not change
+    manifest_dir = os.path.join(work_dir, "manifest")
+    expected_jobs = reprocessing.plan_jobs(tgen_logs, torctl_logs, None)
+    assert_equals(reprocessing.plan_jobs(tgen_logs, torctl_logs, None, reprocessing.AnalysisManifest(manifest_dir)), expected_jobs)
+    find_log_time_range = util.find_log_time_range
+    read_logs = []
+    def record_reading(filename):
+        read_logs.append(filename)
+        return find_log_time_range(filename)
+    util.find_log_time_range = record_reading
+    try:
+        assert_equals(reprocessing.plan_jobs(tgen_logs, torctl_logs, None, reprocessing.AnalysisManifest(manifest_dir)), expected_jobs)
+        assert_equals(read_logs, [])
+        os.utime(tgen_logs[1], ns=(0, 0))
+        assert_equals(reprocessing.plan_jobs(tgen_logs, torctl_logs, None, reprocessing.AnalysisManifest(manifest_dir)), expected_jobs)
+        assert_equals(read_logs, [tgen_logs[1]])
+    finally:
+        util.find_log_time_range = find_log_time_range
+    shutil.rmtree(work_dir)
+
+def test_multiprocess_logs_by_date():
+    # the test logs span 2019-01-31 to 2019-02-11 and are parsed once for all dates
+    pairs = reprocessing.plan_jobs([DATA_DIR + 'logs/onionperf.tgen.log'], [DATA_DIR + 'logs/onionperf.torctl.log'], None)
+    assert_equals(len(pairs), 12)
+    work_dir = tempfile.mkdtemp()
+    reprocessing.multiprocess_logs(pairs, os.path.join(work_dir, "by_date"))
+    for pair in pairs:
+        reprocessing.analyze_func(os.path.join(work_dir, "by_pair"), None, pair)
+        filename = analysis.get_analysis_filename(pair[2])
+        by_date = analysis.OPAnalysis.load(filename=filename, input_prefix=os.path.join(work_dir, "by_date"))
+        by_pair = analysis.OPAnalysis.load(filename=filename, input_prefix=os.path.join(work_dir, "by_pair"))
+        assert_equals(by_date.json_db, by_pair.json_db)
+    shutil.rmtree(work_dir)
+
+def test_multiprocess_logs_retries_and_summary():
+    work_dir = tempfile.mkdtemp()
+    bad_tgen_log = os.path.join(work_dir, "onionperf_2019-02-01.tgen.log")
+    with open(bad_tgen_log, "wt") as f:
+        f.write("2019-02-01 00:00:00 not-a-timestamp [message] line\n")
+    pairs = [(DATA_DIR + 'logs/onionperf.tgen.log', DATA_DIR + 'logs/onionperf.torctl.log', datetime.datetime(2019, 1, 31, 0, 0)),
+             (bad_tgen_log, DATA_DIR + 'logs/onionperf.torctl.log', datetime.datetime(2019, 2, 1, 0, 0))]
+    output_dir = os.path.join(work_dir, "output")
+    assert_equals(reprocessing.multiprocess_logs(pairs, output_dir, num_retries=2), 1)
+    assert(os.path.exists(os.path.join(output_dir, "2019-01-31.onionperf.analysis.json.xz")))
+    with open(os.path.join(output_dir, reprocessing.SUMMARY_FILENAME), "rt") as f:
+        summary = json.load(f)
+    assert_equals([task["dates"] for task in summary], [["2019-02-01"], ["2019-01-31"]])
+    assert_equals([task["attempts"] for task in summary], [3, 1])
+    assert("ValueError" in summary[0]["error"])
+    assert_equals(summary[1]["error"], None)
+    assert_equals(summary[1]["input_size"], os.path.getsize(pairs[0][0]) + os.path.getsize(pairs[0][1]))
+    shutil.rmtree(work_dir)
+
+def test_multiprocess_logs_terminates_pool_on_error():
+    work_dir = tempfile.mkdtemp()
+    pairs = [(DATA_DIR + 'logs/onionperf.tgen.log', DATA_DIR + 'logs/onionperf.torctl.log', datetime.datetime(2019, 1, 31, 0, 0))]
+    def fail_recording(manifest, outputs, do_columnar):
+        raise IOError("manifest is not writable")
+    record_analysis = reprocessing.record_analysis
+    reprocessing.record_analysis = fail_recording
+    try:
+        assert_equals(reprocessing.multiprocess_logs(pairs, work_dir), 1)
+    finally:
+        reprocessing.record_analysis = record_analysis
+    assert_equals(multiprocessing.active_children(), [])
+    shutil.rmtree(work_dir)
+
+def copy_log_pairs(work_dir, num_dates):
+    # separate copies of the test logs make separate tasks for each date
+    pairs = []
+    for i in range(num_dates):
+        date = datetime.datetime(2019, 1, 31) + datetime.timedelta(days=i)
+        pair = (os.path.join(work_dir, "{0}.tgen.log".format(util.date_to_string(date))),
+                os.path.join(work_dir, "{0}.torctl.log".format(util.date_to_string(date))), date)
+        shutil.copy(DATA_DIR + 'logs/onionperf.tgen.log', pair[0])
+        shutil.copy(DATA_DIR + 'logs/onionperf.torctl.log', pair[1])
+        pairs.append(pair)
+    return pairs
+
+def test_work_queue_claim():
+    work_dir = tempfile.mkdtemp()
+    work_queue = reprocessing.WorkQueue(work_dir, lock_timeout=60)
+    assert_equals(work_queue.claim("task"), True)
+    assert_equals(work_queue.claim("task"), False)
+    work_queue.release("task")
+    assert_equals(work_queue.claim("task"), True)
+    # a lock file that was not refreshed for too long can be claimed again
+    os.utime(work_queue.get_lock_path("task"), (0, 0))
+    assert_equals(work_queue.claim("task"), True)
+    work_queue.finish("task")
+    assert_equals(os.path.exists(work_queue.get_lock_path("task")), False)
+    assert_equals(work_queue.claim("task"), False)
+    shutil.rmtree(work_dir)
+
+def claim_stale_lock(work_dir, barrier, results):
+    work_queue = reprocessing.WorkQueue(work_dir, lock_timeout=60)
+    barrier.wait()
+    results.put(work_queue.claim("task"))
+
+def test_work_queue_claim_stale_lock_race():
+    work_dir = tempfile.mkdtemp()
+    work_queue = reprocessing.WorkQueue(work_dir, lock_timeout=60)
+    assert_equals(work_queue.claim("task"), True)
+    os.utime(work_queue.get_lock_path("task"), (0, 0))
+    # a process that saw the stale lock file before another process took it over cannot take it over as well
+    stale_lock = work_queue.read_lock("task")
+    other_queue = reprocessing.WorkQueue(work_dir, lock_timeout=60)
+    assert_equals(other_queue.claim("task"), True)
+    late_queue = reprocessing.WorkQueue(work_dir, lock_timeout=60)
+    late_queue.read_lock = lambda task_id: stale_lock
+    assert_equals(late_queue.claim("task"), False)
+    assert_equals(other_queue.refresh("task"), True)
+    # the previous owner can neither refresh nor release the lock file anymore
+    assert_equals(work_queue.refresh("task"), False)
+    work_queue.release("task")
+    assert_equals(other_queue.owns("task"), True)
+    other_queue.release("task")
+    assert_equals(other_queue.owns("task"), False)
+
+    # several processes racing for a stale lock file, only one of them wins
+    assert_equals(work_queue.claim("task"), True)
+    os.utime(work_queue.get_lock_path("task"), (0, 0))
+    barrier, results = multiprocessing.Barrier(4), multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=claim_stale_lock, args=(work_dir, barrier, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert_equals(sorted(results.get() for _ in range(4)), [False, False, False, True])
+    shutil.rmtree(work_dir)
+
+def test_multiprocess_logs_shards():
+    work_dir = tempfile.mkdtemp()
+    pairs = copy_log_pairs(work_dir, 4)
+    analyzed_dates = []
+    for i in [1, 2]:
+        output_dir = os.path.join(work_dir, "shard{0}".format(i))
+        reprocessing.multiprocess_logs(pairs, output_dir, shard=(i, 2))
+        shard_dates = sorted(filename.split('.')[0] for filename in os.listdir(output_dir) if 'analysis' in filename)
+        # assignments do not depend on the state of the output directory
+        reprocessing.multiprocess_logs(pairs, output_dir, shard=(i, 2), use_manifest=False)
+        assert_equals(sorted(filename.split('.')[0] for filename in os.listdir(output_dir) if 'analysis' in filename), shard_dates)
+        analyzed_dates.extend(shard_dates)
+    assert_equals(sorted(analyzed_dates), [util.date_to_string(pair[2]) for pair in pairs])
+    shutil.rmtree(work_dir)
+
+def test_multiprocess_logs_work_queue():
+    work_dir = tempfile.mkdtemp()
+    pairs = copy_log_pairs(work_dir, 6)
+    output_dir = os.path.join(work_dir, "output")
+    work_queue = reprocessing.WorkQueue(os.path.join(work_dir, "queue"))
+    # several worker processes that share a work queue, as if they were running on different hosts
+    workers = [multiprocessing.Process(target=reprocessing.multiprocess_logs, args=(pairs, output_dir),
+                                       kwargs={'work_queue': work_queue}) for i in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    statuses = {}
+    for filename in os.listdir(output_dir):
+        if filename.startswith("onionperf.reprocessing."):
+            with open(os.path.join(output_dir, filename), "rt") as f:
+                for task in json.load(f):
+                    statuses.setdefault(task["dates"][0], []).append(task["status"])
+    assert_equals(len(statuses), 6)
+    for task_statuses in statuses.values():
+        assert_equals(sorted(task_statuses), ["analyzed", "skipped", "skipped"])
+    for pair in pairs:
+        assert(os.path.exists(os.path.join(output_dir, analysis.get_analysis_filename(pair[2]))))
+    with open(os.path.join(output_dir, reprocessing.MANIFEST_FILENAME), "rt") as f:
+        assert_equals(len(json.load(f)["entries"]), 6)
+    shutil.rmtree(work_dir)
@@ -1,12 +1,15 @@
 import datetime
 import hashlib
+import io
+import json
+import lzma
 import os
 import pkg_resources
 import shutil
 import sys
 import tempfile
 
-from nose.tools import assert_equals
+from nose.tools import assert_equals, assert_raises
 
 from onionperf import util
 
@@ -174,6 +177,78 @@ def test_dates_match_false():
     second_date = datetime.datetime(2016, 11, 27, 11)
     assert_equals(util.do_dates_match(first_date, second_date), False)
 
+def test_date_to_timestamp_range():
+    """
+    Uses util.date_to_timestamp_range with a datetime object.
+    Returns the unix timestamps of midnight at the start and end of the UTC date.
+    """
+    date_object = datetime.datetime(2019, 1, 31, 11)
+    assert_equals(util.date_to_timestamp_range(date_object), (1548892800, 1548979200))
+
+def test_find_timestamp_offset():
+    """
+    Uses util.find_timestamp_offset to find the first line of a date in a
+    time-ordered log file spanning two dates, and the end of the file if no
+    line is recent enough.
+    """
+    log_path = absolute_data_path("logs/onionperf.tgen.log")
+    unix_ts, _ = util.date_to_timestamp_range(datetime.date(2019, 2, 11))
+    offset = util.find_timestamp_offset(log_path, unix_ts)
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+        assert(f.readline().startswith(b"2019-02-11 14:58:38 1549893518.928599"))
+    assert_equals(util.find_timestamp_offset(log_path, 0), 0)
+    assert_equals(util.find_timestamp_offset(log_path, unix_ts + 86400), os.path.getsize(log_path))
+
+def test_split_byte_range():
+    """
+    Uses util.split_byte_range to split a log file into consecutive byte
+    ranges that cover the whole file and each start at the beginning of a line.
+    """
+    log_path = absolute_data_path("logs/onionperf.torctl.log")
+    size = os.path.getsize(log_path)
+    byte_ranges = util.split_byte_range(log_path, 0, size, 4, newline='\r\n')
+    assert_equals(len(byte_ranges), 4)
+    assert_equals(byte_ranges[0][0], 0)
+    assert_equals(byte_ranges[-1][1], size)
+    with open(log_path, 'rb') as f:
+        for ((_, end), (start, _)) in zip(byte_ranges[:-1], byte_ranges[1:]):
+            assert_equals(end, start)
+            f.seek(start - 2)
+            assert_equals(f.read(2), b"\r\n")
+    assert_equals(util.split_byte_range(log_path, size, size, 4), [])
+
+def test_find_last_line_end():
+    """
+    Uses util.find_last_line_end to find the end of the last complete line in
+    a file that is still being written.
+    """
+    temp_file = tempfile.NamedTemporaryFile(delete=False)
+    temp_file.write(b"first line\r\nsecond line\r\nthird li")
+    temp_file.close()
+    assert_equals(util.find_last_line_end(temp_file.name, newline='\r\n'), len(b"first line\r\nsecond line\r\n"))
+    os.remove(temp_file.name)
+
+def test_data_source_compressed_byte_ranges():
+    """
+    Creates a new util.DataSource object that reads a byte range of the
+    uncompressed contents of a compressed input file to its end.
+    """
+    test_data_source = util.DataSource(absolute_data_path("simplefile.xz"), byte_ranges=[(2, None)])
+    assert(not test_data_source.is_seekable())
+    test_data_source.open()
+    assert_equals(test_data_source.source.read(), "ionperf")
+
+def test_data_source_byte_ranges():
+    """
+    Creates a new util.DataSource object that only reads two byte ranges of
+    an uncompressed input file, which are returned as if they were one file.
+    """
+    test_data_source = util.DataSource(absolute_data_path("simplefile"), byte_ranges=[(0, 2), (5, 9)])
+    assert(test_data_source.is_seekable())
+    test_data_source.open()
+    assert_equals(test_data_source.source.read(), "onperf")
+
 def test_find_ip_address_url():
     """
     Uses util.find_ip_address_url with a string containing an IPv4 address.
@@ -305,3 +380,325 @@ def test_file_writable_rotate_file():
     assert(os.path.isdir(created_dir))
     assert(os.path.exists(rotated_file))
     shutil.rmtree(work_dir)
+
+def test_write_json():
+    """
+    Writes a nested dict with integer and string keys to a util.MemoryWritable
+    using util.write_json with a tiny buffer size, and checks that the output
+    is the same as json.dumps, both indented and compact.
+    """
+    obj = {"data": {"op-ab": {"tor": {"circuits": {10: {"path": [["$A~a", 0.5]]}, 9: {}},
+                                      "streams": {}},
+                              "tgen": {"transfers": {"t1": {"elapsed_seconds": {"payload_progress": {"0.0": 1.0}}}}}}},
+           "type": "onionperf", "version": "4.0", "filters": [], "empty": None}
+    for (compact, indent, separators) in [(False, 2, (',', ': ')), (True, None, (',', ':'))]:
+        for sort_keys in [True, False]:
+            test_writable = util.MemoryWritable()
+            util.write_json(test_writable, obj, sort_keys=sort_keys, compact=compact, buffer_size=16)
+            assert_equals(test_writable.str_buffer.getvalue(),
+                          json.dumps(obj, sort_keys=sort_keys, indent=indent, separators=separators))
+
+def test_json_backends():
+    """
+    Decodes and encodes values that orjson handles differently from json with
+    every available backend, and checks that the results are the same as with
+    json.loads and json.dumps.
+    """
+    obj = {"circuits": {1: {"elapsed_seconds": [["GENERAL:LAUNCHED", 0.0], ["GENERAL:BUILT", 1e-05]]},
+                        2: {"unix_ts_start": 1e+16, "nickname": "reläy\x7f", "build_quantile": float("nan")},
+                        3: {"large": 2 ** 70, "flags": [True, False, None]}},
+           "empty": {}}
+    previous_backend = util.JSON_BACKEND
+    try:
+        for backend in ["json", "orjson"] if util.orjson is not None else ["json"]:
+            util.set_json_backend(backend)
+            for sort_keys in [True, False]:
+                assert_equals(util.json_dumps(obj, sort_keys=sort_keys),
+                              json.dumps(obj, sort_keys=sort_keys, separators=(',', ': '), indent=2))
+                assert_equals(util.json_dumps(obj["circuits"], sort_keys=sort_keys, compact=True),
+                              json.dumps(obj["circuits"], sort_keys=sort_keys, separators=(',', ':')))
+            encoded = json.dumps(obj)
+            assert_equals(json.dumps(util.json_loads(encoded)), encoded)
+            assert_equals(util.json_loads(encoded.encode())["circuits"]["1"], obj["circuits"][1])
+    finally:
+        util.set_json_backend(previous_backend)
+
+def test_json_section_reader():
+    """
+    Reads a JSON document with brackets, quotes, and backslashes in strings
+    using util.JSONSectionReader with tiny chunks, and checks that selected
+    objects and arrays are decoded like json.loads would, and that all other
+    objects and arrays are left out.
+    """
+    obj = {"type": "onionperf", "data": {"a": {"ip": "1.2.3.4", "tor": {"circuits": {"1": {"path": [["$A~[a]", 0.5]]}},
+                                                              "streams": {"2": {"target": "[::1]:80 \\\"}{"}}},
+                                      "tgen": {"streams": {"3": {"error": "NONE"}}, "count": 3}}}}
+    text = json.dumps(obj, indent=2)
+
+    def select(path):
+        if path[-1:] in [("circuits",), ("tgen",)]:
+            return True
+        elif path[-1:] == ("streams",):
+            return False
+        return None
+
+    for chunk_size in [1, 5, 1048576]:
+        reader = util.JSONSectionReader(io.StringIO(text), chunk_size=chunk_size)
+        assert_equals(reader.load(select),
+                      {"type": "onionperf", "data": {"a": {"ip": "1.2.3.4", "tor": {"circuits": obj["data"]["a"]["tor"]["circuits"]},
+                                                            "tgen": obj["data"]["a"]["tgen"]}}})
+        assert_equals(util.JSONSectionReader(io.StringIO(text), chunk_size=chunk_size).load(lambda path: None), obj)
+
+def test_open_file_compression_codecs():
+    """
+    Writes a file with each available compression codec using util.open_file,
+    moves it to a file name without extension, and checks that the codec is
+    detected from the magic bytes and the contents are read back unchanged.
+    Also writes an xz file in small blocks using multiple threads.
+    """
+    work_dir = tempfile.mkdtemp()
+    contents = "".join("{0} line {0}\n".format(i) for i in range(10000))
+    codecs = ["xz", "gz"] + (["zst"] if util.zstandard is not None else [])
+    for (codec, threads) in [(codec, 1) for codec in codecs] + [("xz", 3)]:
+        compressed_path = os.path.join(work_dir, "file" + util.COMPRESSION_CODECS[codec][0])
+        with util.open_file(compressed_path, 'wt', codec=codec, level=1, threads=threads) as f:
+            f.write(contents)
+        moved_path = os.path.join(work_dir, "file.log")
+        os.replace(compressed_path, moved_path)
+        assert_equals(util.detect_compression_codec(moved_path), codec)
+        data_source = util.DataSource(moved_path)
+        assert_equals(data_source.is_seekable(), False)
+        assert_equals("".join(data_source), contents)
+    with open(os.path.join(work_dir, "file.xz"), 'wb') as f:
+        writer = util.ParallelXZWriter(f, threads=2, block_size=1000)
+        writer.write(contents.encode())
+        writer.close()
+    with lzma.open(os.path.join(work_dir, "file.xz"), 'rt') as f:
+        assert_equals(f.read(), contents)
+    plain_path = os.path.join(work_dir, "plain.xz")
+    with open(plain_path, 'wt') as f:
+        f.write(contents)
+    assert_equals(util.detect_compression_codec(plain_path), None)
+    assert_equals(util.DataSource(plain_path).is_seekable(), True)
+    shutil.rmtree(work_dir)
+
+def test_file_writable_rotate_file_codec():
+    """
+    Rotates a util.FileWritable into an xz compressed file and checks that it
+    contains what was written.
+    """
+    work_dir = tempfile.mkdtemp()
+    test_writable = util.FileWritable(os.path.join(work_dir, "logfile"), rotate_codec="xz")
+    test_writable.write("onionperf")
+    rotated_file = test_writable.rotate_file(datetime.datetime(2018, 11, 27, 0, 0, 0))
+    assert_equals(rotated_file, os.path.join(work_dir, "log_archive", "logfile_2018-11-27_00:00:00.xz"))
+    with lzma.open(rotated_file, 'rt') as f:
+        assert_equals(f.read(), "onionperf")
+    test_writable.close()
+    shutil.rmtree(work_dir)
+
+def test_file_writable_rotate_file_error():
+    """
+    Fails to rotate a util.FileWritable, because its archive path is taken by
+    a directory, and checks that the log is neither truncated nor left locked.
+    """
+    work_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(work_dir, "log_archive", "logfile_2018-11-27_00:00:00.gz"))
+    test_writable = util.FileWritable(os.path.join(work_dir, "logfile"))
+    test_writable.write("onion")
+    assert_raises(IOError, test_writable.rotate_file, datetime.datetime(2018, 11, 27, 0, 0, 0))
+    test_writable.write("perf")
+    test_writable.close()
+    with open(os.path.join(work_dir, "logfile"), 'rt') as f:
+        assert_equals(f.read(), "onionperf")
+    shutil.rmtree(work_dir)
+
+def test_mapped_line_reader():
+    """
+    Reads lines and blocks of lines from byte ranges of a file using a
+    util.MappedLineReader with a chunk size that splits lines and line
+    terminators, and compares them to the lines of the file.
+    """
+    work_dir = tempfile.mkdtemp()
+    filename = os.path.join(work_dir, "file.log")
+    contents = b"".join(b"line\n" + str(i).encode() + b"\r\n" for i in range(100)) + b"last"
+    with open(filename, 'wb') as f:
+        f.write(contents)
+    lines = [line + b"\r\n" for line in contents.split(b"\r\n")]
+    lines[-1] = b"last"
+    reader = util.MappedLineReader(filename, newline=b"\r\n", chunk_size=7)
+    assert_equals(list(reader), lines)
+    reader.close()
+    reader = util.MappedLineReader(filename, byte_ranges=[(0, 16), (len(contents) - 13, None)], newline=b"\r\n", chunk_size=7)
+    assert_equals(next(reader), lines[0])
+    assert_equals(reader.read_block(), lines[1])
+    assert_equals(reader.read_block() + reader.read_block(), lines[-2] + lines[-1])
+    assert_equals(reader.read_block(), b"")
+    reader.close()
+    data_source = util.DataSource(filename)
+    data_source.open(newline="\r\n", binary=True)
+    assert_equals(list(data_source), lines)
+    data_source.close()
+    shutil.rmtree(work_dir)
+
+def test_find_keyword_lines():
+    """
+    Finds the lines with a separator in a block of lines, and the ones in which
+    the first separator is followed by a keyword.
+    """
+    block = (b"header\r\n"
+             b"1 650 CIRC 650 BUILT\r\n"
+             b"2 650 CIRC_BW 650 CIRC\r\n"
+             b"3 650  STREAM 1\nSUCCEEDED\r\n"
+             b"4 650 CIRC_MINOR\r\n"
+             b"5 650 STREAM")
+    num_lines, lines = util.find_keyword_lines(block, b" 650 ", [b"CIRC", b"CIRC_MINOR", b"STREAM"], newline=b"\r\n")
+    assert_equals(num_lines, 5)
+    assert_equals([(index, block[start:end], block[separator_start:separator_start + 5], keyword)
+                   for (index, start, separator_start, end, keyword) in lines],
+                  [(0, b"1 650 CIRC 650 BUILT\r\n", b" 650 ", b"CIRC"),
+                   (2, b"3 650  STREAM 1\nSUCCEEDED\r\n", b" 650 ", b"STREAM"),
+                   (3, b"4 650 CIRC_MINOR\r\n", b" 650 ", b"CIRC_MINOR"),
+                   (4, b"5 650 STREAM", b" 650 ", b"STREAM")])
+    assert_equals(util.find_keyword_lines(b"header\r\n", b" 650 ", [b"CIRC"], newline=b"\r\n"), (0, []))
+
+def test_background_line_reader():
+    """
+    Reads the lines of compressed files using a util.BackgroundLineReader, both
+    with the installed decompression commands and with the decompressors of the
+    Python standard library, and checks that reading can be stopped early and
+    that errors while decompressing are raised.
+    """
+    work_dir = tempfile.mkdtemp()
+    lines = ["{0} line {0}\r\n".format(i).encode() for i in range(10000)]
+    decompression_commands = util.DECOMPRESSION_COMMANDS
+    try:
+        for commands in [decompression_commands, {}]:
+            util.DECOMPRESSION_COMMANDS = commands
+            for codec in ["xz", "gz"]:
+                filename = os.path.join(work_dir, "file.log" + util.COMPRESSION_CODECS[codec][0])
+                with util.open_file(filename, 'wb', codec=codec) as f:
+                    f.write(b"".join(lines))
+                reader = util.BackgroundLineReader(filename, codec, newline=b"\r\n", chunk_size=1000, queue_size=2)
+                assert_equals(list(reader), lines)
+                reader.close()
+                reader = util.BackgroundLineReader(filename, codec, newline=b"\r\n", chunk_size=1000, queue_size=2)
+                assert_equals(next(reader), lines[0])
+                reader.close()
+                with open(filename, 'r+b') as f:
+                    f.truncate(os.path.getsize(filename) // 2)
+                reader = util.BackgroundLineReader(filename, codec, newline=b"\r\n", chunk_size=1000, queue_size=2)
+                try:
+                    list(reader)
+                    raise AssertionError("reading a truncated {0} file did not fail".format(codec))
+                except (IOError, EOFError, lzma.LZMAError):
+                    pass
+                reader.close()
+    finally:
+        util.DECOMPRESSION_COMMANDS = decompression_commands
+    shutil.rmtree(work_dir)
+
+def test_indexed_archive():
+    """
+    Compresses a log in blocks using util.write_indexed_archive, and checks that
+    the archive is a valid xz file, that blocks only end before lines with a
+    timestamp, and that only the first block and the blocks of a time range are
+    read when a time range is set on a util.DataSource.
+    """
+    work_dir = tempfile.mkdtemp()
+    archive_path = os.path.join(work_dir, "onionperf.torctl.log.xz")
+    lines = []
+    for i in range(1000):
+        lines.append("2020-01-01 00:00:00 {0}.5 650 STREAM {0} NEW\r\n".format(1577836800 + i).encode())
+        lines.append("2020-01-01 00:00:00 {0}.5 650+NS\n continued\r\n".format(1577836800 + i).encode())
+    with open(os.path.join(work_dir, "onionperf.torctl.log"), "wb") as f:
+        f.write(b"".join(lines))
+    with open(os.path.join(work_dir, "onionperf.torctl.log"), "rb") as f:
+        util.write_indexed_archive(f, archive_path, codec="xz", block_size=1000)
+    with lzma.open(archive_path, "rb") as f:
+        assert_equals(f.read(), b"".join(lines))
+    index = util.read_time_index(archive_path)
+    assert_equals(index["codec"], "xz")
+    assert(len(index["blocks"]) > 10)
+    line_starts = set()
+    offset = 0
+    for line in lines:
+        line_starts.add(offset)
+        offset += len(line)
+    for block in index["blocks"]:
+        assert(block["uncompressed_offset"] in line_starts)
+        assert(block["first_ts"] <= block["last_ts"])
+    assert_equals(util.DataSource(archive_path).has_time_index(), True)
+    data_source = util.DataSource(archive_path)
+    data_source.set_time_range(1577837000, 1577837010)
+    data_source.open(newline="\r\n")
+    read_lines = list(data_source)
+    data_source.close()
+    for line in lines[400:420]:
+        assert(line.decode() in read_lines)
+    assert_equals(read_lines[0], lines[0].decode())
+    assert(len(read_lines) < 100)
+    shutil.rmtree(work_dir)
+
+def test_file_writable_rotate_file_indexed():
+    """
+    Rotates a util.FileWritable into an archive with a time index.
+    """
+    work_dir = tempfile.mkdtemp()
+    test_writable = util.FileWritable(os.path.join(work_dir, "logfile"), rotate_codec="xz", rotate_block_size=10)
+    test_writable.write("2018-11-26 23:59:59 1543276799.0 onionperf\n2018-11-26 23:59:59 1543276799.5 onionperf\n")
+    rotated_file = test_writable.rotate_file(datetime.datetime(2018, 11, 27, 0, 0, 0))
+    test_writable.close()
+    assert_equals(len(util.read_time_index(rotated_file)["blocks"]), 2)
+    with lzma.open(rotated_file, 'rt') as f:
+        assert_equals(f.read(), "2018-11-26 23:59:59 1543276799.0 onionperf\n2018-11-26 23:59:59 1543276799.5 onionperf\n")
+    shutil.rmtree(work_dir)
+
+def test_file_writable_rotate_file_indexed_round_trip():
+    """
+    Checks that a util.FileWritable with an indexed archive only truncates the
+    log after all of it was archived, and that it rejects empty blocks.
+    """
+    work_dir = tempfile.mkdtemp()
+    assert_raises(ValueError, util.FileWritable, os.path.join(work_dir, "logfile"), rotate_block_size=0)
+    with open(os.path.join(work_dir, "logfile"), "wb") as f:
+        assert_raises(ValueError, util.write_indexed_archive, f, os.path.join(work_dir, "archive.xz"), block_size=0)
+    test_writable = util.FileWritable(os.path.join(work_dir, "logfile"), rotate_codec="xz", rotate_block_size=100)
+    lines = "".join("2018-11-26 23:59:59 {0}.0 onionperf line {0}\n".format(1543276000 + i) for i in range(100))
+    test_writable.write(lines)
+    test_writable.close()
+    assert_equals(os.path.getsize(os.path.join(work_dir, "logfile")), len(lines))
+    rotated_file = test_writable.rotate_file(datetime.datetime(2018, 11, 27, 0, 0, 0))
+    test_writable.close()
+    with lzma.open(rotated_file, 'rt') as f:
+        assert_equals(f.read(), lines)
+    assert_equals(sum(block["uncompressed_size"] for block in util.read_time_index(rotated_file)["blocks"]), len(lines))
+    assert_equals(os.path.getsize(os.path.join(work_dir, "logfile")), 0)
+    shutil.rmtree(work_dir)
+
+def test_find_log_time_range():
+    """
+    Finds the timestamps of the first and last lines of an uncompressed log, of
+    the same log compressed without and with a time index, and of a log without
+    any timestamps.
+    """
+    work_dir = tempfile.mkdtemp()
+    log_path = os.path.join(work_dir, "onionperf.torctl.log")
+    lines = [b"header line without timestamp\r\n"]
+    for i in range(10000):
+        lines.append("2020-01-01 00:00:00 {0}.5 650 STREAM {0} NEW\r\n".format(1577836800 + i).encode())
+    lines.append(b" continued line of a multi-line event\r\n" * 5000)
+    with open(log_path, "wb") as f:
+        f.write(b"".join(lines))
+    assert_equals(util.find_log_time_range(log_path, block_size=100), (1577836800.5, 1577846799.5))
+    with open(log_path + ".gz", "wb") as f:
+        f.write(util.compress_block(b"".join(lines), "gz"))
+    assert_equals(util.find_log_time_range(log_path + ".gz"), (1577836800.5, 1577846799.5))
+    with open(log_path, "rb") as f:
+        util.write_indexed_archive(f, log_path + ".xz", block_size=10000)
+    assert_equals(util.find_log_time_range(log_path + ".xz"), (1577836800.5, 1577846799.5))
+    with open(log_path, "wb") as f:
+        f.write(b"no timestamps\n")
+    assert_equals(util.find_log_time_range(log_path), None)
+    shutil.rmtree(work_dir)
+
@@ -5,13 +5,60 @@
   See LICENSE for licensing information
 '''
 
-import sys, os, socket, logging, random, re, shutil, datetime, urllib.request, urllib.parse, urllib.error, gzip, lzma
-from threading import Lock
+import sys, os, io, mmap, queue, socket, subprocess, logging, random, re, shutil, datetime, calendar, urllib.request, urllib.parse, urllib.error, gzip, lzma, json, gc
+from threading import Lock, Thread, Event
 from io import StringIO
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compression codecs by name, with the extension of their files and the magic
+# bytes at the start of them
+COMPRESSION_CODECS = {
+    'xz': ('.xz', b'\xfd7zXZ\x00'),
+    'gz': ('.gz', b'\x1f\x8b'),
+    'zst': ('.zst', b'\x28\xb5\x2f\xfd'),
+}
+
+# external commands that decompress a file given as last argument to stdout,
+# preferring those that can use multiple threads
+DECOMPRESSION_COMMANDS = {
+    'xz': [['xz', '--decompress', '--stdout', '--threads=0']],
+    'gz': [['pigz', '--decompress', '--stdout'], ['gzip', '--decompress', '--stdout']],
+    'zst': [['zstd', '--decompress', '--stdout', '--quiet']],
+}
+
+# the library used to decode and encode analysis results, see set_json_backend
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+
+# orjson output that differs from json output: NaN and Infinity written as null,
+# floats formatted without exponent or with a shorter one, and non-ASCII characters
+ORJSON_MISMATCH_PATTERN = re.compile(rb'null|0\.0000|\de|[^\x00-\x7e]')
 
 LINEFORMATS = "k-,r-,b-,g-,c-,m-,y-,k--,r--,b--,g--,c--,m--,y--,k:,r:,b:,g:,c:,m:,y:,k-.,r-.,b-.,g-.,c-.,m-.,y-."
 
+# log lines written by onionperf and tgen start with a date, a time, and a unix timestamp
+LOG_TIMESTAMP_PATTERN = re.compile(rb'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} (\d+(?:\.\d*)?)\s')
+# matches timestamps at the start of any line of a block of lines
+LOG_TIMESTAMP_LINE_PATTERN = re.compile(LOG_TIMESTAMP_PATTERN.pattern, re.MULTILINE)
+# matches the newline before a line that starts with a timestamp
+LOG_LINE_START_PATTERN = re.compile(rb'\n(?=\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} \d)')
+
+# extension of the index files written next to archives compressed in blocks
+TIME_INDEX_EXTENSION = '.idx'
+
 def make_dir_path(path):
     p = os.path.abspath(os.path.expanduser(path))
     if not os.path.exists(p):
@@ -113,6 +160,220 @@ def do_dates_match(date1, date2):
     else:
         return False
 
+def date_to_timestamp_range(date_object):
+    """
+    Returns the range of unix timestamps [start, end) covering the given UTC
+    date, so that lines can be filtered without building date objects.
+
+    :param date_object: datetime.date or datetime.datetime
+    :returns: tuple of int
+    """
+    start = calendar.timegm((date_object.year, date_object.month, date_object.day, 0, 0, 0))
+    return (start, start + 86400)
+
+def find_timestamp_offset(filename, unix_ts, newline='\n'):
+    """
+    Uses binary search to find the byte offset of the first line in the
+    uncompressed, time-ordered log file at filename with a timestamp of at
+    least unix_ts. Lines are terminated by newline; physical lines that do
+    not end in newline belong to the following line, and lines without a
+    timestamp (like the continuation lines of multi-line Tor control events)
+    are skipped. If there is no such line, the file size is returned.
+
+    :param filename: string
+    :param unix_ts: float
+    :param newline: string
+    :returns: int
+    """
+    newline = newline.encode()
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+
+        def find_next_line(offset):
+            # move to the start of the first line at or after offset
+            f.seek(max(offset - len(newline), 0))
+            if offset > 0:
+                physical_line = f.readline()
+                while physical_line != b'' and not physical_line.endswith(newline):
+                    physical_line = f.readline()
+            # return the first line that has a timestamp
+            while True:
+                line_offset = f.tell()
+                physical_line = line = f.readline()
+                while physical_line != b'' and not physical_line.endswith(newline):
+                    physical_line = f.readline()
+                if line == b'':
+                    return (size, size, None)
+                match = LOG_TIMESTAMP_PATTERN.match(line)
+                if match is not None:
+                    return (line_offset, f.tell(), float(match.group(1)))
+
+        low, high = 0, size
+        while low < high:
+            middle = (low + high) // 2
+            line_offset, next_offset, line_ts = find_next_line(middle)
+            if line_ts is not None and line_ts < unix_ts:
+                low = next_offset
+            else:
+                high = middle
+        return find_next_line(low)[0]
+
+def split_byte_range(filename, start, end, num_parts, newline='\n'):
+    """
+    Splits the byte range [start, end) of the uncompressed log file at filename
+    into at most num_parts consecutive ranges of roughly equal size, each of
+    which starts at the beginning of a line. Physical lines that do not end in
+    newline belong to the following line, so a range never starts in the middle
+    of a multi-line Tor control event.
+
+    :param filename: string
+    :param start: int
+    :param end: int
+    :param num_parts: int
+    :param newline: string
+    :returns: list of (int, int) tuples
+    """
+    if start >= end:
+        return []
+    newline = newline.encode()
+    offsets = [start]
+    with open(filename, 'rb') as f:
+        for i in range(1, num_parts):
+            # move to the start of the first line at or after the split point
+            f.seek(max(start + (end - start) * i // num_parts - len(newline), offsets[-1]))
+            physical_line = f.readline()
+            while physical_line != b'' and not physical_line.endswith(newline):
+                physical_line = f.readline()
+            offset = f.tell()
+            if offsets[-1] < offset < end:
+                offsets.append(offset)
+    offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def find_last_line_end(filename, newline='\n'):
+    """
+    Returns the byte offset right after the last newline in the uncompressed
+    file at filename, so that a log file that is still being written can be
+    read without its last, incomplete line.
+
+    :param filename: string
+    :param newline: string
+    :returns: int
+    """
+    newline = newline.encode()
+    with open(filename, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        while end > 0:
+            start = max(end - 65536, 0)
+            f.seek(start)
+            # overlap with the previous block in case it starts inside a newline
+            block = f.read(end - start + len(newline) - 1)
+            index = block.rfind(newline)
+            if index >= 0:
+                return start + index + len(newline)
+            end = start
+    return 0
+
+def set_json_backend(name):
+    '''
+    Selects the library used by json_loads and write_json, either 'orjson' if it
+    is installed, or 'json' from the standard library, and returns the name of
+    the previously selected one.
+    '''
+    global JSON_BACKEND
+    if name not in ['orjson', 'json'] or (name == 'orjson' and orjson is None):
+        raise ValueError("JSON backend '{0}' is not available".format(name))
+    previous_name, JSON_BACKEND = JSON_BACKEND, name
+    return previous_name
+
+def json_loads(s):
+    '''
+    Decodes a JSON document given as str or bytes using the selected backend,
+    with the same result as json.loads. The garbage collector is paused while
+    decoding, because it would otherwise scan the growing result over and over
+    although decoded JSON never contains reference cycles.
+    '''
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if JSON_BACKEND == 'orjson':
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                # orjson rejects NaN, Infinity, and integers beyond 64 bits
+                pass
+        return json.loads(s)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def json_dumps(obj, sort_keys=True, compact=False):
+    '''
+    Encodes obj to JSON using the selected backend, with the same result as
+    json.dumps with indent=2, or without any whitespace if compact is set.
+    '''
+    if JSON_BACKEND == 'orjson':
+        option = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if not compact:
+            option |= orjson.OPT_INDENT_2
+        try:
+            encoded = orjson.dumps(obj, option=option)
+            if ORJSON_MISMATCH_PATTERN.search(encoded) is None:
+                return encoded.decode()
+        except TypeError:
+            # orjson only accepts str keys and integers up to 64 bits
+            pass
+    if compact:
+        return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':'))
+    return json.dumps(obj, sort_keys=sort_keys, separators=(',', ': '), indent=2)
+
+def write_json(writable, obj, sort_keys=True, compact=False, max_depth=5, buffer_size=1048576):
+    '''
+    Writes obj as JSON to writable in the same way as json.dump with indent=2,
+    or without any whitespace if compact is set. Nested dicts up to max_depth
+    levels deep are encoded one item at a time and everything below with one
+    json_dumps call per item, and the output is written in chunks of about
+    buffer_size characters, so that the whole document is never held in memory.
+    '''
+    indent, separators = (None, (',', ':')) if compact else (2, (',', ': '))
+
+    def encode_key(key):
+        if isinstance(key, str):
+            return key
+        elif isinstance(key, bool) or key is None or isinstance(key, float):
+            return json.dumps(key)
+        elif isinstance(key, int):
+            return int.__repr__(key)
+        raise TypeError("keys must be str, int, float, bool or None, not {0}".format(key.__class__.__name__))
+
+    def encode(value, level):
+        if not isinstance(value, dict) or len(value) == 0 or level >= max_depth:
+            chunk = json_dumps(value, sort_keys=sort_keys, compact=compact)
+            if indent is not None and level > 0:
+                chunk = chunk.replace('\n', '\n' + ' ' * (indent * level))
+            yield chunk
+            return
+        item_prefix = '\n' + ' ' * (indent * (level + 1)) if indent is not None else ''
+        items = sorted(value.items()) if sort_keys else value.items()
+        separator = '{'
+        for (key, item) in items:
+            yield separator + item_prefix + json.encoder.encode_basestring_ascii(encode_key(key)) + separators[1]
+            separator = separators[0]
+            yield from encode(item, level + 1)
+        yield '\n' + ' ' * (indent * level) + '}' if indent is not None else '}'
+
+    chunks, size = [], 0
+    for chunk in encode(obj, 0):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            writable.write(''.join(chunks))
+            chunks, size = [], 0
+    if len(chunks) > 0:
+        writable.write(''.join(chunks))
+
 def find_ip_address_url(data):
     """
     Parses a string using a regular expression for identifying IPv4 addressses.
@@ -190,32 +451,822 @@ def get_random_free_port():
         if rc != 0: # error connecting, port is available
             return port
 
+class ByteRangeReader(io.RawIOBase):
+    """
+    Reads the given (start, end) byte ranges of a binary file object one after
+    another, as if they were a single file. Compressed files are seeked by
+    decompressing, and an end of None reads to the end of the file.
+    """
+
+    def __init__(self, file, byte_ranges):
+        self.file = file
+        self.byte_ranges = [(start, end) for (start, end) in byte_ranges if end is None or start < end]
+        self.remaining = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.remaining <= 0:
+            if len(self.byte_ranges) == 0:
+                return 0
+            start, end = self.byte_ranges.pop(0)
+            self.file.seek(start)
+            self.remaining = (end if end is not None else sys.maxsize) - start
+        num_bytes = self.file.readinto(memoryview(buffer)[:min(len(buffer), self.remaining)])
+        if num_bytes == 0:
+            # the file is shorter than expected
+            self.remaining, self.byte_ranges = 0, []
+        self.remaining -= num_bytes
+        return num_bytes
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+class ByteLineReader(object):
+    """
+    Reads the lines of a binary file object as bytes, keeping their line
+    terminators, without decoding them or translating newlines. The file is read
+    in large blocks of whole lines, which callers can also take as a whole using
+    read_block to search many lines at once instead of iterating over them.
+    """
+
+    def __init__(self, file, newline=b'\n', chunk_size=8388608):
+        self.file = file
+        self.newline = newline
+        self.chunk_size = chunk_size
+        self.blocks = None
+        self.block, self.offset = b'', 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.offset >= len(self.block):
+            self.block, self.offset = self.read_block(), 0
+            if not self.block:
+                raise StopIteration
+        end = self.block.find(self.newline, self.offset)
+        end = end + len(self.newline) if end >= 0 else len(self.block)
+        line = self.block[self.offset:end]
+        self.offset = end
+        return line
+
+    def read_block(self):
+        '''
+        Returns the lines of the current block that were not read yet, or else the
+        next block of whole lines, as one bytes object, or b'' at the end of the
+        file. Only the last line of a file may lack a line terminator.
+        '''
+        if self.offset < len(self.block):
+            block = self.block[self.offset:]
+            self.block, self.offset = b'', 0
+            return block
+        if self.blocks is None:
+            self.blocks = self.__iter_blocks()
+        return next(self.blocks, b'')
+
+    def iter_chunks(self):
+        while True:
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __iter_blocks(self):
+        rest = b''
+        for chunk in self.iter_chunks():
+            block = rest + chunk
+            # keep the beginning of a line that continues in the next chunk
+            end = block.rfind(self.newline)
+            if end < 0:
+                rest = block
+            else:
+                end += len(self.newline)
+                rest = block[end:]
+                yield block[:end]
+        if rest:
+            yield rest
+
+    def close(self):
+        if self.blocks is not None:
+            self.blocks.close()
+        self.file.close()
+
+class MappedLineReader(ByteLineReader):
+    """
+    Reads the lines of the given (start, end) byte ranges of an uncompressed file
+    as bytes, like ByteLineReader, but takes the chunks from a memory map of the
+    file instead of reading them. An end of None reads to the end of the file.
+    """
+
+    def __init__(self, filename, byte_ranges=None, newline=b'\n', chunk_size=8388608):
+        super().__init__(open(filename, 'rb'), newline=newline, chunk_size=chunk_size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        # empty files cannot be mapped
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else None
+        self.byte_ranges = byte_ranges if byte_ranges is not None else [(0, None)]
+
+    def iter_chunks(self):
+        for (start, end) in self.byte_ranges:
+            end = min(end, self.size) if end is not None else self.size
+            while start < end:
+                chunk_end = min(start + self.chunk_size, end)
+                yield self.map[start:chunk_end]
+                start = chunk_end
+
+    def close(self):
+        super().close()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+class BackgroundLineReader(ByteLineReader):
+    """
+    Reads the lines of a compressed file as bytes, like ByteLineReader, while
+    the file is decompressed in the background and handed on in chunks over a
+    bounded queue, so that decompressing and parsing overlap. The file is
+    decompressed by an external command from DECOMPRESSION_COMMANDS, which may
+    use multiple threads, or by open_file in a helper thread if no such command
+    is installed.
+    """
+
+    def __init__(self, filename, codec, newline=b'\n', chunk_size=8388608, queue_size=4):
+        self.filename = filename
+        self.process = None
+        command = find_decompression_command(codec)
+        if command is not None:
+            self.process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            file = self.process.stdout
+        else:
+            file = open_file(filename, 'rb', codec=codec)
+        super().__init__(file, newline=newline, chunk_size=chunk_size)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = Event()
+        self.helper = Thread(target=self.__read_chunks, name="decompress_{0}".format(os.path.basename(filename)), daemon=True)
+        self.helper.start()
+
+    def __read_chunks(self):
+        # hand on chunks, and then None or the exception that ended reading
+        try:
+            for chunk in super().iter_chunks():
+                if not self.__put(chunk):
+                    return
+            self.__put(None)
+        except Exception as e:
+            self.__put(e)
+
+    def __put(self, item):
+        # wait for space in the queue unless the reader was closed early
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def iter_chunks(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+        if self.process is not None and self.process.wait() != 0:
+            raise IOError("'{0}' exited with status {1} while decompressing {2}".format(
+                self.process.args[0], self.process.returncode, self.filename))
+
+    def close(self):
+        self.stopped.set()
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+        self.helper.join()
+        super().close()
+        if self.process is not None:
+            self.process.wait()
+
+def find_decompression_command(codec):
+    '''
+    Returns the first of the DECOMPRESSION_COMMANDS of the given codec that is
+    installed, or None.
+    '''
+    for command in DECOMPRESSION_COMMANDS.get(codec, []):
+        if shutil.which(command[0]) is not None:
+            return command
+    return None
+
+# bytes that bytes.split() treats as whitespace
+IS_WHITESPACE_BYTE = np.isin(np.arange(256), list(b' \t\n\r\x0b\x0c'))
+
+def find_bytes(data, pattern):
+    '''
+    Returns the sorted offsets of all occurrences of the bytes pattern in the
+    bytes data. Up to four leading bytes of the pattern are compared at once by
+    viewing data as unsigned integers at each alignment, and the other bytes
+    only at the offsets that are left.
+    '''
+    width = 4 if len(pattern) >= 4 else 2 if len(pattern) >= 2 else 1
+    dtype = np.dtype('<u{0}'.format(width))
+    head = np.frombuffer(pattern[:width], dtype=dtype)[0]
+    offsets = [np.zeros(0, dtype=np.int64)]
+    for alignment in range(min(width, len(data))):
+        words = np.frombuffer(data, dtype=dtype, count=(len(data) - alignment) // width, offset=alignment)
+        offsets.append(np.flatnonzero(words == head) * width + alignment)
+    offsets = np.sort(np.concatenate(offsets))
+    offsets = offsets[offsets <= len(data) - len(pattern)]
+    data = np.frombuffer(data, dtype=np.uint8)
+    for (i, byte) in enumerate(pattern[width:], width):
+        offsets = offsets[data[offsets + i] == byte]
+    return offsets
+
+def find_keyword_lines(block, separator, keywords, newline=b'\n'):
+    '''
+    Searches a block of lines for the lines that contain the separator, using
+    NumPy rather than iterating over lines. Returns the number of lines that
+    contain the separator, and a list of (index, line_start, separator_start,
+    line_end, keyword) tuples for those lines in which the first occurrence of
+    the separator is followed by the first word keyword, which is one of the
+    given bytes keywords. The index counts the lines with a separator that come
+    before the line, and line_end includes the line terminator.
+    '''
+    separator_starts = find_bytes(block, separator)
+    if len(separator_starts) == 0:
+        return 0, []
+    newline_starts = find_bytes(block, newline)
+
+    # only the first separator of each line counts
+    line_numbers = np.searchsorted(newline_starts, separator_starts)
+    is_first = np.ones(len(separator_starts), dtype=bool)
+    is_first[1:] = line_numbers[1:] != line_numbers[:-1]
+    separator_starts, line_numbers = separator_starts[is_first], line_numbers[is_first]
+
+    # compare the bytes after each separator to the keywords, treating the end
+    # of the block like whitespace
+    width = max(len(keyword) for keyword in keywords) + 1
+    padded = np.concatenate((np.frombuffer(block, dtype=np.uint8), np.full(width, ord(' '), dtype=np.uint8)))
+    word_starts = separator_starts + len(separator)
+    keyword_indexes = np.full(len(separator_starts), -1)
+    for (i, keyword) in enumerate(keywords):
+        matches = np.flatnonzero(padded[word_starts] == keyword[0])
+        for (j, byte) in enumerate(keyword[1:], 1):
+            matches = matches[padded[word_starts[matches] + j] == byte]
+        matches = matches[IS_WHITESPACE_BYTE[padded[word_starts[matches] + len(keyword)]]]
+        keyword_indexes[matches] = i
+    # words after leading whitespace are rare and compared one by one below
+    candidates = np.flatnonzero((keyword_indexes >= 0) | IS_WHITESPACE_BYTE[padded[word_starts]])
+
+    line_ends = np.append(newline_starts + len(newline), len(block))
+    line_starts = np.insert(line_ends[:-1], 0, 0)
+    results = []
+    for (index, line_start, separator_start, line_end, keyword_index) in zip(
+            candidates.tolist(), line_starts[line_numbers[candidates]].tolist(), separator_starts[candidates].tolist(),
+            line_ends[line_numbers[candidates]].tolist(), keyword_indexes[candidates].tolist()):
+        if keyword_index >= 0:
+            keyword = keywords[keyword_index]
+        else:
+            words = block[separator_start + len(separator):line_end].split(None, 1)
+            if not words or words[0] not in keywords:
+                continue
+            keyword = words[0]
+        results.append((index, line_start, separator_start, line_end, keyword))
+    return len(separator_starts), results
+
+def get_compression_codec(filename):
+    '''
+    Returns the name of the compression codec that belongs to the extension of
+    the given file name, or None if it does not end in a known extension.
+    '''
+    for (codec, (extension, magic)) in COMPRESSION_CODECS.items():
+        if filename.endswith(extension):
+            return codec
+    return None
+
+def detect_compression_codec(filename):
+    '''
+    Returns the name of the compression codec of a file from the magic bytes at
+    its start, or None if it is not compressed or cannot be read.
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(6)
+    except OSError:
+        return None
+    for (codec, (extension, magic)) in COMPRESSION_CODECS.items():
+        if header.startswith(magic):
+            return codec
+    return None
+
+def open_file(filename, mode='rb', codec=None, level=None, threads=1, newline=None):
+    '''
+    Opens a file that may be compressed in binary or text mode. Files opened for
+    reading are decompressed with the codec detected from their first bytes.
+    Files opened for writing or appending are compressed with the given codec,
+    if any, at the given level, or the default level of the codec if None, and
+    using the given number of threads where the codec supports that.
+    '''
+    is_text = 't' in mode
+    binary_mode = mode.replace('t', '').replace('b', '') + 'b'
+    is_reading = binary_mode.startswith('r')
+    if is_reading:
+        codec = detect_compression_codec(filename)
+
+    if codec is None:
+        return open(filename, mode, newline=newline) if is_text else open(filename, binary_mode)
+    elif codec == 'xz':
+        if is_reading or threads <= 1:
+            f = lzma.open(filename, binary_mode, preset=None if is_reading else level)
+        else:
+            f = ParallelXZWriter(open(filename, binary_mode), preset=level, threads=threads)
+    elif codec == 'gz':
+        f = gzip.open(filename, binary_mode, compresslevel=9 if level is None else level)
+    elif codec == 'zst':
+        if zstandard is None:
+            raise ValueError("reading or writing zstd compressed file '{0}' requires the zstandard module".format(filename))
+        if is_reading:
+            f = zstandard.ZstdDecompressor().stream_reader(open(filename, binary_mode), read_across_frames=True, closefd=True)
+        else:
+            compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads if threads > 1 else 0)
+            f = compressor.stream_writer(open(filename, binary_mode), closefd=True)
+    else:
+        raise ValueError("unknown compression codec '{0}'".format(codec))
+    return io.TextIOWrapper(f, newline=newline) if is_text else f
+
+class ParallelXZWriter(io.BufferedIOBase):
+    '''
+    Compresses the data written to it in blocks using multiple threads, and
+    writes each block to the given file as a separate xz stream, like xz -T does.
+    Files with multiple streams are decompressed like files with a single one.
+    '''
+
+    # three times the dictionary size of the default preset, like xz -T
+    BLOCK_SIZE = 24 * 1024 * 1024
+
+    def __init__(self, file, preset=None, threads=2, block_size=BLOCK_SIZE):
+        self.file = file
+        self.preset = preset
+        self.block_size = block_size
+        self.block = bytearray()
+        self.num_blocks = 0
+        self.max_pending_blocks = 2 * threads
+        self.pending_blocks = deque()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.block += data
+        while len(self.block) >= self.block_size:
+            self.__submit_block(bytes(self.block[:self.block_size]))
+            del self.block[:self.block_size]
+        return len(data)
+
+    def __submit_block(self, block):
+        # lzma releases the GIL while compressing, so blocks are compressed in parallel
+        self.pending_blocks.append(self.executor.submit(lzma.compress, block, preset=self.preset))
+        self.num_blocks += 1
+        while len(self.pending_blocks) > self.max_pending_blocks:
+            self.file.write(self.pending_blocks.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            if len(self.block) > 0 or self.num_blocks == 0:
+                self.__submit_block(bytes(self.block))
+                self.block = bytearray()
+            while len(self.pending_blocks) > 0:
+                self.file.write(self.pending_blocks.popleft().result())
+            self.executor.shutdown()
+            self.file.close()
+        super().close()
+
+def compress_block(data, codec, level=None):
+    '''
+    Compresses data as a single stream of the given codec, which can be
+    decompressed on its own or as part of a file with multiple streams.
+    '''
+    if codec == 'xz':
+        return lzma.compress(data, preset=level)
+    elif codec == 'gz':
+        return gzip.compress(data, compresslevel=9 if level is None else level)
+    elif codec == 'zst':
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard module")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise ValueError("unknown compression codec '{0}'".format(codec))
+
+def decompress_block(data, codec):
+    if codec == 'xz':
+        return lzma.decompress(data)
+    elif codec == 'gz':
+        return gzip.decompress(data)
+    elif codec == 'zst':
+        if zstandard is None:
+            raise ValueError("zstd decompression requires the zstandard module")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("unknown compression codec '{0}'".format(codec))
+
+def find_last_log_timestamp(block):
+    # look at lines from the end of the block until one starts with a timestamp
+    end = len(block)
+    while end > 0:
+        start = block.rfind(b'\n', 0, end - 1) + 1
+        match = LOG_TIMESTAMP_LINE_PATTERN.match(block, start)
+        if match is not None:
+            return float(match.group(1))
+        end = start
+    return None
+
+def find_log_time_range(filename, block_size=65536):
+    '''
+    Returns the unix timestamps of the first and last lines of the log file at
+    filename that start with a timestamp, or None if there are no such lines.
+    Indexed archives are looked up in their time index, and uncompressed files
+    are only read at their start and end, whereas other compressed files need
+    to be decompressed completely.
+    '''
+    index = read_time_index(filename)
+    if index is not None:
+        blocks = [block for block in index['blocks'] if block['first_ts'] is not None]
+        return (blocks[0]['first_ts'], blocks[-1]['last_ts']) if len(blocks) > 0 else None
+    first_ts, last_ts = None, None
+    if detect_compression_codec(filename) is None:
+        with open(filename, 'rb') as f:
+            for line in f:
+                match = LOG_TIMESTAMP_PATTERN.match(line)
+                if match is not None:
+                    first_ts = float(match.group(1))
+                    break
+            if first_ts is None:
+                return None
+            # read ever larger blocks from the end until one contains a line start
+            size, tail_size = os.fstat(f.fileno()).st_size, block_size
+            while last_ts is None:
+                start = max(size - tail_size, 0)
+                f.seek(start)
+                block = f.read(size - start)
+                if start > 0:
+                    block = block[block.find(b'\n') + 1:]
+                last_ts = find_last_log_timestamp(block)
+                tail_size *= 2
+    else:
+        reader = ByteLineReader(open_file(filename, 'rb'))
+        try:
+            for block in iter(reader.read_block, b''):
+                if first_ts is None:
+                    match = LOG_TIMESTAMP_LINE_PATTERN.search(block)
+                    first_ts = float(match.group(1)) if match is not None else None
+                block_last_ts = find_last_log_timestamp(block)
+                last_ts = block_last_ts if block_last_ts is not None else last_ts
+        finally:
+            reader.close()
+        if first_ts is None:
+            return None
+    return (first_ts, last_ts)
+
+def write_indexed_archive(f_in, filename, codec='xz', level=None, block_size=1048576):
+    '''
+    Compresses the log read from the binary file object f_in to filename in
+    blocks of at least block_size uncompressed bytes that are compressed
+    independently of each other, so that the result is also a valid file with
+    multiple streams. Blocks only end before lines that start with a timestamp.
+    The blocks are listed in an index written next to filename, with their
+    offset and size in filename, in the uncompressed log, and the unix
+    timestamps of their first and last lines, if any. Returns the number of
+    uncompressed bytes that were archived.
+    '''
+    if block_size <= 0:
+        raise ValueError("block size must be positive, not {0}".format(block_size))
+    blocks = []
+    uncompressed_offset = 0
+    with open(filename, 'wb') as f_out:
+        def write_block(block):
+            nonlocal uncompressed_offset
+            compressed = compress_block(block, codec, level)
+            first_match = LOG_TIMESTAMP_LINE_PATTERN.search(block)
+            blocks.append({'offset': f_out.tell(), 'size': len(compressed),
+                           'uncompressed_offset': uncompressed_offset, 'uncompressed_size': len(block),
+                           'first_ts': float(first_match.group(1)) if first_match is not None else None,
+                           'last_ts': find_last_log_timestamp(block) if first_match is not None else None})
+            f_out.write(compressed)
+            uncompressed_offset += len(block)
+
+        pending = b''
+        for chunk in iter(lambda: f_in.read(block_size), b''):
+            pending += chunk
+            match = LOG_LINE_START_PATTERN.search(pending, block_size - 1)
+            while match is not None:
+                write_block(pending[:match.end()])
+                pending = pending[match.end():]
+                match = LOG_LINE_START_PATTERN.search(pending, block_size - 1)
+        if len(pending) > 0 or len(blocks) == 0:
+            write_block(pending)
+    with open(filename + TIME_INDEX_EXTENSION, 'wt') as f_index:
+        json.dump({'codec': codec, 'blocks': blocks}, f_index, indent=1)
+    return uncompressed_offset
+
+def read_time_index(filename):
+    '''
+    Returns the index written next to a log archive by write_indexed_archive, or
+    None if there is no readable index.
+    '''
+    try:
+        with open(filename + TIME_INDEX_EXTENSION, 'rt') as f_index:
+            return json.load(f_index)
+    except (OSError, ValueError):
+        return None
+
+def select_indexed_blocks(blocks, start_ts, end_ts):
+    '''
+    Returns the blocks of a time index that may contain lines with a timestamp
+    of at least start_ts and less than end_ts, assuming that lines are ordered
+    by time, plus the first block, which contains the header lines of the log.
+    '''
+    return [block for (i, block) in enumerate(blocks) if i == 0 or block['first_ts'] is None or
+            (block['last_ts'] >= start_ts and block['first_ts'] < end_ts)]
+
+class IndexedArchiveReader(io.RawIOBase):
+    """
+    Reads the given blocks of an archive written by write_indexed_archive one
+    after another, as if they were a single file, decompressing only those.
+    """
+
+    def __init__(self, filename, codec, blocks):
+        self.file = open(filename, 'rb')
+        self.codec = codec
+        self.blocks = deque(blocks)
+        self.data, self.offset = b'', 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.data):
+            if len(self.blocks) == 0:
+                return 0
+            block = self.blocks.popleft()
+            self.file.seek(block['offset'])
+            self.data, self.offset = decompress_block(self.file.read(block['size']), self.codec), 0
+        num_bytes = min(len(buffer), len(self.data) - self.offset)
+        buffer[:num_bytes] = self.data[self.offset:self.offset + num_bytes]
+        self.offset += num_bytes
+        return num_bytes
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+class JSONSectionReader(object):
+    '''
+    Incrementally reads a JSON document from a text file handle and decodes only
+    the parts of it that are selected, skipping all other objects and arrays
+    without turning them into Python objects. Only the text of the value that
+    is currently decoded, or of one chunk, is held in memory at a time.
+    '''
+
+    WHITESPACE_PATTERN = re.compile(r'[ \t\n\r]*')
+    SCALAR_END_PATTERN = re.compile(r'[^,:\]}\s]*')
+    SPECIAL_CHAR_PATTERN = re.compile(r'["\\\[\]{}]')
+    # which bytes are quotes or brackets, and how brackets change the nesting depth
+    IS_SPECIAL_BYTE = np.isin(np.arange(256), [34, 91, 93, 123, 125])
+    BYTE_DEPTH_DELTAS = np.isin(np.arange(256), [91, 123]).astype(np.int32) - np.isin(np.arange(256), [93, 125])
+
+    def __init__(self, f, chunk_size=1048576):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.is_eof = False
+
+    def load(self, select):
+        '''
+        Reads the document and returns its contents. select is called with the
+        tuple of keys leading to each object or array, starting with the empty
+        tuple for the document itself, and returns True to decode it, False to
+        skip it, or None to select among the items of an object one by one.
+        Values that are neither objects nor arrays are always decoded.
+        '''
+        (is_selected, value) = self.__read_value((), select)
+        self.__skip_whitespace()
+        if self.pos < len(self.buf):
+            raise ValueError("extra data after JSON document at offset {0}".format(self.pos))
+        return value
+
+    def __fill(self, keep_from=None):
+        # drop the text before keep_from, or before the current position, and read another chunk
+        keep_from = self.pos if keep_from is None else keep_from
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.is_eof = True
+        self.buf = self.buf[keep_from:] + chunk
+        self.pos -= keep_from
+
+    def __skip_whitespace(self):
+        while True:
+            self.pos = JSONSectionReader.WHITESPACE_PATTERN.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.is_eof:
+                return
+            self.__fill()
+
+    def __peek(self):
+        self.__skip_whitespace()
+        if self.pos >= len(self.buf):
+            raise ValueError("unexpected end of JSON document")
+        return self.buf[self.pos]
+
+    def __expect(self, char):
+        if self.__peek() != char:
+            raise ValueError("expected '{0}' at offset {1}".format(char, self.pos))
+        self.pos += 1
+
+    def __read_string(self):
+        while True:
+            try:
+                (string, self.pos) = json.decoder.scanstring(self.buf, self.pos + 1)
+                return string
+            except json.JSONDecodeError:
+                if self.is_eof:
+                    raise
+                self.__fill()
+
+    def __read_scalar(self):
+        if self.buf[self.pos] == '"':
+            return self.__read_string()
+        while True:
+            end = JSONSectionReader.SCALAR_END_PATTERN.match(self.buf, self.pos).end()
+            if end < len(self.buf) or self.is_eof:
+                break
+            self.__fill()
+        value = json.loads(self.buf[self.pos:end])
+        self.pos = end
+        return value
+
+    def __read_value(self, path, select):
+        char = self.__peek()
+        if char not in '{[':
+            return (True, self.__read_scalar())
+        is_selected = select(path)
+        if is_selected is None and char == '{':
+            return (True, self.__read_object(path, select))
+        elif is_selected is False:
+            self.__find_container_end(keep=False)
+            return (False, None)
+        return (True, json_loads(self.__find_container_end(keep=True)))
+
+    def __find_container_end(self, keep):
+        # moves past the object or array at the current position, and returns its
+        # text if keep is set
+        kept_parts = []
+        start = scan = self.pos
+        depth = 0
+        is_in_string = False
+        is_escaped = False
+        while True:
+            segment = self.buf[scan:]
+            if not is_escaped and '\\' not in segment and segment.isascii():
+                # count brackets outside of strings for the whole segment at once
+                data = np.frombuffer(segment.encode('ascii'), dtype=np.uint8)
+                indexes = np.flatnonzero(JSONSectionReader.IS_SPECIAL_BYTE[data])
+                chars = data[indexes]
+                is_outside_string = (np.cumsum(chars == 34) + is_in_string) % 2 == 0
+                depths = depth + np.cumsum(JSONSectionReader.BYTE_DEPTH_DELTAS[chars] * is_outside_string)
+                ends = np.flatnonzero(depths == 0)
+                if len(ends) > 0:
+                    self.pos = scan + int(indexes[ends[0]]) + 1
+                    break
+                if len(chars) > 0:
+                    depth = int(depths[-1])
+                    is_in_string = not is_outside_string[-1]
+            else:
+                skip_index = 0 if is_escaped else -1
+                is_escaped = False
+                for match in JSONSectionReader.SPECIAL_CHAR_PATTERN.finditer(segment):
+                    index = match.start()
+                    char = segment[index]
+                    if index == skip_index:
+                        continue
+                    elif is_in_string:
+                        if char == '\\':
+                            skip_index = index + 1
+                            is_escaped = skip_index == len(segment)
+                        elif char == '"':
+                            is_in_string = False
+                    elif char == '"':
+                        is_in_string = True
+                    elif char in '{[':
+                        depth += 1
+                    elif char in '}]':
+                        depth -= 1
+                        if depth == 0:
+                            self.pos = scan + index + 1
+                            break
+                if depth == 0:
+                    break
+            if self.is_eof:
+                raise ValueError("unexpected end of JSON document")
+            if keep:
+                kept_parts.append(self.buf[start:])
+            self.__fill(keep_from=len(self.buf))
+            start = scan = 0
+        if keep:
+            kept_parts.append(self.buf[start:self.pos])
+            return ''.join(kept_parts)
+
+    def __read_object(self, path, select):
+        obj = {}
+        self.__expect('{')
+        if self.__peek() == '}':
+            self.pos += 1
+            return obj
+        while True:
+            if self.__peek() != '"':
+                raise ValueError("expected object key at offset {0}".format(self.pos))
+            key = self.__read_string()
+            self.__expect(':')
+            (is_selected, value) = self.__read_value(path + (key,), select)
+            if is_selected:
+                obj[key] = value
+            char = self.__peek()
+            self.pos += 1
+            if char == '}':
+                return obj
+            elif char != ',':
+                raise ValueError("expected ',' or '}}' at offset {0}".format(self.pos - 1))
+
 class DataSource(object):
-    def __init__(self, filename, compress=False):
+    def __init__(self, filename, compress=False, byte_ranges=None):
         self.filename = filename
         self.compress = compress
+        self.byte_ranges = byte_ranges
+        self.time_range = None
         self.source = None
 
     def __iter__(self):
         if self.source is None:
             self.open()
-        return self.source
+        return iter(self.source)
 
     def __next__(self):
         return next(self.source) if self.source is not None else None
 
-    def open(self, newline=None):
+    def open(self, newline=None, binary=False):
         if self.source is None:
-            if self.filename == '-':
+            if self.time_range is not None and self.byte_ranges is None and self.filename != '-':
+                index = read_time_index(self.filename)
+                if index is not None:
+                    self.compress = True
+                    blocks = select_indexed_blocks(index['blocks'], *self.time_range)
+                    f = io.BufferedReader(IndexedArchiveReader(self.filename, index['codec'], blocks))
+                    if binary:
+                        self.source = ByteLineReader(f, newline=newline.encode() if newline is not None else b'\n')
+                    else:
+                        self.source = io.TextIOWrapper(f, newline=newline)
+                    return
+            if binary:
+                # lines are bytes ending in newline, which defaults to b'\n' here
+                newline = newline.encode() if newline is not None else b'\n'
+                if self.filename == '-':
+                    self.source = ByteLineReader(sys.stdin.buffer, newline=newline)
+                elif self.is_seekable():
+                    self.source = MappedLineReader(self.filename, byte_ranges=self.byte_ranges, newline=newline)
+                elif self.byte_ranges is None and detect_compression_codec(self.filename) is not None:
+                    self.compress = True
+                    self.source = BackgroundLineReader(self.filename, detect_compression_codec(self.filename), newline=newline)
+                elif self.byte_ranges is not None:
+                    self.source = ByteLineReader(ByteRangeReader(self.__open_binary(), self.byte_ranges), newline=newline)
+                else:
+                    self.source = ByteLineReader(self.__open_binary(), newline=newline)
+            elif self.filename == '-':
                 self.source = sys.stdin
-            elif self.compress or self.filename.endswith(".xz"):
-                self.compress = True
-                self.source = lzma.open(self.filename, mode='rt', newline=newline)
-            elif self.filename.endswith(".gz"):
-                self.compress = True
-                self.source = gzip.open(self.filename, 'rt', newline=newline)
+            elif self.byte_ranges is not None:
+                self.source = io.TextIOWrapper(io.BufferedReader(ByteRangeReader(self.__open_binary(), self.byte_ranges)), newline=newline)
             else:
-                self.source = open(self.filename, 'rt', newline=newline)
+                self.compress = self.compress or detect_compression_codec(self.filename) is not None
+                self.source = open_file(self.filename, 'rt', newline=newline)
+
+    def __open_binary(self):
+        self.compress = self.compress or detect_compression_codec(self.filename) is not None
+        return open_file(self.filename, 'rb')
+
+    def is_seekable(self):
+        # the compression codec is detected from the contents, not the file name
+        if self.filename == '-' or self.compress or not os.path.isfile(self.filename):
+            return False
+        return detect_compression_codec(self.filename) is None
+
+    def set_byte_ranges(self, byte_ranges):
+        # only read the given (start, end) byte ranges of the uncompressed file contents
+        self.byte_ranges = byte_ranges
+
+    def has_time_index(self):
+        return self.filename != '-' and os.path.isfile(self.filename + TIME_INDEX_EXTENSION)
+
+    def set_time_range(self, start_ts, end_ts):
+        # only decompress the blocks of an indexed archive that may contain lines
+        # in the [start_ts, end_ts) unix timestamp range, plus the first block
+        self.time_range = (start_ts, end_ts)
 
     def get_file_handle(self):
         if self.source is None:
@@ -223,7 +1274,9 @@ class DataSource(object):
         return self.source
 
     def close(self):
-        if self.source is not None: self.source.close()
+        if self.source is not None:
+            self.source.close()
+            self.source = None
 
 
 class Writable(object, metaclass=ABCMeta):
@@ -237,19 +1290,39 @@ class Writable(object, metaclass=ABCMeta):
 
 class FileWritable(Writable):
 
-    def __init__(self, filename, do_compress=False, do_truncate=False):
+    def __init__(self, filename, do_compress=False, do_truncate=False, codec=None, level=None, threads=1, rotate_codec='gz',
+                 rotate_block_size=None):
+        '''
+        Files are compressed with the given codec, or the one that belongs to the
+        extension of the file name, or xz if do_compress is set, and rotated files
+        are compressed with rotate_codec. The compression level and number of
+        threads are used for both. If rotate_block_size is set, rotated files are
+        compressed in blocks of that many bytes with a time index next to them,
+        see write_indexed_archive.
+        '''
         self.filename = filename
         self.do_compress = do_compress
         self.do_truncate = do_truncate
+        self.codec = codec
+        self.level = level
+        self.threads = threads
+        self.rotate_codec = rotate_codec
+        self.rotate_block_size = rotate_block_size
+        if self.rotate_block_size is not None and self.rotate_block_size <= 0:
+            raise ValueError("rotate block size must be positive, not {0}".format(self.rotate_block_size))
         self.file = None
         self.lock = Lock()
 
         if self.filename == '-':
             self.file = sys.stdout
-        elif self.do_compress or self.filename.endswith(".xz"):
-            self.do_compress = True
-            if not self.filename.endswith(".xz"):
-                self.filename += ".xz"
+        else:
+            if self.codec is None:
+                self.codec = get_compression_codec(self.filename) or ('xz' if self.do_compress else None)
+            if self.codec is not None:
+                self.do_compress = True
+                extension = COMPRESSION_CODECS[self.codec][0]
+                if not self.filename.endswith(extension):
+                    self.filename += extension
 
     def write(self, msg):
         self.lock.acquire()
@@ -264,7 +1337,7 @@ class FileWritable(Writable):
 
     def __open_nolock(self):
         if self.do_compress:
-            self.file = lzma.open(self.filename, mode='wt')
+            self.file = open_file(self.filename, 'wt', codec=self.codec, level=self.level, threads=self.threads)
         else:
             self.file = open(self.filename, 'wt' if self.do_truncate else 'at', 1)
 
@@ -279,26 +1352,37 @@ class FileWritable(Writable):
             self.file = None
 
     def rotate_file(self, filename_datetime=datetime.datetime.now()):
-        self.lock.acquire()
+        with self.lock:
+            # build up the new filename with an embedded timestamp and ending in the extension of the codec
+            base = os.path.basename(self.filename)
+            base_noext = os.path.splitext(os.path.splitext(base)[0])[0]
+            ts = filename_datetime.strftime("%Y-%m-%d_%H:%M:%S")
+            new_base = base.replace(base_noext, "{0}_{1}".format(base_noext, ts))
+            new_filename = self.filename.replace(base, "log_archive/{0}{1}".format(new_base, COMPRESSION_CODECS[self.rotate_codec][0]))
 
-        # build up the new filename with an embedded timestamp and ending in .gz
-        base = os.path.basename(self.filename)
-        base_noext = os.path.splitext(os.path.splitext(base)[0])[0]
-        ts = filename_datetime.strftime("%Y-%m-%d_%H:%M:%S")
-        new_base = base.replace(base_noext, "{0}_{1}".format(base_noext, ts))
-        new_filename = self.filename.replace(base, "log_archive/{0}.gz".format(new_base))
+            make_dir_path(os.path.dirname(new_filename))
 
-        make_dir_path(os.path.dirname(new_filename))
+            # close and copy the old file, then truncate and reopen the old file
+            self.__close_nolock()
+            try:
+                if self.rotate_block_size is not None:
+                    with open(self.filename, 'rb') as f_in:
+                        archived_size = write_indexed_archive(f_in, new_filename, codec=self.rotate_codec, level=self.level,
+                                                              block_size=self.rotate_block_size)
+                    # never truncate a log that did not make it into the archive in full
+                    log_size = os.path.getsize(self.filename)
+                    if archived_size != log_size:
+                        raise IOError("archived {0} of {1} bytes of {2} to {3}, not truncating it".format(
+                            archived_size, log_size, self.filename, new_filename))
+                else:
+                    with open(self.filename, 'rb') as f_in, open_file(new_filename, 'wb', codec=self.rotate_codec, level=self.level, threads=self.threads) as f_out:
+                        shutil.copyfileobj(f_in, f_out)
+                with open(self.filename, 'ab') as f_in:
+                    f_in.truncate(0)
+            finally:
+                # keep logging to the old file even if it could not be rotated
+                self.__open_nolock()
 
-        # close and copy the old file, then truncate and reopen the old file
-        self.__close_nolock()
-        with open(self.filename, 'rb') as f_in, gzip.open(new_filename, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        with open(self.filename, 'ab') as f_in:
-            f_in.truncate(0)
-        self.__open_nolock()
-
-        self.lock.release()
         # return new file name so it can be processed if desired
         return new_filename
 
@@ -308,7 +1392,7 @@ class MemoryWritable(Writable):
         self.str_buffer = StringIO()
 
     def write(self, msg):
-        self.str_buffer.write()
+        self.str_buffer.write(msg)
 
     def readline(self):
         return self.str_buffer.readline()